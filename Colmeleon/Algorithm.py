@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import math
 from Histogram import ColorHistogram, GreyHistogram, Histogram
+from Histogram import CompactHistogram
 from Database import Database
 from Image import Image
 import numpy as np
 import bisect
 import matplotlib
 from deprecated import deprecated
+import Retrieval
+import ApproximateIndex
 
 def jaccard_dist(data1, data2) -> float :
     """
@@ -66,115 +68,166 @@ def euclidean_dist(data1, data2) -> float :
                         " It is not possible to calculate the euclidean "+
                         "distance in this case.")
    
+def _is_color(histo) -> bool:
+    """
+    Tell if a Histogram or a CompactHistogram holds the three colors
+    """
+    if isinstance(histo, CompactHistogram):
+        return histo.is_color()
+    return isinstance(histo.histograms, ColorHistogram)
+
+def _counts(histo):
+    """
+    Return the object holding the get_red, get_green, get_blue or get_grey
+    methods of a Histogram or a CompactHistogram
+    """
+    if isinstance(histo, CompactHistogram):
+        return histo
+    return histo.histograms
+
+def _to_grey(histo, bins):
+    """
+    Return the grey counts of a color Histogram or CompactHistogram. Their
+    channels are summed, which gives the same counts as a GreyHistogram
+    without decoding nor counting the image again, and the result is kept
+    by the histogram for the next comparisons.
+    """
+    if isinstance(histo, CompactHistogram):
+        return histo.grey().rebin(bins)
+    return histo.grey(bins)
+
+def _at_bins(histo, bins):
+    """
+    Return the counts of a Histogram or a CompactHistogram with bins bins.
+    A Histogram still has its pixels, so it serves any number of bins through
+    its pyramid. A CompactHistogram is rebinned, which raises a ValueError if
+    it can not be done exactly.
+    """
+    if histo.bins == bins:
+        return _counts(histo)
+    if isinstance(histo, CompactHistogram):
+        return histo.rebin(bins)
+    return histo.pyramid().level(bins)
+
+def _array(counts) -> np.ndarray:
+    """
+    Return the (channels, bins) array of the counts returned by _counts or
+    _at_bins
+    """
+    if isinstance(counts, CompactHistogram):
+        return counts.counts
+    if isinstance(counts, ColorHistogram):
+        return np.stack([counts.get_red(), counts.get_green(),
+                         counts.get_blue()])
+    return counts.get_grey().reshape(1, -1)
+
+def _aligned(histo_image, histo_model) -> tuple:
+    """
+    Return the (channels, bins) arrays of the counts of two histograms, with
+    the same number of bins (the smallest of both) and the same channels :
+    if one of them is in grey, the other one is turned into grey.
+    """
+    assert isinstance(histo_image, (Histogram, CompactHistogram))
+    assert isinstance(histo_model, (Histogram, CompactHistogram))
+    bins = min(histo_image.bins, histo_model.bins)
+    if _is_color(histo_image) and _is_color(histo_model):
+        return (_array(_at_bins(histo_image, bins)),
+                _array(_at_bins(histo_model, bins)))
+    if _is_color(histo_image):
+        image = _to_grey(histo_image, bins)
+    else:
+        image = _at_bins(histo_image, bins)
+    if _is_color(histo_model):
+        model = _to_grey(histo_model, bins)
+    else:
+        model = _at_bins(histo_model, bins)
+    return _array(image), _array(model)
+
+def _sum_dtype(counts):
+    """
+    Return the type in which counts are summed without overflow
+    """
+    return np.int64 if counts.dtype.kind in "ui" else np.float64
+
+def _sum_of_minimums(image, models) -> np.ndarray:
+    """
+    Return the (number of models, channels) sums over the bins of the
+    minimum of the image and each model. When the counts are integers, each
+    sum is at most the total of the channel of the image, so if it fits in
+    the type of the models the whole computation stays in that type.
+    """
+    if models.dtype.kind in "ui":
+        limit = np.iinfo(models.dtype).max
+        if (image.dtype != models.dtype and image.size > 0 and
+            image.min() >= 0 and image.max() <= limit):
+            image = image.astype(models.dtype)
+        if (image.dtype == models.dtype and
+            image.sum(axis = -1, dtype = _sum_dtype(image)).max() <= limit):
+            return np.einsum("...cb->...c", np.minimum(image, models))
+    return np.minimum(image, models).sum(axis = -1,
+                                         dtype = _sum_dtype(models))
+
+def intersection_scores(image, models, pixels = None):
+    """
+    ===========================================================================
+    This function calculates the percentage of correspondence between the
+    counts of an image and the counts of one or many models at once.
+    For each channel (red, green, blue or grey alone), it sums the minimum of
+    each bin, divides it by the number of pixels of the model, and keeps the
+    smallest value among the channels.
+    ===========================================================================
+    Arguments :
+        image : The (channels, bins) counts of the image
+        models : The (channels, bins) counts of a model, or the stacked
+                 (number of models, channels, bins) counts of many models
+        pixels : The number of pixels of each model. By default, it is the
+                 sum of its first channel.
+    Return :
+        The value of correspondence with the model, or the array of the
+        values of correspondence with each model.
+    """
+    image = np.asarray(image)
+    models = np.asarray(models)
+    single = models.ndim == image.ndim
+    if single:
+        models = models[np.newaxis]
+    assert models.shape[1:] == image.shape, {"intersection_scores : the "+
+                        f"counts of shape {image.shape} can not be compared"+
+                        f" with counts of shape {models.shape[1:]}"}.pop()
+    inter = _sum_of_minimums(image, models)
+    if pixels is None:
+        pixels = models[:, 0].sum(axis = -1, dtype = _sum_dtype(models))
+    pixels = np.asarray(pixels).reshape(-1, 1)
+    #the models without pixels match nothing, as in Quantization
+    values = np.divide(inter, pixels, out = np.full(inter.shape, np.nan),
+                       where = pixels > 0).min(axis = 1) * 100
+    return values[0] if single else values
+
 def intersection(histo_image, histo_model)-> list:
     """
     ===========================================================================
     This function calculates the intersection of two histograms.
     It takes the minimum of each composants (red, green blue and grey) between 
     the model histogram and the image given. 
+    If the histograms do not have the same number of bins, the largest one is
+    brought down to the number of bins of the smallest one.
+    If one of them is in grey, the other one is turned into grey.
     ===========================================================================
     Arguments : 
-        histo_image : The Histogram object of the image
-        histo_model : The Histogram object of the model
-    Returns: the histogram data of the intersection of the two histograms.
-    
+        histo_image : The Histogram (or CompactHistogram) object of the image
+        histo_model : The Histogram (or CompactHistogram) object of the model
+    Returns: the histogram data of the intersection of the two histograms :
+        the lists of the red, blue and green bins, or the list of grey bins.
+    Raises :
+        ValueError if a CompactHistogram can not be brought down exactly to
+        the number of bins of the other histogram
     """
-    assert type(histo_image) is Histogram
-    assert type(histo_model) is Histogram
-    matplotlib.use("Agg")
-    histo=[]
-    #Defines which histogram is the largest and smallest 
-    histo_min = {histo_image if histo_image.bins <= histo_model.bins 
-                 else histo_model}.pop()
-    histo_max = {histo_image if histo_image.bins >= histo_model.bins 
-                 else histo_model}.pop()
-    #Calculates the ratio between the size of the two histograms
-    ratio = histo_min.bins/histo_max.bins
-    
-    #Treat all cases : 
-    # - image histogram and model histogram are both instance of ColorHistogram
-    # - image histogram and model histogram are both instance of GreyHistogram
-    # - image histogram is an instance of ColorHistogram and model histogram 
-    #   is an instance of GreyHistogram
-    # - image histogram is an instance of GreyHistogram and model histogram 
-    #   is an instance of ColorHistogram
-    if(isinstance(histo_image.histograms, ColorHistogram) 
-        and isinstance(histo_model.histograms, ColorHistogram)):      
-        histo.append([])
-        histo.append([])
-        histo.append([])
-        
-        for j in range(histo_min.bins):
-            #To avoid loss of information
-            if (j%2) == 0:
-                ratio=math.ceil(ratio)
-            else:
-                ratio=math.floor(ratio)
-            #The largest histogram needs to scale up to the smallest
-            red = sum(((histo_max.histograms.get_red())
-                       [ratio*j : ratio*(j+1)]))
-            blue = sum(((histo_max.histograms.get_blue())
-                        [ratio*j : ratio*(j+1)]))
-            green =sum(((histo_max.histograms.get_green())
-                        [ratio*j : ratio*(j+1)]))
-            #Add the smaller of the two data
-            histo[0].append(min((histo_min.histograms.get_red())[j], red))
-            histo[1].append(min((histo_min.histograms.get_blue())[j], blue))
-            histo[2].append(min((histo_min.histograms.get_green())[j], green))
-        return histo
-    if(isinstance(histo_image.histograms, GreyHistogram) 
-       and isinstance(histo_model.histograms, GreyHistogram)):
-        for j in range(histo_min.bins):
-            if (j%2)==0:
-                ratio=math.ceil(ratio)
-            else: 
-                ratio=math.floor(ratio)
-            grey = sum(histo_max.histograms.get_grey()[ratio*j : ratio*(j+1)])
-            histo.append(min(histo_min.histograms.get_grey()[j],grey))
-
-        return histo
-    if(isinstance(histo_image.histograms, ColorHistogram) 
-       and isinstance(histo_model.histograms, GreyHistogram)):
-        #Transforms the color histogram of the image into a grey histogram
-        his = Histogram(histo_image.image, histo_image.bins, True)
-        if histo_image.bins == histo_min.bins:
-            for j in range(histo_min.bins):
-                if (j%2)==0:
-                    ratio=math.ceil(ratio)
-                else: 
-                    ratio=math.floor(ratio)
-                grey = (histo_model.histograms.get_grey())[ratio*j:ratio*(j+1)]
-                histo.append(min((his.histograms.get_grey())[j], grey))
-        else:
-            for j in range(histo_min.bins):
-                if (j%2)==0:
-                    ratio=math.ceil(ratio)
-                else: 
-                    ratio=math.floor(ratio)
-                grey = (his.histograms.get_grey())[ratio*j : ratio*(j+1)]
-                histo.append(min((histo_min.histograms.get_grey())[j],grey))
-        return histo
-    if(isinstance(histo_image.histograms, GreyHistogram) 
-       and isinstance(histo_model.histograms, ColorHistogram)):
-        #Transforms the color histogram of the model into a grey histogram
-        his = Histogram(histo_model.image, histo_image.bins, True)
-        if histo_image.bins == histo_min.bins:
-            for j in range(histo_min.bins):
-                if (j%2)==0:
-                    ratio=math.ceil(ratio)
-                else: 
-                    ratio=math.floor(ratio)
-                grey = (his.histograms.get_grey())[ratio*j:ratio*(j+1)]
-                histo.append(min((histo_min.histograms.get_grey())[j], grey))
-        else:
-            for j in range(histo_min.bins):
-                if (j%2)==0:
-                    ratio=math.ceil(ratio)
-                else: 
-                    ratio=math.floor(ratio)
-                grey = (histo_max.histograms.get_grey())[ratio*j : ratio*(j+1)]
-                histo.append(min((his.histograms.get_grey())[j],grey))
-        return histo  
+    image, model = _aligned(histo_image, histo_model)
+    histo = [list(channel) for channel in np.minimum(image, model)]
+    if len(histo) == 1:
+        return histo[0]
+    red, green, blue = histo
+    return [red, blue, green]
 
 @deprecated("This method does not work well, and the intersection method is"+
             " better and faster.")
@@ -241,41 +294,36 @@ def match_value(histo_image, histo_model, function = intersection) -> float:
     It uses a function that represents the algorithm used.
     ===========================================================================
     Arguments : 
-        histo_image : The Histogram object of the image
-        histo_model : The Histogram object of the model
+        histo_image : The Histogram (or CompactHistogram) object of the image
+        histo_model : The Histogram (or CompactHistogram) object of the model
         function : the algorithm used for the intersection.
-                   By default, it is the intersection function 
+                   By default, it is the intersection function, computed by
+                   intersection_scores
     Return : The value of correspondence between two histograms.
     """
-    assert isinstance(histo_image, Histogram)
-    assert isinstance(histo_model, Histogram)
+    assert isinstance(histo_image, (Histogram, CompactHistogram))
+    assert isinstance(histo_model, (Histogram, CompactHistogram))
 #    matplotlib.use("Agg")
 
-    histo = function(histo_image, histo_model)
-    pixels = {sum(histo_model.histograms.get_red() 
-                  if isinstance(histo_model.histograms, ColorHistogram) 
-                  else histo_model.histograms.get_grey())}.pop()
-    r=0
-    b=0
-    g=0
-    grey=0
-    if(isinstance(histo_image.histograms, ColorHistogram) 
-       and isinstance(histo_model.histograms, ColorHistogram)):
-        for i in range(len(histo[0])):
-            r+=histo[0][i]
-            b+=histo[1][i]
-            g+=histo[2][i]
-        value = min([r/pixels,b/pixels,g/pixels])
-    else: 
-        for i in range(len(histo)):
-            grey = histo[i] + grey
-        value = grey/pixels
-    return value*100
+    #the number of pixels of the model, whatever the channels compared
+    model_counts = _array(_counts(histo_model))
+    pixels = model_counts[0].sum(dtype = _sum_dtype(model_counts))
+    if function is intersection:
+        image, model = _aligned(histo_image, histo_model)
+        return float(intersection_scores(image, model, pixels))
+    histo = np.array(function(histo_image, histo_model))
+    if histo.ndim == 1:
+        histo = histo.reshape(1, -1)
+    return float((histo.sum(axis = -1) / pixels).min() * 100)
 
 
 def retrieval(database, histoImage, depth=15, incremental = False, 
                             compareFunction = euclidean_dist,
-                            grey = False) -> list:
+                            grey = False, mode = None, stats = None,
+                            nprobe = 8, subquantizers = 16,
+                            kernel = None, workers = None,
+                            shard_size = None, nclusters = 4,
+                            dtype = None) -> list:
     """
     ===========================================================================
     This function calculates the closest matching images in the database.
@@ -289,6 +337,23 @@ def retrieval(database, histoImage, depth=15, incremental = False,
                       Incremental method (True) or not (False).
         compareFunction :The algorithm used for the intersection.
                          By default, it is the euclidean_dist() function
+        mode        : A mode of Retrieval.MODES, used instead of the ones
+                      incremental and grey select, if given
+        stats       : A dictionary in which the counters of the retrieval
+                      are added, if given (see Retrieval.search)
+        nprobe, subquantizers : The parameters of the Retrieval.APPROXIMATE
+                      mode, see Retrieval.search
+        kernel      : The name of a kernel of Kernels.KERNELS comparing the
+                      whole database with the query instead of the default
+                      distance of the mode, if given (see Retrieval.search)
+        workers, shard_size : The number of processes scoring shards of
+                      shard_size images of the database, if given (see
+                      Retrieval.search)
+        nclusters   : The number of clusters scored by the
+                      Retrieval.CLUSTERED mode, see Retrieval.search
+        dtype       : The name of a storage type of Quantization.DTYPES the
+                      histograms of the database are scored in, if given
+                      (see Retrieval.search)
     Return : 
         The n best matched images as a list of tuples (value,pathToImage)
     """
@@ -301,7 +366,17 @@ def retrieval(database, histoImage, depth=15, incremental = False,
     result=[]
     value=0
 
-    if incremental : #For incremental method
+    #The whole database is scored at once by the retrieval engine, unless
+    #another comparison function is given for the incremental method
+    if ((kernel is not None or workers is not None or dtype is not None)
+        and mode is None) :
+        mode = (Retrieval.INCREMENTAL if incremental else
+                Retrieval.GREY if grey else Retrieval.INTERSECTION)
+    if mode is not None :
+        result = Retrieval.search(database, histoImage, depth, mode, stats,
+                                  nprobe, subquantizers, kernel, workers,
+                                  shard_size, nclusters, dtype)
+    elif incremental and compareFunction is not euclidean_dist :
         histoImage = Histogram.color_axes(histoImage)
         for a in database.bin_histograms():
             if len(result)<depth:
@@ -312,51 +387,58 @@ def retrieval(database, histoImage, depth=15, incremental = False,
                 if value<result[-1][0]:
                     del(result[-1])
                     bisect.insort(result, (value, a[0]))
-
-    else : #For intersection method
-        if grey:
-            for a in database.grey_histograms():
-                if len(result)<depth:
-                    bisect.insort(result, (abs(100-match_value(histoImage,
-                                             a[1])), 
-                                             a[0]))
-                else:
-                    value=abs(100.0-match_value(histoImage, a[1]))
-                    if value<result[-1][0]:
-                        del(result[-1])
-                        bisect.insort(result, (value, a[0]))
-        else:
-            for a in database.histograms():
-                if len(result)<depth:
-                    bisect.insort(result, (abs(100-match_value(histoImage,
-                                             a[1])), 
-                                             a[0]))
-                else:
-                    value=abs(100.0-match_value(histoImage, a[1]))
-                    if value<result[-1][0]:
-                        del(result[-1])
-                        bisect.insort(result, (value, a[0]))
+    elif incremental : #For incremental method
+        result = Retrieval.search(database, histoImage, depth,
+                                  Retrieval.INCREMENTAL, stats)
+    elif grey : #For intersection method
+        result = Retrieval.search(database, histoImage, depth,
+                                  Retrieval.GREY, stats)
+    else :
+        result = Retrieval.search(database, histoImage, depth,
+                                  Retrieval.INTERSECTION, stats)
         
     return result
         
         
     
     
-def label_images(img):
+def label_images(img, db, clusters = None) -> int:
     """
     ===========================================================================
-    This function is a labelling of a given image according to potential(s)
-    caracteristic(s)
+    This function is a labelling of a given image according to its colors :
+    its label is the cluster of the database (see cluster) closest to its
+    color histogram.
     ===========================================================================
+    Arguments :
+        img : The Image, or its Histogram
+        db : The Database whose clusters are used
+        clusters : The number of clusters, see cluster
+    Return :
+        The label of the image, between 0 and the number of clusters
     """
-    assert type(img) is Image
+    assert type(img) in (Image, Histogram)
+    assert type(db) is Database
+    histo = Histogram(img) if type(img) is Image else img
+    index = Retrieval.cluster_index(db, clusters)
+    return index.label(ApproximateIndex.vector(histo))
 
-def cluster(db):
+def cluster(db, clusters = None) -> dict:
     """
     ===========================================================================
     Groups the images in the database according to the labels that have been
-    assigned to them
+    assigned to them : the clusters of a mini-batch k-means of their color
+    histograms (see ClusterIndex), computed once and stored with the
+    database, the images added afterwards going to their closest cluster.
     ===========================================================================
+    Arguments :
+        db : The Database with all the calculated histograms inside
+        clusters : The number of clusters. By default, the clusters stored
+                   are kept, or the square root of the number of images is
+                   used.
+    Return :
+        A dictionary giving the list of the paths of the images of each
+        label
     """
     assert type(db) is Database
+    return Retrieval.cluster_index(db, clusters).clusters()
 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pickle
+import numpy as np
+from FeatureStore import dump
+from Histogram import Histogram, HistogramPyramid
+
+#Number of bins per channel of the vectors of the index
+BINS = 32
+
+#Number of iterations of the k-means
+_ITERATIONS = 15
+
+#Most vectors a k-means is trained on
+_TRAINING = 16384
+
+def vector(histo) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the vector under which the index knows a histogram : its counts
+    at BINS bins divided by its number of pixels, a grey histogram counting
+    as a color one with three equal channels.
+    ===========================================================================
+    Argument :
+        histo : A Histogram, CompactHistogram or HistogramPyramid
+    Returns :
+        The (3 * BINS,) vector
+    """
+    if isinstance(histo, HistogramPyramid):
+        histo = histo.level(BINS)
+    elif isinstance(histo, Histogram):
+        histo = histo.pyramid().level(BINS)
+    else:
+        histo = histo.rebin(BINS)
+    counts = histo.counts.astype(np.float64)
+    counts /= max(counts[0].sum(), 1)
+    if not histo.is_color():
+        counts = np.repeat(counts, 3, axis = 0)
+    return counts.reshape(-1)
+
+def _squared_distances(vectors, centroids) -> np.ndarray:
+    """
+    The (N, K) squared euclidean distances of vectors to centroids
+    """
+    res = (np.sum(vectors ** 2, axis = 1)[:, np.newaxis] -
+           2 * vectors @ centroids.T + np.sum(centroids ** 2, axis = 1))
+    return np.maximum(res, 0)
+
+def nearest_centroids(vectors, centroids) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the index of the centroid closest to each vector, for the
+    euclidean distance.
+    ===========================================================================
+    Arguments :
+        vectors : The (N, dimensions) vectors
+        centroids : The (K, dimensions) centroids
+    Returns :
+        The (N,) indexes of the centroids
+    """
+    return np.argmin(np.sum(centroids ** 2, axis = 1) -
+                     2 * vectors @ centroids.T, axis = 1)
+
+def _kmeans(vectors, clusters, rng) -> np.ndarray:
+    """
+    Return clusters centroids of the vectors found by Lloyd's algorithm,
+    an empty cluster being moved to a random vector
+    """
+    if len(vectors) > _TRAINING:
+        vectors = vectors[rng.choice(len(vectors), _TRAINING, replace = False)]
+    clusters = max(1, min(clusters, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), clusters, replace = False)]
+    for _ in range(_ITERATIONS):
+        labels = nearest_centroids(vectors, centroids)
+        sizes = np.bincount(labels, minlength = clusters)
+        order = np.argsort(labels, kind = "stable")
+        sums = np.zeros_like(centroids)
+        filled = np.flatnonzero(sizes)
+        sums[filled] = np.add.reduceat(vectors[order],
+                                       np.cumsum(sizes)[filled] -
+                                       sizes[filled])
+        empty = sizes == 0
+        centroids[~empty] = sums[~empty] / sizes[~empty, np.newaxis]
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    return centroids
+
+class ApproximateIndex:
+    """
+    ===========================================================================
+    Class representing an inverted file index with product quantization
+    (IVF-PQ) over the histograms of a database, for approximate retrieval.
+    The vectors (see vector) are spread among lists around the centroids of
+    a k-means. Inside a list, each vector is only kept as a code of
+    subquantizers bytes : the closest of 256 centroids for each part of its
+    difference with the centroid of the list.
+    A query only visits its nprobe closest lists, ranks their vectors by the
+    approximate distances the codes give, and keeps the best ones, which are
+    then scored exactly by the caller.
+    The index is stored next to the histograms of the database, and the
+    images added since are added to it when it is loaded (see
+    Database.ann_index).
+    ===========================================================================
+    Attributes :
+        paths : the paths to the images, in the order of the rows
+        centroids : the (lists, 3 * BINS) centroids of the lists
+        codebooks : the (subquantizers, 256, 3 * BINS / subquantizers)
+                    centroids of the parts of the vectors
+        rows, codes : for each list, the rows it holds and their codes
+        version : the version of the database the index was built for (see
+                  Database.version)
+    """
+    def __init__(self, paths, vectors, lists = None, subquantizers = 16,
+                 version = None, seed = 0):
+        """
+        =======================================================================
+        Train the index on vectors and add them.
+        =======================================================================
+        Arguments :
+            paths : the paths to the images of the vectors
+            vectors : the (N, 3 * BINS) vectors
+            lists : the number of lists, by default the square root of N
+            subquantizers : the number of bytes of a code, it must divide
+                            3 * BINS
+            version : see the attributes
+            seed : the seed of the k-means
+        """
+        vectors = np.asarray(vectors, dtype = np.float64).reshape(-1, 3*BINS)
+        assert (3 * BINS) % subquantizers == 0, {"ApproximateIndex : the "+
+                     f"number of subquantizers must divide {3 * BINS}"}.pop()
+        if lists is None:
+            lists = int(np.sqrt(len(vectors)))
+        rng = np.random.default_rng(seed)
+        self.paths = []
+        self.version = version
+        self.subquantizers = subquantizers
+        if len(vectors) == 0:
+            vectors = np.zeros((1, 3 * BINS))
+        self.centroids = _kmeans(vectors, lists, rng)
+        residuals = vectors - self.centroids[self._assign(vectors)]
+        parts = residuals.reshape(len(vectors), subquantizers, -1)
+        self.codebooks = np.stack([_kmeans(parts[:, m], 256, rng)
+                                   for m in range(subquantizers)])
+        if len(self.codebooks[0]) < 256:
+            #too few vectors, the missing codes repeat the first one and are
+            #never chosen
+            missing = 256 - len(self.codebooks[0])
+            self.codebooks = np.concatenate([self.codebooks, np.repeat(
+                self.codebooks[:, :1], missing, axis = 1)], axis = 1)
+        self.rows = [np.zeros(0, dtype = np.intp) for _ in self.centroids]
+        self.codes = [np.zeros((0, subquantizers), dtype = np.uint8)
+                      for _ in self.centroids]
+        if len(paths):
+            self.add(paths, vectors)
+
+    def from_histograms(entries, lists = None, subquantizers = 16,
+                        version = None):
+        """
+        =======================================================================
+        Build the index of couples (path to image, histogram), such as the
+        ones the Database generators yield.
+        =======================================================================
+        """
+        paths, vectors = [], []
+        for path, histo in entries:
+            paths.append(path)
+            vectors.append(vector(histo))
+        return ApproximateIndex(paths, np.stack(vectors) if vectors
+                                else np.zeros((0, 3 * BINS)), lists,
+                                subquantizers, version)
+
+    def load(path):
+        """
+        =======================================================================
+        Load an index saved by ApproximateIndex.save
+        =======================================================================
+        """
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def save(self, path) -> None:
+        dump(self, path)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _assign(self, vectors) -> np.ndarray:
+        """
+        The list of each vector
+        """
+        return nearest_centroids(vectors, self.centroids)
+
+    def add(self, paths, vectors) -> None:
+        """
+        =======================================================================
+        Add vectors at the end of the index, with the trained centroids.
+        =======================================================================
+        Arguments :
+            paths : the paths to the images of the vectors
+            vectors : their (N, 3 * BINS) vectors
+        """
+        if len(paths) == 0:
+            return
+        vectors = np.asarray(vectors, dtype = np.float64).reshape(-1, 3*BINS)
+        rows = np.arange(len(self.paths), len(self.paths) + len(vectors))
+        self.paths.extend(paths)
+        lists = self._assign(vectors)
+        parts = (vectors - self.centroids[lists]).reshape(
+            len(vectors), self.subquantizers, -1)
+        codes = np.stack([nearest_centroids(parts[:, m], self.codebooks[m])
+                          for m in range(self.subquantizers)], axis = 1)
+        for i in np.unique(lists):
+            self.rows[i] = np.concatenate([self.rows[i], rows[lists == i]])
+            self.codes[i] = np.concatenate([self.codes[i],
+                                            codes[lists == i].astype(
+                                                np.uint8)])
+
+    def candidates(self, query, count, nprobe = 8, stats = None) -> np.ndarray:
+        """
+        =======================================================================
+        Find the rows closest to a query according to their codes.
+        =======================================================================
+        Arguments :
+            query : The vector of the query (see vector)
+            count : The number of rows returned
+            nprobe : The number of lists visited
+            stats : A dictionary in which "lists" (lists visited), "codes"
+                    (codes compared) and "rows" (rows of the index) are
+                    added, if given
+        Returns :
+            The increasing indexes of the count closest rows of the visited
+            lists
+        """
+        query = np.asarray(query, dtype = np.float64).reshape(1, -1)
+        probes = np.argsort(_squared_distances(query, self.centroids)[0],
+                            kind = "stable")[:max(1, nprobe)]
+        parts = (query - self.centroids[probes]).reshape(
+            len(probes), self.subquantizers, -1)
+        #distance of each part of the query to each centroid of its part,
+        #for each list visited
+        tables = (np.sum(parts ** 2, axis = 2)[:, :, np.newaxis] -
+                  2 * np.einsum("pmd,mkd->pmk", parts, self.codebooks) +
+                  np.sum(self.codebooks ** 2, axis = 2))
+        subquantizers = np.arange(self.subquantizers)
+        rows, distances = [], []
+        for table, i in zip(tables, probes):
+            if len(self.rows[i]) > 0:
+                rows.append(self.rows[i])
+                distances.append(table[subquantizers,
+                                       self.codes[i]].sum(axis = 1))
+        if stats is not None:
+            for name, value in [("lists", len(probes)),
+                                ("codes", sum(len(r) for r in rows)),
+                                ("rows", len(self))]:
+                stats[name] = stats.get(name, 0) + value
+        if not rows:
+            return np.zeros(0, dtype = np.intp)
+        rows, distances = np.concatenate(rows), np.concatenate(distances)
+        if count < len(rows):
+            rows = rows[np.argpartition(distances, count - 1)[:count]]
+        return np.sort(rows)
@@ -0,0 +1,1006 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Benchmarks of the costly parts of Colmeleon.
+Run this file to print the results :
+    python3 Benchmark.py
+===============================================================================
+"""
+import time
+import os
+import tempfile
+import shutil
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from Histogram import channel_counts
+from Algorithm import intersection_scores
+from Histogram import CompactHistogram
+import Retrieval
+from MetricTree import MetricTree
+import ApproximateIndex
+from ShardPool import ShardPool
+from ClusterIndex import ClusterIndex
+import SimilarityJoin
+import Quantization
+import Segmentation
+from IntegralHistogram import IntegralHistogram
+import FeatureStore
+from Histogram import HistogramPyramid
+import csv
+import pickle
+import multiprocessing
+import cv2
+from Database import Database
+from Histogram import Histogram
+from Image import Image
+
+def _best_time(function, repeat) -> float:
+    """
+    ===========================================================================
+    Return the best time, in seconds, of repeat calls to function
+    ===========================================================================
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _matplotlib_histograms(imgArray, bins) -> list:
+    """
+    ===========================================================================
+    The way ColorHistogram used to count its channels, kept as a reference
+    ===========================================================================
+    """
+    res = [plt.hist(imgArray[:,:,i].flatten(), range = [0,255], bins = bins)
+           for i in range(3)]
+    plt.close("all")
+    return res
+
+def benchmark_histograms(sizes = (64, 256, 1024, 2048), bins = 255,
+                         repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the matplotlib histograms and the numpy engine of Histogram.py on
+    random square RGB images.
+    ===========================================================================
+    Arguments :
+        sizes : The widths (and heights) of the images
+        bins : The number of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (size, matplotlib time, engine time, speedup)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    for size in sizes:
+        imgArray = rng.integers(0, 256, (size, size, 3), dtype = np.uint8)
+        reference = _best_time(lambda: _matplotlib_histograms(imgArray, bins),
+                               repeat)
+        engine = _best_time(lambda: channel_counts(
+                                imgArray.reshape(-1, 3), bins), repeat)
+        res.append((size, reference, engine, reference / engine))
+    return res
+
+def _loop_match_value(image, model) -> float:
+    """
+    ===========================================================================
+    The way match_value used to score two color histograms, bin by bin, kept
+    as a reference
+    ===========================================================================
+    """
+    histo = [[], [], []]
+    for j in range(len(image[0])):
+        for i in range(3):
+            histo[i].append(min(image[i].astype(int)[j],
+                                model[i].astype(int)[j]))
+    pixels = sum(model[0].astype(int))
+    return min([sum(channel)/pixels for channel in histo])*100
+
+def benchmark_intersection(models = (100, 1000, 10000), bins = 255,
+                           repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the scoring of a query against many models bin by bin, one model
+    at a time, with intersection_scores on the stacked models.
+    ===========================================================================
+    Arguments :
+        models : The numbers of models
+        bins : The number of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (models, time per comparison of the loop, time per
+        comparison of intersection_scores, speedup)
+    """
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 1000, (3, bins), dtype = np.uint32)
+    res = []
+    for number in models:
+        stacked = rng.integers(0, 1000, (number, 3, bins), dtype = np.uint32)
+        #the loop is too slow to run on every model
+        sample = stacked[:min(number, 20)]
+        reference = _best_time(lambda: [_loop_match_value(image, model)
+                                        for model in sample], repeat)
+        reference /= len(sample)
+        engine = _best_time(lambda: intersection_scores(image, stacked),
+                            repeat) / number
+        res.append((number, reference, engine, reference / engine))
+    return res
+
+def benchmark_retrieval(sizes = (1000, 10000, 100000), bins = (255, 32),
+                        repeat = 3) -> list:
+    """
+    ===========================================================================
+    Measure the latency of a query against a FeatureMatrix of random color
+    histograms, scoring and top 15 selection included.
+    ===========================================================================
+    Arguments :
+        sizes : The numbers of images of the database
+        bins : The numbers of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (images, bins, time)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    for size in sizes:
+        for number in bins:
+            colors = rng.integers(0, 1000, (size, 3 * number),
+                                  dtype = np.uint32)
+            matrix = Retrieval.FeatureMatrix(
+                [str(i) for i in range(size)], number,
+                np.ones(size, dtype = bool), colors,
+                colors.reshape(size, 3, number).sum(axis = 1),
+                colors[:, :number].sum(axis = 1))
+            query = CompactHistogram(rng.integers(0, 1000, (3, number)),
+                                     CompactHistogram.COLOR)
+            res.append((size, number, _best_time(lambda: Retrieval.top_k(
+                np.abs(100 - matrix.scores(query)), matrix.paths, 15),
+                repeat)))
+    return res
+
+def benchmark_incremental(size = 20000, depths = (1, 15), bins = 32,
+                          repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the exhaustive and the incremental intersection of a query that
+    is one of the images, on random sparse color histograms of 4096 pixels.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        depths : The numbers of images returned
+        bins : The number of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (depth, exhaustive time, incremental time, counters
+        of the incremental intersection, see PostingIndex.candidates)
+    """
+    rng = np.random.default_rng(0)
+    colors = np.stack([rng.multinomial(4096,
+                                       rng.dirichlet(np.full(bins, 0.05)),
+                                       size = 3).reshape(-1)
+                       for _ in range(size)]).astype(np.uint32)
+    matrix = Retrieval.FeatureMatrix(
+        [str(i) for i in range(size)], bins, np.ones(size, dtype = bool),
+        colors, colors.reshape(size, 3, bins).sum(axis = 1),
+        np.full(size, 4096))
+    query = CompactHistogram(colors[0].reshape(3, bins),
+                             CompactHistogram.COLOR)
+    matrix.postings("color")
+    res = []
+    for depth in depths:
+        stats = {}
+        matrix.incremental(query, depth, stats)
+        res.append((depth,
+                    _best_time(lambda: Retrieval.top_k(
+                        np.abs(100 - matrix.scores(query)), matrix.paths,
+                        depth), repeat),
+                    _best_time(lambda: matrix.incremental(query, depth),
+                               repeat), stats))
+    return res
+
+def benchmark_metric_tree(sizes = (1000, 10000, 100000), depth = 15,
+                          repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the exhaustive euclidean search with the MetricTree on color
+    axes like vectors gathered around 100 random colors.
+    ===========================================================================
+    Arguments :
+        sizes : The numbers of vectors
+        depth : The number of neighbours looked for
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (vectors, exhaustive time, tree time, distances
+        computed by the tree)
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.dirichlet(np.full(40, 0.2), size = 100)
+    res = []
+    for size in sizes:
+        vectors = (centers[rng.integers(0, 100, size)] +
+                   rng.normal(0, 0.005, (size, 40)))
+        matrix = Retrieval.AxesMatrix([str(i) for i in range(size)], vectors)
+        tree = MetricTree(matrix.paths, vectors)
+        query = vectors[0] + 0.001
+        stats = {}
+        tree.candidates(query, depth, stats)
+        res.append((size,
+                    _best_time(lambda: Retrieval.top_k(
+                        matrix.distances(query), matrix.paths, depth),
+                        repeat),
+                    _best_time(lambda: tree.nearest(query, depth), repeat),
+                    stats["distances"]))
+    return res
+
+def benchmark_approximate(size = 20000, nprobes = (1, 4, 8, 16), depth = 15,
+                          queries = 50) -> list:
+    """
+    ===========================================================================
+    Measure the recall at depth and the latency of the APPROXIMATE mode of
+    Retrieval, against the exhaustive intersection, on color histograms of
+    4096 pixels drawn around 200 random colors.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        nprobes : The numbers of lists visited
+        depth : The number of images returned
+        queries : The number of images of the database used as queries
+    Returns :
+        A list of tuples (nprobe, recall, approximate time, exhaustive time)
+    """
+    rng = np.random.default_rng(0)
+    bins = ApproximateIndex.BINS
+    centers = rng.dirichlet(np.full(bins, 0.3), size = (200, 3))
+    counts = np.stack([[rng.multinomial(4096, center) for center in
+                        centers[rng.integers(200)]] for _ in range(size)])
+    counts = counts.astype(np.uint32)
+    matrix = Retrieval.FeatureMatrix(
+        [str(i) for i in range(size)], bins, np.ones(size, dtype = bool),
+        counts.reshape(size, -1), counts.sum(axis = 1), np.full(size, 4096))
+    index = ApproximateIndex.ApproximateIndex(
+        matrix.paths, counts.reshape(size, -1) / 4096)
+    samples = [CompactHistogram(counts[i], CompactHistogram.COLOR)
+               for i in rng.choice(size, queries, replace = False)]
+    start = time.perf_counter()
+    exact = [Retrieval.top_k(np.abs(100 - matrix.scores(query)),
+                             matrix.paths, depth) for query in samples]
+    exhaustive = (time.perf_counter() - start) / queries
+    res = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [Retrieval._approximate(matrix, index, query, depth, nprobe,
+                                        None) for query in samples]
+        latency = (time.perf_counter() - start) / queries
+        recall = float(np.mean([len({p for _, p in e} & {p for _, p in f})
+                                / depth for e, f in zip(exact, found)]))
+        res.append((nprobe, recall, latency, exhaustive))
+    return res
+
+def benchmark_cascade(size = 20000, depths = (1, 15), bins = (255, 32),
+                      repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the exhaustive intersection and the CASCADE mode of Retrieval on
+    color histograms of 4096 pixels drawn around 200 random colors, the
+    query being one of the images.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        depths : The numbers of images returned
+        bins : The numbers of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (bins, depth, exhaustive time, cascade time, rows
+        scored at full resolution by the cascade)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    for number in bins:
+        centers = rng.dirichlet(np.full(number, 0.3), size = (200, 3))
+        counts = np.stack([[rng.multinomial(4096, center) for center in
+                            centers[rng.integers(200)]] for _ in range(size)])
+        counts = counts.astype(np.uint32)
+        matrix = Retrieval.FeatureMatrix(
+            [str(i) for i in range(size)], number,
+            np.ones(size, dtype = bool), counts.reshape(size, -1),
+            counts.sum(axis = 1), np.full(size, 4096))
+        query = CompactHistogram(counts[0], CompactHistogram.COLOR)
+        matrix.summary("color")
+        for depth in depths:
+            stats = {}
+            matrix.cascade(query, depth, stats)
+            res.append((number, depth,
+                        _best_time(lambda: Retrieval.top_k(
+                            np.abs(100 - matrix.scores(query)), matrix.paths,
+                            depth), repeat),
+                        _best_time(lambda: matrix.cascade(query, depth),
+                                   repeat), stats["full"]))
+    return res
+
+def benchmark_clustered(size = 20000, nclusters = (1, 2, 4, 8), depth = 15,
+                        queries = 50) -> list:
+    """
+    ===========================================================================
+    Measure the recall at depth, the part of the scoring saved and the
+    latency of the CLUSTERED mode of Retrieval, against the exhaustive
+    intersection, on color histograms of 4096 pixels drawn around 200
+    random colors.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        nclusters : The numbers of clusters scored
+        depth : The number of images returned
+        queries : The number of images of the database used as queries
+    Returns :
+        A list of tuples (nclusters, recall, part of the rows not scored,
+        clustered time, exhaustive time)
+    """
+    rng = np.random.default_rng(0)
+    bins = ApproximateIndex.BINS
+    centers = rng.dirichlet(np.full(bins, 0.3), size = (200, 3))
+    counts = np.stack([[rng.multinomial(4096, center) for center in
+                        centers[rng.integers(200)]] for _ in range(size)])
+    counts = counts.astype(np.uint32)
+    matrix = Retrieval.FeatureMatrix(
+        [str(i) for i in range(size)], bins, np.ones(size, dtype = bool),
+        counts.reshape(size, -1), counts.sum(axis = 1), np.full(size, 4096))
+    index = ClusterIndex(matrix.paths, counts.reshape(size, -1) / 4096)
+    samples = [CompactHistogram(counts[i], CompactHistogram.COLOR)
+               for i in rng.choice(size, queries, replace = False)]
+    start = time.perf_counter()
+    exact = [Retrieval.top_k(np.abs(100 - matrix.scores(query)),
+                             matrix.paths, depth) for query in samples]
+    exhaustive = (time.perf_counter() - start) / queries
+    res = []
+    for number in nclusters:
+        stats = {}
+        start = time.perf_counter()
+        found = [Retrieval._clustered(matrix, index, query, depth, number,
+                                      stats) for query in samples]
+        latency = (time.perf_counter() - start) / queries
+        recall = float(np.mean([len({p for _, p in e} & {p for _, p in f})
+                                / depth for e, f in zip(exact, found)]))
+        res.append((number, recall, stats["saved"] / stats["rows"], latency,
+                    exhaustive))
+    return res
+
+def benchmark_sharded(size = 200000, workers = (1, 2, 4), bins = 255,
+                      repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the latency of a query scored by the process of the caller and
+    by ShardPools of several workers, on random color histograms.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        workers : The numbers of processes of the pools
+        bins : The number of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (workers, time), 0 workers being the caller alone
+    """
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 1000, (size, 3 * bins), dtype = np.uint32)
+    matrix = Retrieval.FeatureMatrix(
+        [str(i) for i in range(size)], bins, np.ones(size, dtype = bool),
+        colors, colors.reshape(size, 3, bins).sum(axis = 1),
+        colors[:, :bins].sum(axis = 1))
+    query = CompactHistogram(rng.integers(0, 1000, (3, bins)),
+                             CompactHistogram.COLOR)
+    res = [(0, _best_time(lambda: Retrieval.top_k(
+        np.abs(100 - matrix.scores(query)), matrix.paths, 15), repeat))]
+    for number in workers:
+        pool = ShardPool(matrix, number)
+        try:
+            #the workers attach to the matrix on their first query
+            pool.search([query], 15)
+            res.append((number, _best_time(lambda: pool.search([query], 15),
+                                           repeat)))
+        finally:
+            pool.close()
+    return res
+
+def benchmark_join(size = 20000, thresholds = (95, 90, 80), bins = 32,
+                   sample = 200) -> list:
+    """
+    ===========================================================================
+    Compare the time of the similarity self-join of SimilarityJoin with the
+    one of scoring every pair of images, estimated from sample images scored
+    against all the others, on color histograms of 4096 pixels drawn around
+    size / 4 random colors, so that there are near duplicates.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        thresholds : The smallest scores of the pairs kept, in percent
+        bins : The number of bins of the histograms
+        sample : The number of images the time of every pair is estimated on
+    Returns :
+        A list of tuples (threshold, pairs found, part of the pairs scored,
+        join time, every pair time)
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.dirichlet(np.full(bins, 0.3), size = (size // 4, 3))
+    counts = np.stack([[rng.multinomial(4096, center) for center in
+                        centers[rng.integers(len(centers))]]
+                       for _ in range(size)]).astype(np.uint32)
+    matrix = Retrieval.FeatureMatrix(
+        [str(i) for i in range(size)], bins, np.ones(size, dtype = bool),
+        counts.reshape(size, -1), counts.sum(axis = 1), np.full(size, 4096))
+    dists = matrix.normalized("color")
+    start = time.perf_counter()
+    for i in range(sample):
+        np.minimum(dists[i], dists).sum(axis = -1).min(axis = -1)
+    every = (time.perf_counter() - start) / sample * (size - 1) / 2
+    res = []
+    for threshold in thresholds:
+        stats = {}
+        start = time.perf_counter()
+        list(SimilarityJoin.join(matrix, threshold, stats))
+        res.append((threshold, stats["pairs"],
+                    stats["scored"] / (size * (size - 1) / 2),
+                    time.perf_counter() - start, every))
+    return res
+
+def benchmark_quantized(size = 20000, bins = (255, 32), depth = 15,
+                        queries = 20, repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the size, the latency and the accuracy of the storage types of
+    Quantization with the counts, on color histograms of 4096 to 65536
+    pixels drawn around 200 random colors, queried with images of the
+    database.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        bins : The numbers of bins of the histograms
+        depth : The number of images the recall is measured at
+        queries : The number of queries the accuracy is measured on
+        repeat : The number of runs of a query, only the best one is kept
+    Returns :
+        A list of tuples (bins, storage type, part of the size of the
+        counts, time per query, largest difference of the match values,
+        recall at depth), the storage type "uint32" being the counts
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    for number in bins:
+        centers = rng.dirichlet(np.full(number, 0.3), size = (200, 3))
+        pixels = rng.integers(4096, 65536, size)
+        counts = np.stack([[rng.multinomial(p, center) for center in
+                            centers[rng.integers(200)]]
+                           for p in pixels]).astype(np.uint32)
+        matrix = Retrieval.FeatureMatrix(
+            [str(i) for i in range(size)], number,
+            np.ones(size, dtype = bool), counts.reshape(size, -1),
+            counts.sum(axis = 1, dtype = np.uint32), pixels)
+        samples = [CompactHistogram(counts[i], CompactHistogram.COLOR)
+                   for i in rng.choice(size, queries, replace = False)]
+        exact = matrix.score_matrix(samples)
+        full = matrix.colors.nbytes + matrix.greys.nbytes
+        res.append((number, "uint32", 1.0,
+                    _best_time(lambda: matrix.scores(samples[0]), repeat),
+                    0.0, 1.0))
+        for dtype in Quantization.DTYPES:
+            quantized = Retrieval.QuantizedMatrix.from_matrix(matrix, dtype)
+            scores = quantized.score_matrix(samples)
+            recall = float(np.mean([
+                len({p for _, p in Retrieval.top_k(np.abs(100 - e),
+                                                   matrix.paths, depth)} &
+                    {p for _, p in Retrieval.top_k(np.abs(100 - s),
+                                                   matrix.paths, depth)})
+                / depth for e, s in zip(exact, scores)]))
+            res.append((number, dtype, quantized.nbytes() / full,
+                        _best_time(lambda: quantized.scores(samples[0]),
+                                   repeat),
+                        float(np.abs(scores - exact).max()), recall))
+    return res
+
+def _table_backprojection(pixels, table) -> np.ndarray:
+    """
+    ===========================================================================
+    The back-projection of a whole image by numpy indexing, kept as a
+    reference
+    ===========================================================================
+    """
+    return table[np.arange(3), pixels].min(axis = 2)
+
+def benchmark_segmentation(sizes = (1024, 4096), gigapixel = 32768, bins = 32,
+                           repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the back-projection of Segmentation with the one of numpy
+    indexing on random square RGB images held in memory, then segment a
+    gigapixel image read from a np.memmap into a np.memmap of np.uint8
+    likelihoods. The peak memory is the one numpy allocated.
+    ===========================================================================
+    Arguments :
+        sizes : The widths (and heights) of the images held in memory
+        gigapixel : The width (and height) of the image on disk, None to
+                    leave it out
+        bins : The number of bins of the histograms
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (size, numpy time, time, numpy peak memory, peak
+        memory), the times and memories of numpy being None on disk
+    """
+    rng = np.random.default_rng(0)
+    model = CompactHistogram(rng.integers(0, 1000, (3, bins)),
+                             CompactHistogram.COLOR)
+    res = []
+    for size in sizes:
+        pixels = rng.integers(0, 256, (size, size, 3), dtype = np.uint8)
+        table = Segmentation.likelihoods(model, Segmentation.image_histogram(
+            pixels, bins))[:, Segmentation.bin_lut(bins)].astype(np.float32)
+        functions = [lambda: _table_backprojection(pixels, table),
+                     lambda: Segmentation.backproject(pixels, model, bins)]
+        peaks = []
+        for function in functions:
+            tracemalloc.start()
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        res.append((size, _best_time(functions[0], repeat),
+                    _best_time(functions[1], repeat), *peaks))
+    if gigapixel is None:
+        return res
+    with tempfile.TemporaryDirectory() as directory:
+        pixels = np.lib.format.open_memmap(
+            os.path.join(directory, "image.npy"), mode = "w+",
+            dtype = np.uint8, shape = (gigapixel, gigapixel, 3))
+        band = rng.integers(0, 256, (1 << 22) * 3, dtype = np.uint8)
+        flat = pixels.reshape(-1)
+        for start in range(0, len(flat), len(band)):
+            flat[start:start+len(band)] = band[:len(flat)-start]
+        pixels.flush()
+        del flat, pixels
+        pixels = np.load(os.path.join(directory, "image.npy"),
+                         mmap_mode = "r")
+        out = np.lib.format.open_memmap(
+            os.path.join(directory, "mask.npy"), mode = "w+",
+            dtype = np.uint8, shape = (gigapixel, gigapixel))
+        tracemalloc.start()
+        start = time.perf_counter()
+        Segmentation.backproject(pixels, model, bins, out = out)
+        out.flush()
+        latency = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del pixels, out
+    res.append((gigapixel, None, latency, None, peak))
+    return res
+
+def benchmark_integral(size = 4096, windows = (256, 512, 1024), bins = 16,
+                       cell = 8, sample = 50) -> list:
+    """
+    ===========================================================================
+    Compare the search of the window of a random RGB image best matching a
+    model, a square of other colors pasted in it, by the integral histogram
+    of IntegralHistogram with the histogram of every window at a stride of
+    one cell, estimated from sample windows.
+    ===========================================================================
+    Arguments :
+        size : The width (and height) of the image
+        windows : The widths (and heights) of the windows, and of the model
+        bins : The number of bins of the histograms
+        cell : The side, in pixels, of a cell of the integral histogram
+        sample : The number of windows the time of every window is
+                 estimated on
+    Returns :
+        A list of tuples (window, build time, coarse to fine time, windows
+        scored, every window time with the integral histogram, every window
+        time by histograms, coarse to fine score, best score)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    for window in windows:
+        pixels = rng.integers(0, 256, (size, size, 3), dtype = np.uint8)
+        model = rng.integers(0, 256, (window, window, 3), dtype = np.uint8)
+        model[:, :, 0] //= 4
+        pixels[size//3:size//3+window, size//2:size//2+window] = model
+        model = CompactHistogram(channel_counts(model.reshape(-1, 3), bins),
+                                 CompactHistogram.COLOR)
+        start = time.perf_counter()
+        integral = IntegralHistogram(pixels, bins, cell)
+        build = time.perf_counter() - start
+        stats = {}
+        start = time.perf_counter()
+        found = integral.search(model, [(window, window)], stats = stats)
+        search = time.perf_counter() - start
+        side = window // cell
+        last = integral.grid()[0] - side
+        top, left = [np.ravel(axis) for axis in np.meshgrid(
+            np.arange(last + 1), np.arange(last + 1), indexing = "ij")]
+        start = time.perf_counter()
+        best = integral.scores(integral._distributions(model), top, left,
+                               side, side).max()
+        every = time.perf_counter() - start
+        start = time.perf_counter()
+        for y, x in rng.integers(0, last + 1, (sample, 2)) * cell:
+            channel_counts(np.ascontiguousarray(
+                pixels[y:y+window, x:x+window]).reshape(-1, 3), bins)
+        brute = (time.perf_counter() - start) / sample * len(top)
+        res.append((window, build, search, stats["windows"], every, brute,
+                    found[0][0], float(best)))
+    return res
+
+def _pickled_histograms(directory, bins):
+    """
+    ===========================================================================
+    The way Database.histograms used to read histograms.csv and unpickle
+    every histogram, kept as a reference
+    ===========================================================================
+    """
+    with open(os.path.join(directory, "histograms.csv"), "r") as csv_file:
+        for item in csv.reader(csv_file):
+            if len(item) > 0:
+                with open(item[1], "rb") as pickled_histo:
+                    yield item[0], pickle.load(pickled_histo).level(bins)
+
+def benchmark_store(size = 20000, bins = (255, 32)) -> list:
+    """
+    ===========================================================================
+    Compare the time to load the feature matrix of a database from one
+    pickle per image listed in histograms.csv with the one from the
+    FeatureStore, on random color histograms.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        bins : The numbers of bins of the matrices
+    Returns :
+        A list of tuples (bins, pickles time, store time)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    with tempfile.TemporaryDirectory() as directory:
+        os.mkdir(os.path.join(directory, "histograms"))
+        store = FeatureStore.FeatureStore.create(directory)
+        grey = CompactHistogram(np.zeros((1, 256)), CompactHistogram.GREY)
+        axes = np.zeros(FeatureStore.AXES)
+        with open(os.path.join(directory, "histograms.csv"), "w") as file:
+            writer = csv.writer(file)
+            for start in range(0, size, 1024):
+                entries = []
+                for i in range(start, min(size, start + 1024)):
+                    histo = CompactHistogram(rng.integers(0, 64, (3, 256)),
+                                             CompactHistogram.COLOR)
+                    path = os.path.join(directory, "histograms", str(i))
+                    with open(path, "wb") as pickled:
+                        pickle.dump(HistogramPyramid(histo), pickled)
+                    writer.writerow([f"image{i}.jpg", path])
+                    entries.append((f"image{i}.jpg", histo, grey, axes))
+                store.append(entries)
+        for number in bins:
+            start = time.perf_counter()
+            Retrieval.FeatureMatrix.from_histograms(
+                _pickled_histograms(directory, number), number)
+            pickles = time.perf_counter() - start
+            start = time.perf_counter()
+            Retrieval.FeatureMatrix.from_store(
+                FeatureStore.FeatureStore(directory), number)
+            res.append((number, pickles, time.perf_counter() - start))
+    return res
+
+def _decoded_features(file, tmpdir) -> tuple:
+    """
+    Compute the features of a file as the database did before
+    Histogram.image_features, its greyscale version going through a file
+    """
+    histo = Histogram(Image(file))
+    axes = Histogram.color_axes(histo)
+    grey = Histogram(Image.to_grey(Image(file), tmpdir), grey = True)
+    return histo.pyramid().level(256), grey.pyramid().level(256), axes
+
+def benchmark_extraction(sides = (512, 2048), repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the time to compute the features of an image stored by the
+    database when its greyscale version is written to a file and decoded
+    again, and when everything comes from a single decode (see
+    Database._calculate_histogram), on random JPEG images.
+    ===========================================================================
+    Arguments :
+        sides : The width and height of the images, in pixels
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A list of tuples (side, time through a file, time in memory)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    with tempfile.TemporaryDirectory() as directory:
+        database = Database(directory, directory)
+        for side in sides:
+            file = os.path.join(directory, f"image{side}.jpg")
+            cv2.imwrite(file, rng.integers(0, 256, (side, side, 3),
+                                           dtype = np.uint8))
+            res.append((side,
+                        _best_time(lambda: _decoded_features(file, directory),
+                                   repeat),
+                        _best_time(lambda: database._calculate_histogram(file),
+                                   repeat)))
+    return res
+
+def benchmark_indexing(size = 200, workers = (1, 2, 4),
+                       side = 512) -> list:
+    """
+    ===========================================================================
+    Compare the throughput of the computation of the histograms of a
+    database (see Database._calculate_histograms) with several numbers of
+    worker processes, on random JPEG images.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        workers : The numbers of processes
+        side : The width and height of the images, in pixels
+    Returns :
+        A list of tuples (workers, time, images per second)
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    with tempfile.TemporaryDirectory() as directory:
+        images = os.path.join(directory, "images")
+        os.mkdir(images)
+        for i in range(size):
+            cv2.imwrite(os.path.join(images, f"image{i}.jpg"),
+                        rng.integers(0, 256, (side, side, 3),
+                                     dtype = np.uint8))
+        for number in workers:
+            shutil.rmtree(FeatureStore.FeatureStore.path(images),
+                          ignore_errors = True)
+            stats = {}
+            Database(images, directory)._calculate_histograms(
+                workers = number, stats = stats)
+            res.append((number, stats["seconds"],
+                        stats["images"] / stats["seconds"]))
+    return res
+
+def benchmark_reindex(size = 5000, changed = (0, 50), side = 64) -> list:
+    """
+    ===========================================================================
+    Compare the time of a first computation of a database with the one of
+    reindexing it when a few images changed (see
+    Database._calculate_histograms), on random JPEG images.
+    ===========================================================================
+    Arguments :
+        size : The number of images of the database
+        changed : The numbers of images replaced, touched and deleted before
+                  each reindex
+        side : The width and height of the images, in pixels
+    Returns :
+        A list of tuples (images changed, time, images computed), the first
+        one being the first computation
+    """
+    rng = np.random.default_rng(0)
+    res = []
+    with tempfile.TemporaryDirectory() as directory:
+        images = os.path.join(directory, "images")
+        os.mkdir(images)
+        paths = [os.path.join(images, f"image{i}.jpg") for i in range(size)]
+        for path in paths:
+            cv2.imwrite(path, rng.integers(0, 256, (side, side, 3),
+                                           dtype = np.uint8))
+        database = Database(images, directory)
+        stats = {}
+        database._calculate_histograms(workers = 1, stats = stats)
+        res.append((size, stats["seconds"], stats["images"]))
+        for number in changed:
+            for i in range(number):
+                path = paths.pop()
+                #one image in three replaced, touched or deleted
+                if i % 3 == 0:
+                    cv2.imwrite(path, rng.integers(0, 256, (side, side, 3),
+                                                   dtype = np.uint8))
+                elif i % 3 == 1:
+                    os.utime(path, ns = (0, 0))
+                else:
+                    os.remove(path)
+            stats = {}
+            database._calculate_histograms(workers = 1, stats = stats)
+            res.append((number, stats["seconds"], stats["images"]))
+    return res
+
+def benchmark_open(size = 100000, repeat = 3) -> list:
+    """
+    ===========================================================================
+    Compare the time to tell if a database was computed by looking for
+    histograms.csv among its files, as Database.is_computed did, with the one
+    of reading the header of its FeatureStore.
+    ===========================================================================
+    Arguments :
+        size : The number of files of the database, empty
+        repeat : The number of runs, only the best one is kept
+    Returns :
+        A tuple (time of the walk, time of the header)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(size):
+            open(os.path.join(directory, f"image{i}.jpg"), "w").close()
+        FeatureStore.FeatureStore.create(directory)
+        database = Database(directory, directory)
+        walk = _best_time(lambda: any(
+            file.endswith("histograms.csv") for file in database.explore()),
+                          repeat)
+        return walk, _best_time(database.is_computed, repeat)
+
+def _append_rows(directory, entries) -> None:
+    """
+    Append entries to the store of a database one at a time, as the
+    Database.add of an ingest process does
+    """
+    store = FeatureStore.FeatureStore.open(directory)
+    for entry in entries:
+        store.append([entry], replace = True)
+
+def benchmark_appends(size = 400, writers = (1, 4)) -> list:
+    """
+    ===========================================================================
+    Compare the throughput of the writes to a FeatureStore : rows appended
+    one at a time by several processes sharing the store, each write being
+    locked and synced, and rows appended in a single write.
+    ===========================================================================
+    Arguments :
+        size : The number of rows written
+        writers : The numbers of processes appending one row at a time
+    Returns :
+        A list of tuples (processes, time, rows per second), 0 processes
+        being a single write of every row
+    """
+    rng = np.random.default_rng(0)
+    grey = CompactHistogram(np.zeros((1, 256)), CompactHistogram.GREY)
+    axes = np.zeros(FeatureStore.AXES)
+    entries = [(f"image{i}.jpg",
+                CompactHistogram(rng.integers(0, 64, (3, 256)),
+                                 CompactHistogram.COLOR), grey, axes)
+               for i in range(size)]
+    res = []
+    for number in (0,) + tuple(writers):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FeatureStore.FeatureStore.create(directory)
+            start = time.perf_counter()
+            if number == 0:
+                store.append(entries)
+            else:
+                processes = [multiprocessing.Process(
+                    target = _append_rows,
+                    args = (directory, entries[i::number]))
+                             for i in range(number)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+            seconds = time.perf_counter() - start
+            assert len(FeatureStore.FeatureStore(directory)) == size
+            res.append((number, seconds, size / seconds))
+    return res
+
+if __name__ == "__main__":
+    print("Histograms (255 bins, RGB)")
+    print(f"{'size':>12} {'matplotlib':>12} {'engine':>12} {'speedup':>9}")
+    for size, reference, engine, speedup in benchmark_histograms():
+        print(f"{str(size)+'x'+str(size):>12} {reference*1000:>10.2f}ms "+
+              f"{engine*1000:>10.2f}ms {speedup:>8.1f}x")
+
+    print("\nIntersection (255 bins, RGB), time per comparison")
+    print(f"{'models':>12} {'loop':>12} {'kernel':>12} {'speedup':>9}")
+    for number, reference, engine, speedup in benchmark_intersection():
+        print(f"{number:>12} {reference*1e6:>10.2f}us "+
+              f"{engine*1e6:>10.2f}us {speedup:>8.1f}x")
+
+    print("\nRetrieval (RGB), time per query")
+    print(f"{'images':>12} {'bins':>6} {'time':>12}")
+    for size, number, latency in benchmark_retrieval():
+        print(f"{size:>12} {number:>6} {latency*1000:>10.2f}ms")
+
+    print("\nIncremental intersection (20000 images, 32 bins)")
+    print(f"{'depth':>12} {'exhaustive':>12} {'incremental':>12} "+
+          f"{'bins':>5} {'postings':>9} {'scored':>7}")
+    for depth, exhaustive, incremental, stats in benchmark_incremental():
+        print(f"{depth:>12} {exhaustive*1000:>10.2f}ms "+
+              f"{incremental*1000:>10.2f}ms {stats['bins']:>5} "+
+              f"{stats['postings']:>9} {stats['scored']:>7}")
+
+    print("\nMetric tree (color axes vectors), time per query")
+    print(f"{'vectors':>12} {'exhaustive':>12} {'tree':>12} {'distances':>10}")
+    for size, exhaustive, tree, distances in benchmark_metric_tree():
+        print(f"{size:>12} {exhaustive*1000:>10.2f}ms {tree*1000:>10.2f}ms "+
+              f"{distances:>10}")
+
+    print("\nApproximate retrieval (20000 images, 32 bins), recall at 15")
+    print(f"{'nprobe':>12} {'recall':>8} {'approximate':>12} "+
+          f"{'exhaustive':>12}")
+    for nprobe, recall, latency, exhaustive in benchmark_approximate():
+        print(f"{nprobe:>12} {recall:>8.3f} {latency*1000:>10.2f}ms "+
+              f"{exhaustive*1000:>10.2f}ms")
+
+    print("\nCascade (20000 images, RGB), time per query")
+    print(f"{'bins':>12} {'depth':>6} {'exhaustive':>12} {'cascade':>12} "+
+          f"{'full':>7}")
+    for number, depth, exhaustive, cascade, full in benchmark_cascade():
+        print(f"{number:>12} {depth:>6} {exhaustive*1000:>10.2f}ms "+
+              f"{cascade*1000:>10.2f}ms {full:>7}")
+
+    print("\nClustered retrieval (20000 images, 32 bins), recall at 15")
+    print(f"{'clusters':>12} {'recall':>8} {'saved':>7} {'clustered':>12} "+
+          f"{'exhaustive':>12}")
+    for number, recall, saved, latency, exhaustive in benchmark_clustered():
+        print(f"{number:>12} {recall:>8.3f} {saved:>7.1%} "+
+              f"{latency*1000:>10.2f}ms {exhaustive*1000:>10.2f}ms")
+
+    print("\nSharded retrieval (200000 images, 255 bins), time per query")
+    print(f"{'workers':>12} {'time':>12}")
+    for number, latency in benchmark_sharded():
+        print(f"{number if number else 'caller':>12} "+
+              f"{latency*1000:>10.2f}ms")
+
+    print("\nSimilarity self-join (20000 images, 32 bins)")
+    print(f"{'threshold':>12} {'pairs':>8} {'scored':>8} {'join':>10} "+
+          f"{'every pair':>11}")
+    for threshold, pairs, scored, join, every in benchmark_join():
+        print(f"{threshold:>12} {pairs:>8} {scored:>8.2%} {join:>9.2f}s "+
+              f"{every:>10.2f}s")
+
+    print("\nQuantized storage (20000 images, RGB), time per query")
+    print(f"{'bins':>12} {'type':>8} {'size':>7} {'time':>10} "+
+          f"{'max error':>10} {'recall':>7}")
+    for number, dtype, size, latency, error, recall in benchmark_quantized():
+        print(f"{number:>12} {dtype:>8} {size:>7.1%} "+
+              f"{latency*1000:>8.2f}ms {error:>10.4f} {recall:>7.3f}")
+
+    print("\nBack-projection segmentation (RGB, 32 bins)")
+    print(f"{'size':>12} {'numpy':>10} {'tiled':>10} {'numpy peak':>11} "+
+          f"{'tiled peak':>11}")
+    for size, reference, latency, reference_peak, peak in (
+            benchmark_segmentation()):
+        print(f"{str(size)+'x'+str(size):>12} "+
+              (f"{reference:>9.3f}s" if reference is not None
+               else f"{'-':>10}")+f" {latency:>9.3f}s "+
+              (f"{reference_peak/2**20:>9.1f}MB" if reference_peak
+               is not None else f"{'-':>11}")+f" {peak/2**20:>9.1f}MB")
+
+    print("\nIntegral histogram (4096x4096 RGB, 16 bins, cells of 8 pixels)")
+    print(f"{'window':>12} {'build':>9} {'search':>9} {'windows':>8} "+
+          f"{'every':>9} {'histograms':>11} {'score':>7} {'best':>7}")
+    for (window, build, search, scored, every, brute, score,
+         best) in benchmark_integral():
+        print(f"{window:>12} {build:>8.3f}s {search:>8.3f}s {scored:>8} "+
+              f"{every:>8.3f}s {brute:>10.1f}s {score:>7.2f} {best:>7.2f}")
+
+    print("\nFeature matrix loading (20000 images, RGB)")
+    print(f"{'bins':>12} {'pickles':>10} {'store':>10} {'speedup':>9}")
+    for number, pickles, stored in benchmark_store():
+        print(f"{number:>12} {pickles:>9.2f}s {stored:>9.3f}s "+
+              f"{pickles/stored:>8.1f}x")
+
+    print("\nFeature extraction (RGB JPEG), time per image")
+    print(f"{'size':>12} {'grey file':>10} {'memory':>10} {'speedup':>9}")
+    for side, files, memory in benchmark_extraction():
+        print(f"{str(side)+'x'+str(side):>12} {files*1000:>8.1f}ms "+
+              f"{memory*1000:>8.1f}ms {files/memory:>8.1f}x")
+
+    print(f"\nDatabase indexing (200 images of 512x512 RGB, {os.cpu_count()}"+
+          " processors)")
+    print(f"{'workers':>12} {'time':>10} {'images/s':>10}")
+    for number, seconds, rate in benchmark_indexing():
+        print(f"{number:>12} {seconds:>9.2f}s {rate:>10.1f}")
+
+    print("\nReindexing (5000 images of 64x64 RGB)")
+    print(f"{'changed':>12} {'time':>10} {'computed':>9}")
+    for number, seconds, computed in benchmark_reindex():
+        print(f"{number:>12} {seconds:>9.2f}s {computed:>9}")
+
+    print("\nDatabase opening (100000 files)")
+    print(f"{'walk':>12} {'header':>10} {'speedup':>9}")
+    walk, header = benchmark_open()
+    print(f"{walk*1000:>10.1f}ms {header*1e6:>8.1f}us "+
+          f"{walk/header:>8.0f}x")
+
+    print("\nStore writes (400 rows, RGB)")
+    print(f"{'processes':>12} {'time':>10} {'rows/s':>10}")
+    for number, seconds, rate in benchmark_appends():
+        print(f"{number if number else 'one write':>12} {seconds:>9.3f}s "+
+              f"{rate:>10.0f}")
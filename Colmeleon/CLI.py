@@ -17,10 +17,19 @@ if __name__ == "__main__":
 from argparse import ArgumentParser, ArgumentTypeError
 import pathlib
 import os
+import sys
+import glob
+import json
 from sys import argv
 from Image import Saver,Image
 from Database import Database
 import Algorithm
+import Retrieval
+import Kernels
+import Quantization
+import SimilarityJoin
+import Segmentation
+import numpy as np
 from Histogram import Histogram
 
 DEFAULT_CLI_OPTIONS = ["image=None\n",
@@ -54,6 +63,29 @@ class CLI():
         algorithm instead of the normal intersection
         --grey, if present will use grey scale histograms instead color
         histograms
+        --kernel, -k, the name of the distance used to compare the image with
+        the database instead of the default one (see Kernels.py)
+        --workers, the number of processes scoring the database in parallel,
+        each one a shard of it (see ShardPool.py), and computing its
+        histograms
+        --shardsize, the number of images of a shard, by default the database
+        is split evenly among the workers
+        --dtype, the type the histograms of the database are stored in while
+        they are compared, smaller and less accurate than the counts (see
+        Quantization.py)
+        --batch, the files, globs or - (a newline-separated list of files on
+        stdin) of many images to process against the same database, one JSON
+        line being printed per image. The images are not added to the database
+        --duplicates, the smallest intersection, in percent, of the pairs of
+        images of the database printed as near duplicates (see
+        SimilarityJoin.py), one line per pair
+        --pairformat, the format of the lines of the pairs, csv or jsonl
+        --segment, the image whose colors are searched in the image instead of
+        the retrieval, or the path of an image of the database whose stored
+        histogram is used : the likelihood of each pixel of the image to
+        belong to it is written to the --mask file (see Segmentation.py)
+        --mask, the file the mask of --segment is written to, an 8 bits image
+        or a .npy file of the likelihoods, by default <image>_mask.png
         --saveparams, if present will save the given parameters as default in
         the CLI.init file
         --reset, --clear, -c, if present the program will not consider any
@@ -117,6 +149,25 @@ class CLI():
         if self._args.saveparams:
             if not self._saveparams():
                 return
+        if self._args.segment != None:
+            if self._args.image == None:
+                raise ArgumentTypeError("--image, --file or -f argument not "+
+                        "used but no default value found.\nPlease state "+
+                        "the file containing the image to segment.")
+            print(self.compute_segmentation())
+            return
+        if self._args.duplicates != None:
+            if self._args.database == None:
+                raise ArgumentTypeError("--database or -db argument not "+
+                        "used but no default value found.")
+            self.compute_duplicates()
+            return
+        if self._args.batch != None:
+            if self._args.database == None:
+                raise ArgumentTypeError("--database or -db argument not "+
+                        "used but no default value found.")
+            self.compute_batch()
+            return
         if self._args.image == None:
             raise ArgumentTypeError("--image, --file or -f argument not "+
                     "used but no default value found.\nPlease state "+
@@ -213,6 +264,68 @@ class CLI():
                             default = self.parse_default_grey(),
                             help = "if present will use grey scale"+
                             " histograms instead color histograms")
+        parser.add_argument("--kernel",
+                            "-k",
+                            metavar = "<kernel>",
+                            choices = sorted(Kernels.KERNELS),
+                            default = None,
+                            help = "the name of the distance used to "+
+                            "compare the image with the database instead of "+
+                            "the default one, one of "+
+                            ", ".join(sorted(Kernels.KERNELS)))
+        parser.add_argument("--workers",
+                            type = int,
+                            metavar = "<processes>",
+                            default = None,
+                            help = "the number of processes scoring the "+
+                            "database in parallel, each one a shard of it, "+
+                            "and computing its histograms")
+        parser.add_argument("--shardsize",
+                            type = int,
+                            metavar = "<images>",
+                            default = None,
+                            help = "the number of images of a shard, by "+
+                            "default the database is split evenly among the "+
+                            "workers")
+        parser.add_argument("--dtype",
+                            metavar = "<type>",
+                            choices = sorted(Quantization.DTYPES),
+                            default = None,
+                            help = "the type the histograms of the database "+
+                            "are stored in while they are compared, one of "+
+                            ", ".join(sorted(Quantization.DTYPES)))
+        parser.add_argument("--batch",
+                            nargs = "+",
+                            metavar = "<file, glob or ->",
+                            default = None,
+                            help = "the files of many images to "+
+                            "process, as paths, globs or - to read a newline"+
+                            "-separated list on stdin, one JSON line being "+
+                            "printed per image")
+        parser.add_argument("--duplicates",
+                            type = float,
+                            metavar = "<threshold>",
+                            default = None,
+                            help = "the smallest intersection, in percent, "+
+                            "of the pairs of images of the database printed "+
+                            "as near duplicates, one line per pair")
+        parser.add_argument("--pairformat",
+                            choices = ["csv", "jsonl"],
+                            default = "jsonl",
+                            help = "the format of the lines of the pairs")
+        parser.add_argument("--segment",
+                            metavar = "<model>",
+                            default = None,
+                            help = "the image whose colors are searched in "+
+                            "the image, or the path of an image of the "+
+                            "database, the likelihood of each pixel being "+
+                            "written to the --mask file")
+        parser.add_argument("--mask",
+                            metavar = "<file>",
+                            default = None,
+                            help = "the file the mask of --segment is "+
+                            "written to, an 8 bits image or a .npy file, by "+
+                            "default <image>_mask.png")
         parser.add_argument("--saveparams", 
                             "-sp", 
                             action = "store_true", 
@@ -430,12 +543,13 @@ class CLI():
         return(True)
     
     
-    def compute(self, tmpPath = None) -> None:
-        if tmpPath == None:
-            tmpPath = self.tmpPath
-        if self._args.grey:
-            self._args.image = Image.to_grey(self._args.image, tmpPath)
-        self.histogram = Histogram(self._args.image, bins = self._args.bins)
+    def _check_database(self) -> None:
+        """
+        =======================================================================
+        This method offers to calculate the histograms of the database when
+        it has not been computed yet.
+        =======================================================================
+        """
         if not self._args.database.is_computed():
             if __name__ == "__main__":
                 ans = ""
@@ -445,17 +559,161 @@ class CLI():
                           "histogram now?(y/n)")
                     ans = input().strip().lower()
                     if(ans == "y" or ans == "yes"):
-                        self._args.database._calculate_histograms()
+                        self._index_database()
+
+    def _index_database(self) -> None:
+        """
+        =======================================================================
+        Calculates the histograms of the database with --workers processes,
+        printing the progress and the images which could not be read.
+        =======================================================================
+        """
+        def progress(done, total, rate):
+            print(f"\r{done}/{total} images ({rate:.1f} images/s)",
+                  end = "", flush = True)
+        failed = self._args.database._calculate_histograms(
+            workers = self._args.workers, progress = progress)
+        print()
+        for error in failed:
+            print(f"Warning : left out of the database, {error}")
+
+    def compute(self, tmpPath = None) -> None:
+        if tmpPath == None:
+            tmpPath = self.tmpPath
+        if self._args.grey:
+            self._args.image = Image.to_grey(self._args.image, tmpPath)
+        self.histogram = Histogram(self._args.image, bins = self._args.bins)
+        self._check_database()
         self.results = Algorithm.retrieval(self._args.database, 
                                     self.histogram, 
                                     depth = self._args.depth,
                                     incremental = self._args.incremental,
-                                    compareFunction= Algorithm.euclidean_dist)
+                                    compareFunction= Algorithm.euclidean_dist,
+                                    kernel = self._args.kernel,
+                                    workers = self._args.workers,
+                                    shard_size = self._args.shardsize,
+                                    dtype = self._args.dtype)
         if not self._args.noadd:
             self._args.database.add(self._args.image.getpath(), self.histogram)
         if self._args.saver != None:
             for img in self.results:
                 self._args.saver.save(img[1])
+
+    def batch_files(self, stdin = None):
+        """
+        =======================================================================
+        Generator of the files given to the --batch argument, in order : the
+        paths as they are, the globs expanded and sorted, and the lines of
+        stdin for -.
+        =======================================================================
+        """
+        if stdin == None:
+            stdin = sys.stdin
+        for item in self._args.batch:
+            if item == "-":
+                for line in stdin:
+                    if line.strip() != "":
+                        yield line.strip()
+            elif glob.has_magic(item):
+                yield from sorted(glob.glob(item, recursive = True))
+            else:
+                yield item
+
+    def compute_batch(self, tmpPath = None, out = None) -> None:
+        """
+        =======================================================================
+        This method runs the retrieval of every image of the --batch argument
+        against the database, scoring the images by batches (see
+        Retrieval.search_batch), and writes one JSON line per image to out as
+        soon as its batch is scored :
+            {"query": path, "results": [{"path": ..., "distance": ...}, ...]}
+        or {"query": path, "error": message} if the image could not be read.
+        =======================================================================
+        """
+        if tmpPath == None:
+            tmpPath = self.tmpPath
+        if out == None:
+            out = sys.stdout
+        self._check_database()
+        mode = (Retrieval.INCREMENTAL if self._args.incremental
+                else Retrieval.INTERSECTION)
+        #the paths of the images read but not yet scored
+        pending = []
+
+        def histograms():
+            for path in self.batch_files():
+                try:
+                    image = Image(path)
+                    if self._args.grey:
+                        image = Image.to_grey(image, tmpPath)
+                    histo = Histogram(image, bins = self._args.bins)
+                except (AssertionError, OSError) as e:
+                    out.write(json.dumps({"query": path, "error": str(e) or
+                                          "the image could not be read"})+
+                              "\n")
+                    continue
+                pending.append(path)
+                yield histo
+
+        for results in Retrieval.search_batch(self._args.database,
+                                              histograms(),
+                                              depth = self._args.depth,
+                                              mode = mode,
+                                              kernel = self._args.kernel,
+                                              workers = self._args.workers,
+                                              shard_size =
+                                              self._args.shardsize,
+                                              dtype = self._args.dtype):
+            out.write(json.dumps({"query": pending.pop(0), "results":
+                                  [{"path": path, "distance": distance}
+                                   for distance, path in results]})+"\n")
+            out.flush()
+
+    def compute_duplicates(self, out = None) -> int:
+        """
+        =======================================================================
+        This method writes to out every pair of images of the database whose
+        intersection is at least the --duplicates argument, as soon as it is
+        found (see SimilarityJoin.duplicates), in the --pairformat format.
+        =======================================================================
+        Returns:
+            The number of pairs written
+        """
+        if out == None:
+            out = sys.stdout
+        self._check_database()
+        return SimilarityJoin.write_pairs(
+            SimilarityJoin.duplicates(self._args.database,
+                                      self._args.duplicates,
+                                      bins = self._args.bins,
+                                      workers = self._args.workers),
+            out, self._args.pairformat)
+
+    def compute_segmentation(self) -> str:
+        """
+        =======================================================================
+        This method writes the mask of the image for the --segment model (see
+        Segmentation.backproject) to the --mask file : the likelihoods
+        between 0 and 1 in a .npy file, else scaled between 0 and 255 in an
+        8 bits image.
+        =======================================================================
+        Returns:
+            The path to the mask
+        """
+        path = self._args.mask
+        if path == None:
+            path = (pathlib.Path(self._args.image.getpath()).stem+
+                    "_mask.png")
+        model = Segmentation.model_histogram(self._args.segment,
+                                             self._args.bins,
+                                             self._args.database)
+        mask = Segmentation.backproject(self._args.image, model,
+                                        self._args.bins,
+                                        dtype = (np.float32
+                                                 if path.endswith(".npy")
+                                                 else np.uint8))
+        Segmentation.write_mask(mask, path)
+        return path
                 
 if __name__ == "__main__":
     tmpPath = "temp"
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pickle
+import numpy as np
+from FeatureStore import dump
+from ApproximateIndex import vector, BINS, nearest_centroids
+
+#Number of vectors drawn for each step of the mini-batch k-means
+BATCH = 1024
+
+#Number of steps of the mini-batch k-means
+_STEPS = 100
+
+#Most vectors the first centroids are chosen among
+_SEEDING = 16384
+
+def _seeds(vectors, clusters, rng) -> np.ndarray:
+    """
+    Choose clusters first centroids among the vectors by k-means++ : each
+    new one is drawn with a probability proportional to its squared
+    distance to the closest centroid already chosen
+    """
+    if len(vectors) > _SEEDING:
+        vectors = vectors[rng.choice(len(vectors), _SEEDING, replace = False)]
+    chosen = [rng.integers(len(vectors))]
+    dist = np.sum((vectors - vectors[chosen[0]]) ** 2, axis = 1)
+    for _ in range(1, clusters):
+        total = dist.sum()
+        new = (rng.choice(len(vectors), p = dist / total) if total > 0
+               else rng.integers(len(vectors)))
+        chosen.append(new)
+        dist = np.minimum(dist, np.sum((vectors - vectors[new]) ** 2,
+                                       axis = 1))
+    return vectors[chosen].copy()
+
+def minibatch_kmeans(vectors, clusters, rng, batch = BATCH,
+                     steps = _STEPS) -> np.ndarray:
+    """
+    ===========================================================================
+    Return clusters centroids of the vectors found by the mini-batch k-means
+    of Sculley, seeded by k-means++ : at each step, a batch of vectors drawn
+    at random is assigned to the closest centroids, and each centroid moves
+    to the mean of every vector it was ever assigned, the first ones
+    included. A centroid never assigned anything is moved to a random
+    vector.
+    ===========================================================================
+    Arguments :
+        vectors : The (N, dimensions) vectors
+        clusters : The number of centroids
+        rng : The numpy Generator drawing the vectors
+        batch : The number of vectors of a step
+        steps : The number of steps
+    Returns :
+        The (clusters, dimensions) centroids, fewer if there are fewer
+        vectors
+    """
+    clusters = max(1, min(clusters, len(vectors)))
+    centroids = _seeds(vectors, clusters, rng)
+    #number of vectors each centroid is the mean of
+    weights = np.ones(clusters)
+    for _ in range(steps):
+        sample = vectors[rng.integers(0, len(vectors),
+                                      min(batch, len(vectors)))]
+        labels = nearest_centroids(sample, centroids)
+        sizes = np.bincount(labels, minlength = clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        weights += sizes
+        centroids += ((sums - sizes[:, np.newaxis] * centroids) /
+                      weights[:, np.newaxis])
+    empty = weights == 1
+    if empty.any() and steps > 0:
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    return centroids
+
+class ClusterIndex:
+    """
+    ===========================================================================
+    Class grouping the images of a database into clusters of similar colors,
+    found by a mini-batch k-means of their vectors (see
+    ApproximateIndex.vector). The label of an image is the index of its
+    cluster.
+    A query is only scored against the images of its closest clusters by
+    the CLUSTERED mode of Retrieval.
+    The index is stored next to the histograms of the database, and the
+    images added since go to their closest cluster when it is loaded (see
+    Database.cluster_index).
+    ===========================================================================
+    Attributes :
+        paths : the paths to the images, in the order of the rows
+        centroids : the (clusters, 3 * BINS) centroids of the clusters
+        labels : the (N,) cluster of each row
+        version : the version of the database the index was built for (see
+                  Database.version)
+    """
+    def __init__(self, paths, vectors, clusters = None, version = None,
+                 seed = 0):
+        """
+        =======================================================================
+        Cluster the vectors.
+        =======================================================================
+        Arguments :
+            paths : the paths to the images of the vectors
+            vectors : the (N, 3 * BINS) vectors
+            clusters : the number of clusters, by default the square root
+                       of N
+            version : see the attributes
+            seed : the seed of the k-means
+        """
+        vectors = np.asarray(vectors, dtype = np.float64).reshape(-1, 3*BINS)
+        if clusters is None:
+            clusters = int(np.sqrt(len(vectors)))
+        self.paths = []
+        self.version = version
+        self.centroids = minibatch_kmeans(vectors if len(vectors) else
+                                          np.zeros((1, 3 * BINS)), clusters,
+                                          np.random.default_rng(seed))
+        self.labels = np.zeros(0, dtype = np.intp)
+        self.add(paths, vectors)
+
+    def from_histograms(entries, clusters = None, version = None):
+        """
+        =======================================================================
+        Build the index of couples (path to image, histogram), such as the
+        ones the Database generators yield.
+        =======================================================================
+        """
+        paths, vectors = [], []
+        for path, histo in entries:
+            paths.append(path)
+            vectors.append(vector(histo))
+        return ClusterIndex(paths, np.stack(vectors) if vectors
+                            else np.zeros((0, 3 * BINS)), clusters, version)
+
+    def load(path):
+        """
+        =======================================================================
+        Load an index saved by ClusterIndex.save
+        =======================================================================
+        """
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def save(self, path) -> None:
+        dump(self, path)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def label(self, vector) -> int:
+        """
+        =======================================================================
+        Return the cluster of a vector : the one of the closest centroid.
+        =======================================================================
+        """
+        return int(self.nearest(vector, 1)[0])
+
+    def add(self, paths, vectors) -> None:
+        """
+        =======================================================================
+        Add vectors at the end of the index, in their closest cluster.
+        =======================================================================
+        Arguments :
+            paths : the paths to the images of the vectors
+            vectors : their (N, 3 * BINS) vectors
+        """
+        vectors = np.asarray(vectors, dtype = np.float64).reshape(-1, 3*BINS)
+        self.paths.extend(paths)
+        self.labels = np.concatenate([self.labels, nearest_centroids(
+            vectors, self.centroids)])
+
+    def nearest(self, vector, count) -> np.ndarray:
+        """
+        =======================================================================
+        Return the count clusters whose centroids are the closest to a
+        vector, the closest first.
+        =======================================================================
+        """
+        vector = np.asarray(vector, dtype = np.float64).reshape(1, -1)
+        dist = (np.sum(self.centroids ** 2, axis = 1) -
+                2 * (vector @ self.centroids.T)[0])
+        return np.argsort(dist, kind = "stable")[:max(1, count)]
+
+    def clusters(self) -> dict:
+        """
+        =======================================================================
+        Return the paths of the images of each cluster, by label.
+        =======================================================================
+        """
+        res = {label: [] for label in range(len(self.centroids))}
+        for path, label in zip(self.paths, self.labels):
+            res[int(label)].append(path)
+        return res
+
+    def rows(self, clusters, stats = None) -> np.ndarray:
+        """
+        =======================================================================
+        Return the increasing indexes of the rows of some clusters.
+        =======================================================================
+        Arguments :
+            clusters : the labels of the clusters
+            stats : A dictionary in which "clusters" (clusters visited),
+                    "scored" (rows returned), "saved" (rows left out) and
+                    "rows" (rows of the index) are added, if given
+        """
+        rows = np.flatnonzero(np.isin(self.labels, clusters))
+        if stats is not None:
+            for name, value in [("clusters", len(clusters)),
+                                ("scored", len(rows)),
+                                ("saved", len(self) - len(rows)),
+                                ("rows", len(self))]:
+                stats[name] = stats.get(name, 0) + value
+        return rows
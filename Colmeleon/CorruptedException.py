@@ -1,5 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 class CorruptedFileException(Exception):
-    pass
+    """
+    ===========================================================================
+    Exception raised for a file which can not be read as an image.
+    ===========================================================================
+    Attributes :
+        message : what went wrong
+        path : the path to the file, if known
+    """
+    def __init__(self, message, path = None):
+        #both are arguments, so that the exception is sent back by workers
+        super().__init__(message, path)
+        self.message = message
+        self.path = path
 
+    def __str__(self):
+        return self.message
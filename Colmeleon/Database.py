@@ -3,7 +3,12 @@
 import os
 import csv
 import pickle
-from Histogram import ColorHistogram, GreyHistogram, Histogram
+from Histogram import Histogram, HistogramPyramid, image_features
+from FeatureStore import FeatureStore, fingerprint, UNKNOWN
+from FeatureStore import BINS as BINS_STORED
+from MetricTree import MetricTree
+from ApproximateIndex import ApproximateIndex, vector, BINS
+from ClusterIndex import ClusterIndex
 from Image import Image, check_extension
 import shutil
 import numpy as np
@@ -11,6 +16,16 @@ import matplotlib.pyplot as plt
 import matplotlib
 from Histogram import Histogram
 from shutil import SameFileError
+from CorruptedException import CorruptedFileException
+from concurrent.futures import ProcessPoolExecutor
+import time
+import cv2
+
+#Number of images whose features are computed before being stored at once
+_BATCH = 256
+
+#Largest number of images sent to a worker at once
+_CHUNK_SIZE = 64
 
 class Database:
     """
@@ -46,49 +61,245 @@ class Database:
     def get_dir(self):
         return(self._database)
 
+    def version(self):
+        """
+        =======================================================================
+        Returns :
+            what changes whenever the FeatureStore changes, its identifier
+            and generation (the modification time and size of histograms.csv
+            for a database computed by an older version), or None if the
+            database was never computed. Only the header of the store is
+            read, whatever the size of the database.
+        =======================================================================
+        """
+        header = FeatureStore.header(self._database)
+        if header is not None:
+            return (header.get("id"), header["generation"])
+        try:
+            stat = os.stat(self._database+os.sep+"histograms.csv")
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def metric_tree(self):
+        """
+        =======================================================================
+        Load the MetricTree of the color axes vectors of the database,
+        brought up to date with it (see _index).
+        =======================================================================
+        Returns :
+            the MetricTree, its rows in the order of histograms.csv
+        """
+        def build(store, rows, version):
+            return MetricTree.from_vectors(((store.paths[row], store.axes[row])
+                                            for row in rows), version)
+
+        def add(tree, store, rows):
+            for row in rows:
+                tree.insert(store.paths[row], store.axes[row])
+
+        return self._index("color_axes_tree", MetricTree,
+                           lambda tree : True, build, add)
+
+    def ann_index(self, lists = None, subquantizers = 16):
+        """
+        =======================================================================
+        Load the ApproximateIndex of the color histograms of the database,
+        brought up to date with it (see _index). It is built again (which
+        trains it) if it was built with other parameters.
+        =======================================================================
+        Arguments :
+            lists, subquantizers : see ApproximateIndex, lists being left as
+            it is when None
+        Returns :
+            the ApproximateIndex, its rows in the order of histograms.csv
+        """
+        def usable(index):
+            return (index.subquantizers == subquantizers and
+                    (lists is None or len(index.centroids) == lists))
+
+        def build(store, rows, version):
+            return ApproximateIndex.from_histograms(
+                ((store.paths[row], store.histogram(row, BINS))
+                 for row in rows), lists, subquantizers, version)
+
+        return self._index("ann_index", ApproximateIndex, usable, build,
+                           Database._add_vectors)
+
+    def cluster_index(self, clusters = None):
+        """
+        =======================================================================
+        Load the ClusterIndex of the color histograms of the database,
+        brought up to date with it (see _index). It is built again (which
+        runs the k-means) if it was built with another number of clusters.
+        =======================================================================
+        Arguments :
+            clusters : see ClusterIndex, left as it is when None
+        Returns :
+            the ClusterIndex, its rows in the order of histograms.csv
+        """
+        def build(store, rows, version):
+            return ClusterIndex.from_histograms(
+                ((store.paths[row], store.histogram(row, BINS))
+                 for row in rows), clusters, version)
+
+        return self._index("clusters_index", ClusterIndex,
+                           lambda index : (clusters is None or
+                                           len(index.centroids) == clusters),
+                           build, Database._add_vectors)
+
+    def _add_vectors(index, store, rows):
+        """
+        Add rows of the store to an ApproximateIndex or a ClusterIndex
+        """
+        index.add([store.paths[row] for row in rows],
+                  [vector(store.histogram(row, BINS)) for row in rows])
+
+    def _appended(store, index):
+        """
+        Return the live rows of a store appended since the version an index
+        of its live rows was saved for, or None if rows became tombstones
+        since or if there are more new rows than rows of the index : the
+        index is then built again
+        """
+        if (index.version is None or store.identifier is None or
+            index.version[0] != store.identifier or
+            index.version[1] > store.generation):
+            return None
+        deleted = np.asarray(store.deleted)
+        if ((deleted > index.version[1]) &
+            (deleted <= store.generation)).any():
+            return None
+        #the rows of the index are the first live rows, none being deleted
+        live = store.live()
+        if not len(index) <= len(live) <= 2 * len(index):
+            return None
+        return live[len(index):]
+
+    def _index(self, name, kind, usable, build, add):
+        """
+        =======================================================================
+        Load an index stored next to the histograms of the database, and
+        bring it up to date with the FeatureStore : the rows appended since
+        the version it was saved for are added to it, and it is built again
+        if it is missing, not usable, if rows became tombstones since or if
+        it would more than double.
+        The writers of the store do not maintain the indexes, and the index
+        is read from a snapshot of the store (see FeatureStore) : nobody
+        waits for it. It is saved again only when it changed.
+        =======================================================================
+        Arguments :
+            name : the name of the file of the index in the database
+            kind : the class of the index, loading it
+            usable : function telling if the index loaded was built with
+            the parameters wanted
+            build : function build(store, rows, version) building the index
+            of rows of the store
+            add : function add(index, store, rows) adding rows of the store
+            to the index
+        Returns :
+            the index, its rows in the order of histograms.csv
+        """
+        path = self._database+os.sep+name
+        store = self.store()
+        if store is None:
+            #the database was never computed
+            return build(None, [], None)
+        version = store.version()
+        index = kind.load(path) if os.path.exists(path) else None
+        if index is not None and usable(index):
+            if index.version == version:
+                return index
+            rows = Database._appended(store, index)
+            if rows is not None:
+                add(index, store, rows)
+                index.version = version
+                index.save(path)
+                return index
+        index = build(store, store.live(), version)
+        index.save(path)
+        return index
+
     def _calculate_histogram(self,file):
         matplotlib.use("Agg")
         """
         =======================================================================
-        Instantiates then saves the color histogram and the bins histogram of
-        one given file in the database
+        Computes the features of one given file of the database : its color
+        histogram, the histogram of its greyscale version and its bins
+        histogram (see Histogram.image_features).
+        Note : the histograms are the ones of the 256 values of each
+        channel, from which any number of bins can be served without
+        recomputation. The greyscale version is computed in memory, no
+        file is written.
         =======================================================================
         Argument :
             file : the path to the file, either absolute or relative to the
             current directory.
         Returns :
-            a tuple containing : the path to the histogram, the path to the bins
-            histogram. Both paths are either absolute or relative to the current
-            directory, depends on the path to the database being absolute or not.
-        """
-        #calculate the histogram
-        histo = Histogram(Image(file))
-        #save the histogram in the database
-        repertory = self._database+os.sep+"histograms"
-        name = file[file.rindex(os.sep):len(file)-4]+'_hist'
-        with open(repertory+os.sep+name,'wb+') as histo_file:
-            pickle.dump(histo,histo_file,protocol=pickle.HIGHEST_PROTOCOL)
-
-        #calculate the bins histogram
-        histo_bin = Histogram.color_axes(histo)
-        #save the bins histogram in the database
-        repertory_bin = self._database+os.sep+"bins_histograms"
-        with open(repertory_bin+name+'bin','wb+') as histo_bin_file:
-            pickle.dump(histo_bin,histo_bin_file,
-                        protocol=pickle.HIGHEST_PROTOCOL)
-        
-        #calculate the grey histogram
-        histo_grey = Histogram(Image.to_grey(Image(file),self.tmpdir),
-                               grey = True)
-        repertory_grey = self._database+os.sep+"grey_histograms"
-        with open(repertory_grey+name+'grey','wb+') as histo_grey_file:
-            pickle.dump(histo_grey,histo_grey_file,
-                        protocol=pickle.HIGHEST_PROTOCOL)
-        
-        #returns paths to all histogram files
-        return (repertory+name,
-                repertory_bin+name+'bin',
-                repertory_grey+name+'grey')
+            a tuple containing : the histogram, the grey histogram and the
+            bins histogram, the way FeatureStore.append takes them.
+        """
+        #the file is decoded once, every feature is computed from its pixels
+        return image_features(Image(file).getarray())
+
+    def store(self):
+        """
+        =======================================================================
+        Open the FeatureStore holding the features of the database. A
+        database computed by an older version, with histograms.csv and one
+        pickle per histogram, is moved to a new store the first time.
+        The store is opened again only when the database changed.
+        =======================================================================
+        Returns :
+            the FeatureStore, or None if the database was never computed
+        """
+        version = self.version()
+        if version is None:
+            return None
+        if getattr(self, "_store", None) is None or self._store[0] != version:
+            if FeatureStore.header(self._database) is None:
+                self._migrate()
+            self._store = (self.version(), FeatureStore(self._database))
+        return self._store[1]
+
+    def _migrate(self):
+        """
+        =======================================================================
+        Move the histograms listed in histograms.csv to a new store, in the
+        same order. The features of an image whose pickles can not be read
+        (or which were not pyramids) are computed again. The old files are
+        left as they are.
+        =======================================================================
+        """
+        store = FeatureStore.create(self._database)
+        entries = []
+        with open(self._database+os.sep+'histograms.csv','r') as csv_file :
+            for item in csv.reader(csv_file):
+                #to skip blank lines
+                if len(item) == 0:
+                    continue
+                #the grey histograms of the rows written by add
+                grey = (item[3] if len(item) > 3 else
+                        self._database+os.sep+"grey_histograms"+os.sep+
+                        os.path.basename(item[1])+"grey")
+                try:
+                    features = []
+                    for path in (item[1], grey, item[2]):
+                        with open(path, 'rb') as pickled:
+                            features.append(pickle.load(pickled))
+                    if not all(isinstance(f, HistogramPyramid)
+                               for f in features[:2]):
+                        raise ValueError(item[0])
+                    features = (features[0].level(BINS_STORED),
+                                features[1].level(BINS_STORED), features[2])
+                except (OSError, ValueError, pickle.UnpicklingError,
+                        EOFError):
+                    features = self._calculate_histogram(item[0])
+                entries.append((item[0],) + tuple(features))
+                if len(entries) == _BATCH:
+                    store.append(entries)
+                    entries = []
+        store.append(entries)
 
     def explore(self, depth=5)->list:
         """
@@ -124,172 +335,234 @@ class Database:
         return res
 
     def is_computed(self):
-        files = self.explore()
-        for file in files :
-            if file.endswith("histograms.csv") :
-                return True
-        return False
+        """
+        =======================================================================
+        Tells if the histograms of the database were computed, from the
+        header of its FeatureStore (or histograms.csv for a database
+        computed by an older version) alone, in constant time.
+        =======================================================================
+        """
+        return self.version() is not None
 
-    def _calculate_histograms(self, max_depth=1):
+    def _features(self, file):
+        """
+        =======================================================================
+        Computes the features of a file (see _calculate_histogram) and its
+        fingerprint, or tells why they could not be.
+        =======================================================================
+        Returns :
+            the tuple _calculate_histogram returns followed by the
+            fingerprint of the file (see FeatureStore.fingerprint), or the
+            CorruptedFileException of the file if it could not be read as an
+            image.
+        """
+        try:
+            #the file is fingerprinted first, a change while it is read is
+            #then seen by the next reindex
+            known = fingerprint(file)
+            return self._calculate_histogram(file) + (known,)
+        except (AssertionError, OSError, ValueError, SyntaxError,
+                cv2.error) as e:
+            return CorruptedFileException(f"{file} : {str(e) or type(e)}",
+                                          file)
+
+    def _calculate_histograms(self, max_depth=1, workers = None,
+                              chunk_size = None, progress = None,
+                              stats = None):
         """
         =======================================================================
         Computes all images in the database to create their histograms,
-        then stocks them in a new directory named "histograms".
-        Note : all Histogram objects are pickled before being saved.
+        then stocks them in the FeatureStore of the database, in a new
+        directory named "features".
+        A database already computed is brought up to date : the images are
+        compared with the manifest of the store (see FeatureStore), and only
+        the new ones and the ones whose content changed are computed. The
+        rows of the images deleted or changed become tombstones. The content
+        of a file is only hashed when its size or modification time changed.
+        The images are sent by chunks to a pool of worker processes, and
+        their features are appended in order by this process alone, by
+        batches of _BATCH.
+        Note : the indexes of the database are brought up to date the next
+        time they are loaded (see _index). The images which could not be
+        read are left out of the database.
         =======================================================================
         Arguments :
             max_depth : the depth of the database. Confere to explore for
             details.
+            workers : the number of processes, by default the number of
+            processors. With 1, everything is computed in this process.
+            chunk_size : the number of images sent to a worker at once, by
+            default about a quarter of the images of a worker, at most
+            _CHUNK_SIZE.
+            progress : function called as progress(done, total, rate) after
+            each chunk, rate being the number of images computed per
+            second.
+            stats : dictionary in which "images" (images computed), "failed"
+            (images which could not be read), "deleted" (rows which became
+            tombstones), "hashed" (files whose content was hashed to be
+            compared) and "seconds" (time spent) are added, if given.
+        Returns :
+            the list of the CorruptedFileException of the images which could
+            not be read.
         """
         matplotlib.use("Agg")
-        #TODO optimize
         depth = max_depth
-        files = self.explore()
-
-        #all histograms are saved in a dedicated repertory
-        repertory = self._database+os.sep+"histograms"
-        if not os.path.exists(repertory):
-            os.makedirs(repertory)
-
-        #all bins_histograms are saved in a dedicated repertory
-        repertory_bin = self._database+os.sep+"bins_histograms"
-        if not os.path.exists(repertory_bin):
-            os.makedirs(repertory_bin)
-        
-        repertory_grey = self._database+os.sep+"grey_histograms"
-        if not os.path.exists(repertory_grey):
-            os.makedirs(repertory_grey)
-
-        #if histograms.csv exists in the database
-        if self.is_computed() :
-            #first find all images that already had their histogram created
-            with open(self._database+os.sep+'histograms.csv','r') as csv_file :
-                filereader = csv.reader(csv_file)
-                images_ready = []
-                for item in list(filereader) :
-                    if len(item)>0 :
-                        images_ready.append(item[0])
-            #then add the new images
-            with open(self._database+os.sep+"histograms.csv",'a') as csv_file :
-                filewriter = csv.writer(csv_file)
-                #we'll consider the images that do not already have their
-                #histogram
-                for file in files :
-                    if check_extension(file) and (os.path.abspath(file) not
-                                                  in images_ready) :
-                        histo = self._calculate_histogram(file)
-                        #save the path to image and the histogram in csv
-                        filewriter.writerow([os.path.abspath(file),
-                                             histo[0],
-                                             histo[1],
-                                             histo[2]])
-
-        #if there is no histograms.csv file already existing in the directory
+        start = time.perf_counter()
+        store = self.store()
+        if store is None:
+            store = FeatureStore.open(self._database)
+        #the row of each image, the older rows of an image being stale
+        rows = {}
+        stale = []
+        for row in store.live():
+            path = store.paths[row]
+            if path in rows:
+                stale.append(rows[path])
+            rows[path] = int(row)
+        sizes, mtimes = np.array(store.sizes), np.array(store.mtimes)
+        #the images to compute, and the rows whose files did not change
+        #though their modification time did
+        files = []
+        touched = []
+        fingerprints = []
+        hashed = 0
+        for file in self.explore():
+            if not check_extension(file):
+                continue
+            file = os.path.abspath(file)
+            row = rows.pop(file, None)
+            if row is None:
+                files.append(file)
+                continue
+            stat = os.stat(file)
+            if (stat.st_size, stat.st_mtime_ns) == (sizes[row], mtimes[row]):
+                continue
+            known = fingerprint(file, stat)
+            hashed += 1
+            #the rows stored without a manifest are taken as they are
+            if mtimes[row] == UNKNOWN or known[2] == store.hashes[row]:
+                touched.append(row)
+                fingerprints.append(known)
+            else:
+                files.append(file)
+                stale.append(row)
+        #the images left were deleted
+        stale.extend(rows.values())
+        workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+        if chunk_size is None:
+            chunk_size = min(_CHUNK_SIZE, -(-len(files) // (4 * workers)))
+        chunks = [files[i:i+max(1, chunk_size)]
+                  for i in range(0, len(files), max(1, chunk_size))]
+        #the images added, the features not yet stored with the
+        #fingerprints of their files, and the images which could not be read
+        added = []
+        entries = []
+        manifest = []
+        failed = []
+        done = 0
+        if workers == 1:
+            results = ([self._features(file) for file in chunk]
+                       for chunk in chunks)
         else:
-            with open(self._database+os.sep+'histograms.csv','w') as csv_file :
-                filewriter = csv.writer(csv_file,delimiter=',')
-                for file in files:
-                    #we only consider valid image formats
-                    if check_extension(file) :
-                        histo = self._calculate_histogram(file)
-                        #save the path to image and the histogram in csv
-                        filewriter.writerow([os.path.abspath(file),
-                                             histo[0],
-                                             histo[1],
-                                             histo[2]])
+            executor = ProcessPoolExecutor(workers)
+            results = executor.map(_features_task,
+                                   [self._database] * len(chunks),
+                                   [self.tmpdir] * len(chunks), chunks)
+        try:
+            for chunk, features in zip(chunks, results):
+                for file, feature in zip(chunk, features):
+                    if isinstance(feature, CorruptedFileException):
+                        failed.append(feature)
+                        continue
+                    histo, grey, histo_bin, known = feature
+                    entries.append((file, histo, grey, histo_bin))
+                    manifest.append(known)
+                    added.append(file)
+                if len(entries) >= _BATCH:
+                    replaced, _ = store.append(entries, manifest,
+                                               replace = True)
+                    stale.extend(replaced)
+                    entries = []
+                    manifest = []
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, len(files),
+                             done / max(time.perf_counter() - start, 1e-9))
+        finally:
+            if workers > 1:
+                executor.shutdown(cancel_futures = True)
+        replaced, _ = store.append(entries, manifest, replace = True)
+        #the rows replaced by the writes of this reindex, as well as the
+        #other rows of the images changed, deleted or which could not be
+        #computed again, become tombstones last
+        stale = sorted(set(stale).union(replaced))
+        store.record(touched, fingerprints)
+        store.delete(stale)
+        if stats is not None:
+            for name, value in [("images", len(added)),
+                                ("failed", len(failed)),
+                                ("deleted", len(stale)),
+                                ("hashed", hashed),
+                                ("seconds", time.perf_counter() - start)]:
+                stats[name] = stats.get(name, 0) + value
+        return failed
 
-    def histograms(self):
+    def histograms(self, bins = 255):
         """
         =======================================================================
-        Generator that unpickle all the histograms and generates one at a time
-        with the path to its image.
+        Generator of the histograms of the images, one at a time with the
+        path to its image, as views on the FeatureStore of the database.
         =======================================================================
+        Arguments :
+            bins : the number of bins of the histograms, served by the stored
+            counts without recomputation.
         Yields :
             a tuple (pointer to image,histogram) for each image in the base.
         """
-        matplotlib.use("Agg")
-        files = os.listdir(self._database)
-        #res = []
-        #find the histograms.csv file
-        if 'histograms.csv' in files :
-            with open(self._database+os.sep+'histograms.csv','r') as csv_file :
-                #read the file to find the histograms
-                filereader = csv.reader(csv_file)
-                for item in filereader :
-                    #to skip blank lines
-                    if len(item)>0:
-                        #unpickle the histogram
-                        histo = None
-                        with open(os.path.abspath(item[1]),
-                                  'rb') as pickled_histo :
-                            histo = pickle.load(pickled_histo)
-                        #res.append((item[0],histo))
-                        yield (item[0],histo)
-        else :
+        store = self.store()
+        if store is None:
             print("Caution: the histograms were never calculated"+
                   " for this database.")
-
-        #return res
+            return
+        for row in store.live():
+            yield (store.paths[row], store.histogram(row, bins))
 
     def bin_histograms(self):
         """
         =======================================================================
-        Generator that unpickle all the bins_histograms and generates one at a
-        time with the path to its image.
+        Generator of the bins_histograms of the images, one at a time with
+        the path to its image, as views on the FeatureStore of the database.
         =======================================================================
         Yields :
             a tuple (pointer to image,histogram) for each image in the base.
         """
-        matplotlib.use("Agg")
-        files = os.listdir(self._database)
-        #find the histograms.csv file
-        if 'histograms.csv' in files :
-            with open(self._database+os.sep+'histograms.csv','r') as csv_file :
-                #read the file to find the histograms
-                filereader = csv.reader(csv_file)
-                for item in filereader :
-                    #to skip blank lines
-                    if len(item)>0:
-                        #unpickle the histogram
-                        histo = None
-                        with open(os.path.abspath(item[2])
-                                  ,'rb') as pickled_histo :
-                            histo = pickle.load(pickled_histo)
-                        #res.append((item[0],histo))
-                        yield (item[0],histo)
-        else :
+        store = self.store()
+        if store is None:
             print("Caution: the histograms were never calculated"+
                   " for this database.")
-            
-    def grey_histograms(self):
+            return
+        for row in store.live():
+            yield (store.paths[row], store.axes[row])
+
+    def grey_histograms(self, bins = 255):
         """
         =======================================================================
-        Generator that unpickle all the grey_histograms and generates one at a
-        time with the path to its image.
+        Generator of the grey_histograms of the images, one at a time with
+        the path to its image, as views on the FeatureStore of the database.
         =======================================================================
+        Arguments :
+            bins : the number of bins of the histograms, served by the stored
+            counts without recomputation.
         Yields :
             a tuple (pointer to image,histogram) for each image in the base.
         """
-        matplotlib.use("Agg")
-        files = os.listdir(self._database)
-        #find the histograms.csv file
-        if 'histograms.csv' in files :
-            with open(self._database+os.sep+'histograms.csv','r') as csv_file :
-                #read the file to find the histograms
-                filereader = csv.reader(csv_file)
-                for item in filereader :
-                    #to skip blank lines
-                    if len(item)>0:
-                        #unpickle the histogram
-                        histo = None
-                        with open(os.path.abspath(item[3])
-                                  ,'rb') as pickled_histo :
-                            histo = pickle.load(pickled_histo)
-                        #res.append((item[0],histo))
-                        yield (item[0],histo)
-        else :
+        store = self.store()
+        if store is None:
             print("Caution: the histograms were never calculated"+
                   " for this database.")
+            return
+        for row in store.live():
+            yield (store.paths[row], store.grey(row, bins))
 
     def images(self)->list:
         """
@@ -321,82 +594,47 @@ class Database:
         """
         try:
             matplotlib.use("Agg")
-            files = os.listdir(self._database)
-            #creates needed directories if need be
-            repertory = self._database+os.sep+"histograms"
-            if not os.path.exists(repertory):
-                os.makedirs(repertory)
-            repertory_bin = self._database+os.sep+"bins_histograms"
-            if not os.path.exists(repertory_bin):
-                os.makedirs(repertory_bin)
-            repertory_grey = self._database+os.sep+"grey_histograms"
-            if not os.path.exists(repertory_grey):
-                os.makedirs(repertory_grey)
             #add image
             name_img = os.path.basename(str(img))
             new_path = os.path.abspath(self._database+os.sep+name_img)
-            shutil.copy(str(img),new_path)
-            #save the histogram in the database
-            if isinstance(histo, ColorHistogram):
-                #take care of the color histogram
-                name_histo = new_path[new_path.rindex(os.sep):
-                                      new_path.rindex(".")-1]+'_hist'
-                with open(repertory+os.sep+name_histo,'wb+') as histo_file :
-                    pickle.dump(histo,histo_file,
-                                protocol=pickle.HIGHEST_PROTOCOL)
-                #take care of the grey histogram : needs be created
-                name_histo_g = name_histo+"grey"
-                histo_g = Histogram(Image.to_grey(Image(img),self.tmpdir))
-                with open(repertory_grey+os.sep+name_histo_g,'wb+')\
-                    as histog_file:
-                    pickle.dump(histo_g,histog_file,
-                                protocol=pickle.HIGHEST_PROTOCOL)                
-            else:
-                #take care of grey histogram that was given
-                name_histo_g = new_path[new_path.rindex(os.sep):
-                                      new_path.rindex(".")-1]+'_histgrey'
-                with open(repertory_grey+os.sep+name_histo_g,'wb+')\
-                    as histog_file :
-                    pickle.dump(histo,histog_file,
-                                protocol=pickle.HIGHEST_PROTOCOL)
-                #creates the color histogram
-                name_histo = name_histo_g[:-4]
-                histo_c = Histogram(Image(img))
-                with open(repertory+os.sep+name_histo,'wb+') as histo_file :
-                    pickle.dump(histo_c,histo_file,
-                                protocol=pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(new_path) and os.path.samefile(str(img),
+                                                             new_path):
+                raise SameFileError(f"{img} is already in the database")
+            #the image is copied under a name the database does not list,
+            #then renamed, so that no reader sees it half written
+            temporary = (self._database+os.sep+"."+name_img+"."+
+                         str(os.getpid())+".tmp")
+            shutil.copy(str(img),temporary)
+            os.replace(temporary,new_path)
+            #the color histogram is the one given, the other features are
+            #computed from the pixels it was computed from
+            if not isinstance(histo, Histogram):
+                histo = Histogram(Image(img))
+            pyramid = histo.pyramid()
+            _, histo_g, axes = image_features(histo.imageArray)
             #create bin_histo if need be
-            if bin_histo == None :
-                bin_histo = Histogram.color_axes(histo)
-            #save the bin_histo
-            with open(repertory_bin+os.sep+name_histo+"bin",'wb+') \
-                as b_histo_file :
-                pickle.dump(bin_histo,b_histo_file,
-                            protocol=pickle.HIGHEST_PROTOCOL)
-            #
-            #check if database isn't empty
-            if 'histograms.csv' in files :
-                with open(self._database+os.sep+'histograms.csv','a') \
-                    as csv_file:
-                    #we add the couple of adresses to the csv file
-                    filewriter = csv.writer(csv_file)
-                    filewriter.writerow([new_path,
-                                         repertory+os.sep+name_histo,
-                                         repertory_bin+os.sep+name_histo+"bin"])
+            if bin_histo is None :
+                bin_histo = axes
+            store = self.store()
             #this image is the first in the base
-            else :
+            if store is None:
                 print("This is the first image added to that base")
-                with open(self._database+os.sep+'histograms.csv','w+') \
-                    as csv_file :
-                    #we add the couple of adresses to the csv file
-                    filewriter = csv.writer(csv_file)
-                    filewriter.writerow([new_path,
-                                         repertory+os.sep+name_histo,
-                                         repertory_bin+os.sep+name_histo+"bin",
-                                         repertory_grey+os.sep+name_histo_g])
+                store = FeatureStore.open(self._database)
+            #an image added again replaces the one of the same name, in the
+            #same write
+            store.append([(new_path, pyramid.level(BINS_STORED), histo_g,
+                           bin_histo)], [fingerprint(new_path)],
+                         replace = True)
         except SameFileError as e:
             return()
 
     def __str__(self):
         return(self._database)
 
+def _features_task(directory, tmpdir, files) -> list:
+    """
+    Compute the features of files in a worker process (see
+    Database._features)
+    """
+    database = Database(directory, tmpdir)
+    return [database._features(file) for file in files]
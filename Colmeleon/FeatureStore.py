@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Columnar store of the features of the images of a database, in the features
+directory of the database :
+    header.json : the format, the features stored (the number of bins and
+                  the type of the counts, the color spaces and the length of
+                  the color axes vectors), the number of rows, and the
+                  identifier of the store with its generation, counting
+                  the writes since it was created : everything needed to
+                  tell if the database is usable or changed, read in
+                  constant time (see header)
+    paths.jsonl : the path to the image of each row, one JSON string per line
+    is_color.npy : whether each image is in color
+    colors.npy : the (rows, 3, BINS) counts of each image, one per value of
+                 each channel, only the first channel being used for the
+                 grey images
+    greys.npy : the (rows, BINS) counts of the greyscale version of each image
+    axes.npy : the (rows, AXES) color axes vectors (see
+               Histogram.color_axes) of each image
+    deleted.npy : the generation from which each row is a tombstone, the one
+                  of an image deleted or changed since, 0 for the other rows
+    sizes.npy, mtimes.npy, hashes.npy : the manifest of the files, the size,
+                                        modification time (in ns) and content
+                                        hash (see fingerprint) of the image
+                                        of each row when it was computed,
+                                        UNKNOWN for the rows stored without
+                                        them
+    lock : the file locked by the writers, which write one at a time
+    tombstones.json : the rows being marked as tombstones by a write not
+                      published yet
+The arrays are memory-mapped when the store is opened, without reading them,
+and every histogram of the database is a view on them, any number of bins
+being summed from the BINS values.
+The arrays hold more rows than the header counts, so that rows are appended
+in place, the arrays being copied to twice their size when they are full.
+The store is an append-only log : every write takes the lock, reads the
+header again, writes the new rows, paths and tombstones past the ones of the
+header and publishes them all at once by replacing the header with the next
+generation, the files being synced once per write. A store opened before or
+during a write is a snapshot : it only sees the rows of its header, and only
+the tombstones of its generation or older. A write stopped before its header
+is left out, its paths are overwritten and its tombstones cleared by the
+next one.
+Rows are never removed : the rows of the images deleted or changed are
+marked in deleted.npy in place, and the rows of their new versions appended.
+The manifest of the files which did not change is replaced in place, without
+a new generation.
+===============================================================================
+"""
+import os
+import json
+import hashlib
+import uuid
+import contextlib
+import pickle
+import numpy as np
+from Histogram import CompactHistogram, bin_lut
+try:
+    import fcntl
+except ImportError:
+    #Windows
+    fcntl = None
+    import msvcrt
+
+#Number of counts of each channel of a row, one per 8 bits value
+BINS = 256
+
+#Length of a color axes vector
+AXES = 40
+
+#Number of rows of the arrays of a new store
+_CAPACITY = 16
+
+#Number of rows rebinned at once
+_CHUNK = 4096
+
+#Modification time of the rows whose file was not fingerprinted
+UNKNOWN = -1
+
+#Number of bytes of a file hashed at once
+_BLOCK = 1 << 20
+
+def fingerprint(path, stat = None) -> tuple:
+    """
+    ===========================================================================
+    Return what the manifest of a store records of a file : its size, its
+    modification time and a 64 bits BLAKE2 hash of its content.
+    ===========================================================================
+    Arguments :
+        path : The path to the file
+        stat : The os.stat_result of the file, if already known
+    Returns :
+        The tuple (size, modification time in ns, hash)
+    """
+    if stat is None:
+        stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size = 8)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_BLOCK), b""):
+            digest.update(block)
+    return (stat.st_size, stat.st_mtime_ns,
+            int.from_bytes(digest.digest(), "little"))
+
+#The locks held by this process, with the number of times each one is taken
+_HELD = {}
+
+@contextlib.contextmanager
+def _locked(path):
+    """
+    Hold the lock of the store at path, waiting for the writers of the
+    other processes. A process holding it can take it again.
+    """
+    key = os.path.abspath(path)
+    if key in _HELD:
+        _HELD[key][1] += 1
+    else:
+        os.makedirs(key, exist_ok = True)
+        file = open(os.path.join(key, "lock"), "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        except OSError:
+            file.close()
+            raise
+        _HELD[key] = [file, 1]
+    try:
+        yield
+    finally:
+        _HELD[key][1] -= 1
+        if _HELD[key][1] == 0:
+            #closing the file releases the lock
+            _HELD.pop(key)[0].close()
+
+def _sync_directory(path) -> None:
+    """
+    Make the files replaced in a directory durable, where the system
+    allows it
+    """
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+def dump(value, path) -> None:
+    """
+    ===========================================================================
+    Pickle a value to a temporary file, then replace the file at path with
+    it, so that the processes loading it never see it half written. The
+    indexes of a database (MetricTree, ApproximateIndex and ClusterIndex)
+    are saved this way.
+    ===========================================================================
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb+") as file:
+        pickle.dump(value, file, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+def rebin(counts, bins) -> np.ndarray:
+    """
+    ===========================================================================
+    Sum counts of BINS values into bins bins, as the histograms of the
+    values with bins bins (see Histogram.bin_lut) would count them.
+    ===========================================================================
+    Arguments :
+        counts : The (..., BINS) counts
+        bins : The number of bins
+    Returns :
+        The (..., bins) counts, counts itself if bins is BINS
+    """
+    if bins == BINS:
+        return counts
+    lut = bin_lut(bins)
+    if bins < BINS:
+        #the values of a bin follow each other, and every bin has some
+        return np.add.reduceat(counts, np.searchsorted(lut, np.arange(bins)),
+                               axis = -1, dtype = counts.dtype)
+    #finer bins than the values, some of them empty
+    res = np.zeros(counts.shape[:-1] + (bins,), dtype = counts.dtype)
+    np.add.at(res, (Ellipsis, lut), counts)
+    return res
+
+class FeatureStore:
+    """
+    ===========================================================================
+    Class giving access to the features directory of a database (see the
+    module).
+    ===========================================================================
+    Attributes :
+        directory : the path to the features directory
+        identifier, generation : the ones of the header when it was read
+        paths : the paths to the images, in the order of the rows
+        is_color, colors, greys, axes, deleted, sizes, mtimes, hashes : the
+            rows of the arrays (see the module), memory-mapped
+    """
+    DIRECTORY = "features"
+    _FORMAT = 3
+    #the histograms stored in colors.npy and greys.npy
+    SPACES = ["RGB", "GREY"]
+    #the shape of a row and the type of each array
+    _ARRAYS = {"is_color": ((), np.bool_),
+               "colors": ((3, BINS), np.uint32),
+               "greys": ((BINS,), np.uint32),
+               "axes": ((AXES,), np.float64),
+               "deleted": ((), np.int64),
+               "sizes": ((), np.int64),
+               "mtimes": ((), np.int64),
+               "hashes": ((), np.uint64)}
+
+    def __init__(self, directory):
+        """
+        =======================================================================
+        Open the store of a database, memory-mapping its arrays.
+        =======================================================================
+        Arguments :
+            directory : the path to the database
+        Raises :
+            FileNotFoundError if the database has no store
+            ValueError if the store was written in another format
+        """
+        self.directory = FeatureStore.path(directory)
+        self._open()
+
+    def _open(self) -> None:
+        """
+        Read the header and the paths, and map the rows of the arrays it
+        counts
+        """
+        self.identifier = None
+        self.paths = []
+        self._size = 0
+        #the rows of each image, when needed (see _rows_of)
+        self._rows = None
+        self._read()
+
+    def _read(self) -> None:
+        """
+        Read the header again with the paths appended since, and map the
+        rows of the arrays it counts
+        """
+        with open(os.path.join(self.directory, "header.json"), "r") as file:
+            header = json.load(file)
+        if not FeatureStore._valid(header):
+            raise ValueError(f"The features of {self.directory} were not "+
+                             "written by this version.")
+        count = header["count"]
+        if (header.get("id") != self.identifier or
+            count < len(self.paths)):
+            #the store was created again
+            self.paths = []
+            self._size = 0
+            self._rows = None
+        with open(os.path.join(self.directory, "paths.jsonl"), "rb") as file:
+            file.seek(self._size)
+            lines = file.read().split(b"\n")[:count - len(self.paths)]
+        paths = json.loads(b"[" + b",".join(lines) + b"]")
+        if self._rows is not None:
+            for row, path in enumerate(paths, len(self.paths)):
+                self._rows.setdefault(path, []).append(row)
+        #a new list, the snapshots given before keep theirs
+        self.paths = self.paths + paths
+        #the paths of an append which did not reach the header are left out
+        self._size += sum(len(line) + 1 for line in lines)
+        self.identifier = header.get("id")
+        self.generation = header.get("generation", 0)
+        for name in self._ARRAYS:
+            array = np.load(os.path.join(self.directory, name + ".npy"),
+                            mmap_mode = "r")
+            setattr(self, name, array[:count])
+
+    def path(directory) -> str:
+        """
+        =======================================================================
+        Return the path to the features directory of a database.
+        =======================================================================
+        """
+        return os.path.join(directory, FeatureStore.DIRECTORY)
+
+    def _valid(header) -> bool:
+        """
+        Tell if a header describes a store this version reads
+        """
+        return (isinstance(header, dict) and
+                header.get("format") == FeatureStore._FORMAT and
+                header.get("bins") == BINS and
+                header.get("dtype", np.dtype(np.uint32).str) ==
+                np.dtype(np.uint32).str and
+                isinstance(header.get("count"), int))
+
+    def header(directory):
+        """
+        =======================================================================
+        Read the header of the store of a database, and only it.
+        =======================================================================
+        Arguments :
+            directory : the path to the database
+        Returns :
+            The dictionary of the header (see the module), or None if the
+            database has no store or one this version can not read
+        """
+        try:
+            with open(os.path.join(FeatureStore.path(directory),
+                                   "header.json"), "r") as file:
+                header = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return header if FeatureStore._valid(header) else None
+
+    def exists(directory) -> bool:
+        """
+        =======================================================================
+        Tell if a database has a store.
+        =======================================================================
+        """
+        return os.path.exists(os.path.join(FeatureStore.path(directory),
+                                           "header.json"))
+
+    def create(directory):
+        """
+        =======================================================================
+        Create the empty store of a database, replacing any existing one.
+        =======================================================================
+        Arguments :
+            directory : the path to the database
+        Returns :
+            The FeatureStore
+        """
+        path = FeatureStore.path(directory)
+        with _locked(path):
+            for name, (shape, dtype) in FeatureStore._ARRAYS.items():
+                array = np.lib.format.open_memmap(
+                    os.path.join(path, name + ".npy"), mode = "w+",
+                    dtype = dtype, shape = (_CAPACITY,) + shape)
+                array.flush()
+                del array
+            with open(os.path.join(path, "paths.jsonl"), "w"):
+                pass
+            if os.path.exists(os.path.join(path, "tombstones.json")):
+                os.remove(os.path.join(path, "tombstones.json"))
+            FeatureStore._write_header(path, 0, uuid.uuid4().hex, 0)
+            return FeatureStore(directory)
+
+    def open(directory):
+        """
+        =======================================================================
+        Open the store of a database, creating it if the database has none
+        this version can read. The writers of several processes creating it
+        at once share the same store.
+        =======================================================================
+        Arguments :
+            directory : the path to the database
+        Returns :
+            The FeatureStore
+        """
+        with _locked(FeatureStore.path(directory)):
+            if FeatureStore.header(directory) is None:
+                return FeatureStore.create(directory)
+            return FeatureStore(directory)
+
+    def _write_header(path, count, identifier, generation) -> None:
+        """
+        Replace the header of the store at path
+        """
+        header = {"format": FeatureStore._FORMAT, "id": identifier,
+                  "generation": generation, "bins": BINS,
+                  "dtype": np.dtype(np.uint32).str,
+                  "spaces": FeatureStore.SPACES, "axes": AXES,
+                  "count": count}
+        temporary = os.path.join(path, "header.json.tmp")
+        with open(temporary, "w") as file:
+            json.dump(header, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, os.path.join(path, "header.json"))
+        _sync_directory(path)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def version(self) -> tuple:
+        """
+        =======================================================================
+        Return the version of the database this store is the snapshot of
+        (see Database.version).
+        =======================================================================
+        """
+        return (self.identifier, self.generation)
+
+    def _begin(self) -> None:
+        """
+        Start a write, the lock being held : read the last generation, and
+        clear the tombstones of a write which did not publish it
+        """
+        self._read()
+        path = os.path.join(self.directory, "tombstones.json")
+        try:
+            with open(path, "r") as file:
+                pending = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        if pending["generation"] > self.generation:
+            deleted = np.load(os.path.join(self.directory, "deleted.npy"),
+                              mmap_mode = "r+")
+            rows = np.asarray(pending["rows"], dtype = np.intp)
+            rows = rows[deleted[rows] == pending["generation"]]
+            deleted[rows] = 0
+            deleted.flush()
+            del deleted
+        os.remove(path)
+
+    def _tombstone(self, rows, generation) -> None:
+        """
+        Mark rows as tombstones from generation, the rows being written down
+        first so that the next write clears them if this one stops
+        """
+        path = os.path.join(self.directory, "tombstones.json")
+        with open(path, "w") as file:
+            json.dump({"generation": generation,
+                       "rows": [int(row) for row in rows]}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        deleted = np.load(os.path.join(self.directory, "deleted.npy"),
+                          mmap_mode = "r+")
+        deleted[rows] = generation
+        deleted.flush()
+        del deleted
+
+    def _publish(self, count, generation) -> None:
+        """
+        End a write by replacing the header, then read it
+        """
+        FeatureStore._write_header(self.directory, count,
+                                   self.identifier or uuid.uuid4().hex,
+                                   generation)
+        path = os.path.join(self.directory, "tombstones.json")
+        if os.path.exists(path):
+            os.remove(path)
+        self._read()
+
+    def _rows_of(self, paths) -> list:
+        """
+        Return the rows of some images which are not tombstones
+        """
+        if self._rows is None:
+            self._rows = {}
+            for row, path in enumerate(self.paths):
+                self._rows.setdefault(path, []).append(row)
+        deleted = self.deleted
+        return [row for path in set(paths) for row in self._rows.get(path, [])
+                if deleted[row] == 0]
+
+    def _grow(self, capacity) -> None:
+        """
+        Copy each array to a new file of capacity rows, replacing it
+        """
+        for name, (shape, dtype) in self._ARRAYS.items():
+            path = os.path.join(self.directory, name + ".npy")
+            old = np.load(path, mmap_mode = "r")
+            if len(old) >= capacity:
+                continue
+            new = np.lib.format.open_memmap(path + ".tmp", mode = "w+",
+                                            dtype = dtype,
+                                            shape = (capacity,) + shape)
+            for start in range(0, len(self), _CHUNK):
+                end = min(len(self), start + _CHUNK)
+                new[start:end] = old[start:end]
+            new.flush()
+            del new, old
+            os.replace(path + ".tmp", path)
+
+    def append(self, entries, fingerprints = None,
+               replace = False) -> tuple:
+        """
+        =======================================================================
+        Add rows at the end of the store, in a single write (see the module).
+        =======================================================================
+        Arguments :
+            entries : list of tuples (path to image, histogram, grey
+                      histogram, color axes vector), the histograms being
+                      CompactHistograms of BINS bins, the grey one of a
+                      single channel
+            fingerprints : the fingerprint of the file of each entry, if
+                           known (see fingerprint)
+            replace : if True, the rows of the same images already stored
+                      become tombstones in the same write
+        Returns :
+            The rows which became tombstones, and the version this write
+            published (see version), None if there was nothing to write
+        """
+        if not entries:
+            return np.empty(0, dtype = np.intp), None
+        with _locked(self.directory):
+            self._begin()
+            count = len(self)
+            end = count + len(entries)
+            generation = self.generation + 1
+            capacity = len(np.load(os.path.join(self.directory,
+                                                "colors.npy"),
+                                   mmap_mode = "r"))
+            if end > capacity:
+                self._grow(max(end, 2 * capacity))
+            arrays = {name: np.load(os.path.join(self.directory,
+                                                 name + ".npy"),
+                                    mmap_mode = "r+")
+                      for name in self._ARRAYS}
+            for row, (path, histo, grey, axes) in enumerate(entries, count):
+                arrays["is_color"][row] = histo.is_color()
+                arrays["colors"][row] = 0
+                arrays["colors"][row, :len(histo.counts)] = histo.counts
+                arrays["greys"][row] = grey.counts[0]
+                arrays["axes"][row] = axes
+                arrays["deleted"][row] = 0
+            manifest = (fingerprints if fingerprints is not None
+                        else [(0, UNKNOWN, 0)] * len(entries))
+            for name, values in zip(["sizes", "mtimes", "hashes"],
+                                    zip(*manifest)):
+                arrays[name][count:end] = np.array(values,
+                                                   dtype = arrays[name].dtype)
+            for array in arrays.values():
+                array.flush()
+            del arrays
+            replaced = np.asarray(self._rows_of([path for path, _, _, _ in
+                                                 entries])
+                                  if replace else [], dtype = np.intp)
+            if len(replaced):
+                self._tombstone(replaced, generation)
+            with open(os.path.join(self.directory, "paths.jsonl"),
+                      "rb+") as file:
+                file.truncate(self._size)
+                file.seek(self._size)
+                file.writelines((json.dumps(path) + "\n").encode("ascii")
+                                for path, _, _, _ in entries)
+                file.flush()
+                os.fsync(file.fileno())
+            self._publish(end, generation)
+            return replaced, self.version()
+
+    def delete(self, rows):
+        """
+        =======================================================================
+        Mark rows as tombstones, the ones of images deleted or changed, in a
+        single write.
+        =======================================================================
+        Returns :
+            The version this write published (see version), None if there
+            was nothing to write, the rows being tombstones already
+        """
+        rows = np.asarray(rows, dtype = np.intp)
+        if not len(rows):
+            return None
+        with _locked(self.directory):
+            self._begin()
+            rows = rows[self.deleted[rows] == 0]
+            if not len(rows):
+                return None
+            self._tombstone(rows, self.generation + 1)
+            self._publish(len(self), self.generation + 1)
+            return self.version()
+
+    def record(self, rows, fingerprints) -> None:
+        """
+        =======================================================================
+        Replace the manifest of rows whose images did not change, in place.
+        The manifest is not part of the snapshots : the stores already opened
+        see the new one, and no generation is published, so that the version
+        of the database, and the indexes saved for it, stay as they are.
+        =======================================================================
+        Arguments :
+            rows : The rows
+            fingerprints : The new fingerprint of the file of each row
+        """
+        rows = np.asarray(rows, dtype = np.intp)
+        if not len(rows):
+            return
+        with _locked(self.directory):
+            for name, values in zip(["sizes", "mtimes", "hashes"],
+                                    zip(*fingerprints)):
+                array = np.load(os.path.join(self.directory, name + ".npy"),
+                                mmap_mode = "r+")
+                array[rows] = np.array(values, dtype = array.dtype)
+                array.flush()
+                del array
+
+    def live_mask(self) -> np.ndarray:
+        """
+        =======================================================================
+        Tell which rows are not tombstones in the generation of this store.
+        =======================================================================
+        """
+        deleted = np.asarray(self.deleted)
+        return (deleted == 0) | (deleted > self.generation)
+
+    def live(self) -> np.ndarray:
+        """
+        =======================================================================
+        Return the rows which are not tombstones in the generation of this
+        store, in order.
+        =======================================================================
+        """
+        return np.flatnonzero(self.live_mask())
+
+    def histogram(self, row, bins = BINS) -> CompactHistogram:
+        """
+        =======================================================================
+        Return the histogram of a row with bins bins, a view on the store
+        for BINS bins.
+        =======================================================================
+        """
+        if self.is_color[row]:
+            return CompactHistogram(rebin(self.colors[row], bins),
+                                    CompactHistogram.COLOR)
+        return CompactHistogram(rebin(self.colors[row, :1], bins),
+                                CompactHistogram.GREY)
+
+    def grey(self, row, bins = BINS) -> CompactHistogram:
+        """
+        =======================================================================
+        Return the histogram of the greyscale version of the image of a row
+        with bins bins, a view on the store for BINS bins.
+        =======================================================================
+        """
+        return CompactHistogram(rebin(self.greys[row:row+1], bins),
+                                CompactHistogram.GREY)
+
+    def levels(self, name, bins, start = 0, end = None) -> np.ndarray:
+        """
+        =======================================================================
+        Return the counts of rows of an array with bins bins, by chunks.
+        =======================================================================
+        Arguments :
+            name : "colors" or "greys"
+            bins : The number of bins
+            start, end : The rows, by default all of them
+        Returns :
+            The (rows, 3, bins) or (rows, bins) np.uint32 counts
+        """
+        array = getattr(self, name)[start:end]
+        res = np.empty(array.shape[:-1] + (bins,), dtype = np.uint32)
+        for first in range(0, len(array), _CHUNK):
+            res[first:first+_CHUNK] = rebin(array[first:first+_CHUNK], bins)
+        return res
@@ -1,11 +1,218 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from functools import lru_cache
+import struct
 import cv2
 
+#All histograms cover the same value range as the former matplotlib ones
+HISTOGRAM_RANGE = (0, 255)
+#Largest number of pixels whose counts are exact in the float32 of OpenCV
+_EXACT_CHUNK = 1 << 24
+
+@lru_cache(maxsize=None)
+def bin_lut(bins) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the table giving, for each 8 bits value, the index of the bin it
+    falls into. The edges are the ones numpy.histogram (and so plt.hist) uses
+    on HISTOGRAM_RANGE : the bins are half open, except the last one which
+    contains its right edge.
+    ===========================================================================
+    Argument :
+        bins : The number of bins of the histogram
+    Return :
+        A read-only array of 256 bin indexes
+    """
+    assert int(bins) == bins and bins > 0, {"bin_lut : the number of bins "+
+                                            "must be a positive integer, it"+
+                                            f" can not be {bins}"}.pop()
+    edges = np.linspace(HISTOGRAM_RANGE[0], HISTOGRAM_RANGE[1], bins + 1)
+    lut = np.searchsorted(edges, np.arange(256), side = "right") - 1
+    #the right edge of the range belongs to the last bin
+    lut[lut == bins] = bins - 1
+    lut.setflags(write = False)
+    return lut
+
+@lru_cache(maxsize=None)
+def _bin_matrix(bins) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the (256, bins) matrix summing the counts of every 8 bits value
+    into the counts of their bin.
+    ===========================================================================
+    """
+    matrix = np.zeros((256, bins), dtype = np.int64)
+    matrix[np.arange(256), bin_lut(bins)] = 1
+    matrix.setflags(write = False)
+    return matrix
+
+@lru_cache(maxsize=None)
+def _rebin_matrix(from_bins, to_bins):
+    """
+    ===========================================================================
+    Return the (from_bins, to_bins) matrix summing the counts of a histogram
+    into the bins of a coarser one, or None if some bin of the first one
+    overlaps several bins of the second (the rebinning would not be exact).
+    As the pixels are 8 bits values, a bin is only made of the values it
+    contains.
+    ===========================================================================
+    """
+    source = bin_lut(from_bins)
+    target = bin_lut(to_bins)
+    matrix = np.zeros((from_bins, to_bins), dtype = np.int64)
+    matrix[source, target] = 1
+    #each bin must go in a single coarser bin
+    if (matrix.sum(axis = 1) > 1).any():
+        return None
+    matrix.setflags(write = False)
+    return matrix
+
+def value_counts(pixels) -> np.ndarray:
+    """
+    ===========================================================================
+    Count the occurrences of every 8 bits value in each channel of the given
+    pixels. The counting is done by cv2.calcHist on the pixel buffer itself,
+    one chunk of at most _EXACT_CHUNK pixels at a time so that its float32
+    counts stay exact.
+    ===========================================================================
+    Argument :
+        pixels : A (number of pixels, channels) array of np.uint8
+    Return :
+        A (channels, 256) array of np.int64 counts
+    """
+    assert pixels.dtype == np.uint8 and pixels.ndim == 2
+    channels = pixels.shape[1]
+    res = np.zeros((channels, 256), dtype = np.int64)
+    #calcHist reads the buffer as a one pixel wide image of several channels
+    buffer = np.ascontiguousarray(pixels).reshape(-1, 1, channels)
+    for start in range(0, len(buffer), _EXACT_CHUNK):
+        chunk = buffer[start:start + _EXACT_CHUNK]
+        for i in range(channels):
+            res[i] += cv2.calcHist([chunk], [i], None, [256],
+                                   [0, 256]).ravel().astype(np.int64)
+    return res
+
+def channel_counts(pixels, bins) -> np.ndarray:
+    """
+    ===========================================================================
+    Compute the histogram of each channel of the given pixels. The counts are
+    the same as the ones plt.hist gives on HISTOGRAM_RANGE, without creating
+    any matplotlib artist.
+    ===========================================================================
+    Arguments :
+        pixels : A (number of pixels, channels) array
+        bins : The number of bins of each histogram
+    Return :
+        A (channels, bins) array of np.int64 counts
+    """
+    if pixels.dtype == np.uint8:
+        return value_counts(pixels) @ _bin_matrix(bins)
+    #other types can not be indexed in the table, numpy does the binning
+    return np.stack([np.histogram(pixels[:, i], bins = bins,
+                                  range = HISTOGRAM_RANGE)[0]
+                     for i in range(pixels.shape[1])]).astype(np.int64)
+
+def is_grey(imgArray) -> bool:
+    """
+    ===========================================================================
+    Tell if an image only holds shades of grey, that is if its red, green and
+    blue channels are equal everywhere (which is what a null saturation
+    means in HSV).
+    ===========================================================================
+    Argument :
+        imgArray : The pixels of the image, with one or three channels
+    Return :
+        True if the image is greyscale, False otherwise
+    """
+    if imgArray.ndim == 2:
+        return True
+    red = imgArray[:,:,0]
+    return (np.array_equal(red, imgArray[:,:,1]) and
+            np.array_equal(red, imgArray[:,:,2]))
+
+def axes_vector(pixels, color, rgBinsNumber = 16, byBinsNumber = 16,
+                wbBinsNumber = 8) -> np.ndarray:
+    """
+    ===========================================================================
+    Compute the color axes vector of the pixels of an image (see
+    Histogram.color_axes).
+    ===========================================================================
+    Arguments :
+        pixels : The pixels of the image, with one or three channels
+        color : True to read the channels as red, green and blue, False to
+                use all the pixels as each of them, as for a GreyHistogram
+        rgBinsNumber, byBinsNumber, wbBinsNumber : The number of bins for
+                                                   each color axe
+    Return :
+        The keys of rg,by and wb values concatenated into a single vector
+        (the key of a value is the fraction of the total number of pixels)
+    """
+    if color:
+        r = pixels[:,:,0]
+        g = pixels[:,:,1]
+        b = pixels[:,:,2]
+    else:
+        r = pixels[:,:]
+        g,b = r,r
+
+    #Calculate the new color axes : rg, by, wb
+    rg = r - g
+    by = 2 * b - r -g
+    wb = r + g + b
+
+    #Create histograms of the new color axes
+    rgBins = channel_counts(rg.reshape(-1, 1), rgBinsNumber)[0]
+    byBins = channel_counts(by.reshape(-1, 1), byBinsNumber)[0]
+    wbBins = channel_counts(wb.reshape(-1, 1), wbBinsNumber)[0]
+
+    #Return a single vector of the normalized bins
+    total_pixel = len(pixels[0]) * len(pixels)
+    return np.concatenate([rgBins,byBins,wbBins])/total_pixel
+
+def grey_pixels(pixels) -> np.ndarray:
+    """
+    ===========================================================================
+    Convert the pixels of an image to greyscale in memory, with the weights
+    of cv2.cvtColor (the ones Image.to_grey uses, without writing nor
+    reading a file).
+    ===========================================================================
+    Argument :
+        pixels : The (height, width) or (height, width, 3) RGB pixels
+    Return :
+        The (height, width) np.uint8 pixels, pixels itself if it has a single
+        channel
+    """
+    if pixels.ndim == 2:
+        return pixels
+    return cv2.cvtColor(np.ascontiguousarray(pixels[:,:,:3]),
+                        cv2.COLOR_RGB2GRAY)
+
+def image_features(pixels) -> tuple:
+    """
+    ===========================================================================
+    Compute every feature the database keeps of an image from its decoded
+    pixels, in memory : the counts of Histogram(image).pyramid(), the ones
+    of its greyscale version (see grey_pixels) and its color axes vector
+    (see Histogram.color_axes), at 256 values per channel.
+    ===========================================================================
+    Argument :
+        pixels : The pixels of the image (see Image.getarray)
+    Return :
+        A tuple containing : the CompactHistogram of the image, the grey
+        CompactHistogram of its greyscale version and its color axes vector
+    """
+    color = not is_grey(pixels)
+    if color:
+        histo = CompactHistogram(value_counts(pixels[:,:,:3].reshape(-1, 3)),
+                                 CompactHistogram.COLOR)
+    else:
+        histo = CompactHistogram(value_counts(pixels.reshape(-1, 1)),
+                                 CompactHistogram.GREY)
+    grey = CompactHistogram(value_counts(grey_pixels(pixels).reshape(-1, 1)),
+                            CompactHistogram.GREY)
+    return histo, grey, axes_vector(pixels, color)
+
 class Histogram:
     """
     ===========================================================================
@@ -14,14 +221,66 @@ class Histogram:
     """
     def __init__(self, img,bins=255, grey = False):
         self.image = img
-        self.imageArray = np.asarray(self.image.getimg())
+        #the file is decoded once, everything else reads this buffer
+        self.imageArray = img.getarray()
         self.bins = bins
-        h,s,v = cv2.split(cv2.cvtColor(cv2.imread(img.getpath()),
-                                        cv2.COLOR_BGR2HSV))
-        if grey or (s==0).all():
+        if grey or is_grey(self.imageArray):
             self.histograms =  GreyHistogram(self.imageArray, self.bins)
         else:
             self.histograms = ColorHistogram(self.imageArray, self.bins)
+        #the features derived from the counts, computed on first use
+        self._pyramid = None
+        self._greys = {}
+
+    def pyramid(self):
+        """
+        =======================================================================
+        Return the HistogramPyramid of the image : its histograms at 256,
+        128, ... 8 bins, from which any number of bins can be served.
+        The pixels are counted again the first time, whatever the bins of
+        this histogram, and the same pyramid is returned afterwards.
+        =======================================================================
+        """
+        if self._pyramid is None:
+            if isinstance(self.histograms, ColorHistogram):
+                counts = value_counts(self.imageArray[:,:,:3].reshape(-1, 3))
+                mode = CompactHistogram.COLOR
+            else:
+                counts = value_counts(self.imageArray.reshape(-1, 1))
+                mode = CompactHistogram.GREY
+            self._pyramid = HistogramPyramid(CompactHistogram(counts, mode))
+        return self._pyramid
+
+    def grey(self, bins = None):
+        """
+        =======================================================================
+        Return the grey histogram derived from this one (see
+        CompactHistogram.grey), which has the counts of a GreyHistogram of
+        the same image without counting its pixels again. It is computed
+        once per number of bins and shared by every comparison afterwards.
+        =======================================================================
+        Argument :
+            bins : The number of bins wanted, by default the ones of this
+                   histogram
+        Return :
+            The grey CompactHistogram with bins bins
+        """
+        if bins is None:
+            bins = self.bins
+        if bins not in self._greys:
+            histo = (self.compact() if bins == self.bins
+                     else self.pyramid().level(bins))
+            self._greys[bins] = histo.grey()
+        return self._greys[bins]
+
+    def compact(self):
+        """
+        =======================================================================
+        Return the CompactHistogram holding the counts of this histogram,
+        without the image nor its pixels
+        =======================================================================
+        """
+        return CompactHistogram.from_histogram(self)
     
     def color_axes(histo, rgBinsNumber = 16, byBinsNumber = 16,
                 wbBinsNumber = 8) ->np.ndarray:
@@ -47,36 +306,14 @@ class Histogram:
         """
         assert type(histo) is Histogram
 
-        #Retrieve the original RGB channels
-        if isinstance(histo.histograms, ColorHistogram) :
-            r = histo.imageArray[:,:,0]
-            g = histo.imageArray[:,:,1]
-            b = histo.imageArray[:,:,2]
-        elif isinstance(histo.histograms, GreyHistogram) :
-            r = histo.imageArray[:,:]
-            g,b = r,r
-        #Raise an Exception if RGB channels cannot be retrieved
-        else :
+        #the channels can only be retrieved from these histograms
+        if not isinstance(histo.histograms, (ColorHistogram, GreyHistogram)):
             raise Exception("The histogram in argument doesn't have a "+
                         "ColorHistogram nor a GreyHistogram, so it isn't "+
                         "possible to create the associated bins histogram")
-
-        #Calculate the new color axes : rg, by, wb
-        rg = r - g
-        by = 2 * b - r -g
-        wb = r + g + b
-
-        #Create histograms of the new color axes
-        rgBins = plt.hist(rg.flatten(), bins = rgBinsNumber, 
-                                                        range = [0,255])
-        byBins = plt.hist(by.flatten(), bins = byBinsNumber, 
-                                                        range = [0,255])
-        wbBins = plt.hist(wb.flatten(), bins = wbBinsNumber, 
-                                                        range = [0,255])
-
-        #Return a single vector of the normalized bins
-        total_pixel = len(histo.imageArray[0]) * len(histo.imageArray)
-        return np.concatenate([rgBins[0],byBins[0],wbBins[0]])/total_pixel
+        return axes_vector(histo.imageArray,
+                           isinstance(histo.histograms, ColorHistogram),
+                           rgBinsNumber, byBinsNumber, wbBinsNumber)
 
     def __hash__(self) -> int:
         """
@@ -98,10 +335,8 @@ class GreyHistogram(Histogram) :
     """
     def __init__(self, imgArray, bins):
 #        self.grey = cv2.cvtColor(imgArray, cv2.COLOR_BGR2GRAY)
-        self.greyHistogram = plt.hist(imgArray[:,:].flatten(),range=[0,255], 
-                                      color = "grey", 
-                                      alpha = 0.5, 
-                                      bins = bins)
+        #every value of the array is counted, whatever its channel
+        self.greyHistogram = channel_counts(imgArray.reshape(-1, 1), bins)[0]
         
     def get_grey(self) -> np.ndarray:
         """
@@ -111,7 +346,7 @@ class GreyHistogram(Histogram) :
         Returns :
             The list of the bins value of grey
         """
-        return self.greyHistogram[0].astype(int)
+        return self.greyHistogram.astype(int)
     
     def set_grey(self, hist)-> None:
         """
@@ -122,7 +357,7 @@ class GreyHistogram(Histogram) :
         Arguments:
             hist : The list replacing the current histogram's list
         """
-        self.greyHistogram[0] = hist
+        self.greyHistogram[:] = hist
         
     def __hash__(self) -> int:
         """
@@ -146,20 +381,11 @@ class ColorHistogram(Histogram) :
     ===========================================================================
     """
     def __init__(self, imgArray, bins):
-        self.redHistogram = plt.hist(imgArray[:,:,0].flatten(),range=[0,255], 
-                                     color = "red", 
-                                     alpha = 0.5, 
-                                     bins = bins)
-        self.greenHistogram = plt.hist(imgArray[:,:,1].flatten(),
-                                       range=[0,255], 
-                                       color = "green", 
-                                       alpha = 0.5, 
-                                       bins = bins)
-        self.blueHistogram = plt.hist(imgArray[:,:,2].flatten(),
-                                      range=[0,255], 
-                                      color = "blue", 
-                                      alpha = 0.5, 
-                                      bins = bins)
+        #the three channels are counted together, each row is a view on it
+        self.counts = channel_counts(imgArray[:,:,:3].reshape(-1, 3), bins)
+        self.redHistogram = self.counts[0]
+        self.greenHistogram = self.counts[1]
+        self.blueHistogram = self.counts[2]
         
     
     def get_red(self)-> np.ndarray:
@@ -170,7 +396,7 @@ class ColorHistogram(Histogram) :
         Returns :
             The list of the bins value of red
         """
-        return self.redHistogram[0].astype(int)
+        return self.redHistogram.astype(int)
     
     def get_green(self)-> np.ndarray:
         """
@@ -180,7 +406,7 @@ class ColorHistogram(Histogram) :
         Returns :
             The list of the bins value of green
         """
-        return self.greenHistogram[0].astype(int)
+        return self.greenHistogram.astype(int)
         
     def get_blue(self) -> np.ndarray:
         """
@@ -190,7 +416,7 @@ class ColorHistogram(Histogram) :
         Returns :
             The list of the bins value of blue
         """
-        return self.blueHistogram[0].astype(int)
+        return self.blueHistogram.astype(int)
     
     def set_red(self, hist) -> None:
         """
@@ -201,7 +427,7 @@ class ColorHistogram(Histogram) :
         Arguments:
             hist : The list replacing the current red histogram's list
         """
-        self.redHistogram[0] = hist
+        self.redHistogram[:] = hist
         
     def set_green(self, hist) -> None:
         """
@@ -212,7 +438,7 @@ class ColorHistogram(Histogram) :
         Arguments:
             hist : The list replacing the current green histogram's list
         """
-        self.greenHistogram[0] = hist
+        self.greenHistogram[:] = hist
         
     def set_blue(self, hist) -> None:
         """
@@ -223,7 +449,7 @@ class ColorHistogram(Histogram) :
         Arguments:
             hist : The list replacing the current blue histogram's list
         """
-        self.blueHistogram[0] = hist
+        self.blueHistogram[:] = hist
         
     def __hash__(self) -> int:
         """
@@ -242,3 +468,273 @@ class ColorHistogram(Histogram) :
         return int(res)
 
 
+
+
+class CompactHistogram:
+    """
+    ===========================================================================
+    Class representing a histogram by its counts only : a single contiguous
+    (channels, bins) array of unsigned integers, with 3 channels (red, green,
+    blue) in color mode and 1 in grey mode.
+    Unlike Histogram, it does not keep the image nor its pixels alive, so it
+    is the form in which the Database stores its histograms.
+    ===========================================================================
+    """
+    __slots__ = ("counts", "bins", "mode", "_grey")
+
+    COLOR = "color"
+    GREY = "grey"
+
+    #magic, version, mode, dtype, channels, bins
+    _HEADER = struct.Struct("<4sBB3sII")
+    _MAGIC = b"CHST"
+    _VERSION = 1
+
+    def __init__(self, counts, mode):
+        counts = np.asarray(counts)
+        assert counts.ndim == 2, {"CompactHistogram : the counts must be a "+
+                                  "(channels, bins) array, not of shape "+
+                                  f"{counts.shape}"}.pop()
+        assert mode in (self.COLOR, self.GREY), {"CompactHistogram : the mode"+
+                                                 f" can not be {mode}"}.pop()
+        assert len(counts) == (3 if mode == self.COLOR else 1)
+        if counts.dtype.kind != "u":
+            #the smallest unsigned type holding every count
+            dtype = (np.uint32 if counts.size == 0 or
+                     counts.max() <= np.iinfo(np.uint32).max else np.uint64)
+            counts = counts.astype(dtype)
+        self.counts = np.ascontiguousarray(counts)
+        self.bins = counts.shape[1]
+        self.mode = mode
+        #the derived grey histogram, computed on first use
+        self._grey = None
+
+    def from_histogram(histo):
+        """
+        =======================================================================
+        Create the CompactHistogram of a Histogram
+        =======================================================================
+        Argument :
+            histo : The Histogram (a CompactHistogram is returned as is)
+        Return :
+            The CompactHistogram with the same counts
+        """
+        if isinstance(histo, CompactHistogram):
+            return histo
+        assert type(histo) is Histogram
+        if isinstance(histo.histograms, ColorHistogram):
+            return CompactHistogram(np.stack([histo.histograms.get_red(),
+                                              histo.histograms.get_green(),
+                                              histo.histograms.get_blue()]),
+                                    CompactHistogram.COLOR)
+        return CompactHistogram(histo.histograms.get_grey().reshape(1, -1),
+                                CompactHistogram.GREY)
+
+    def is_color(self) -> bool:
+        return self.mode == self.COLOR
+
+    def grey(self):
+        """
+        =======================================================================
+        Return the grey histogram derived from this one, which is the one a
+        GreyHistogram gives on the same pixels : every value is counted
+        whatever its channel, so the channels are summed. It is computed once
+        per histogram.
+        =======================================================================
+        """
+        if not self.is_color():
+            return self
+        if self._grey is None:
+            self._grey = CompactHistogram(self.counts.sum(
+                axis = 0, keepdims = True, dtype = self.counts.dtype),
+                                          self.GREY)
+        return self._grey
+
+    def rebin(self, bins):
+        """
+        =======================================================================
+        Return this histogram with another number of bins, computed from its
+        counts alone. This is only possible when each of its bins falls in a
+        single new bin, which is always the case from 256 bins (one bin per
+        value) and between the levels of a HistogramPyramid.
+        =======================================================================
+        Argument :
+            bins : The number of bins of the new histogram
+        Return :
+            The CompactHistogram with bins bins
+        Raises :
+            ValueError if the counts can not be rebinned exactly
+        """
+        if bins == self.bins:
+            return self
+        matrix = _rebin_matrix(self.bins, bins)
+        if matrix is None:
+            raise ValueError(f"A histogram of {self.bins} bins can not be "+
+                             f"rebinned exactly into {bins} bins.")
+        return CompactHistogram(self.counts @ matrix, self.mode)
+
+    def get_red(self) -> np.ndarray:
+        assert self.is_color()
+        return self.counts[0].astype(int)
+
+    def get_green(self) -> np.ndarray:
+        assert self.is_color()
+        return self.counts[1].astype(int)
+
+    def get_blue(self) -> np.ndarray:
+        assert self.is_color()
+        return self.counts[2].astype(int)
+
+    def get_grey(self) -> np.ndarray:
+        assert not self.is_color()
+        return self.counts[0].astype(int)
+
+    def to_bytes(self) -> bytes:
+        """
+        =======================================================================
+        Serialize the histogram : a small header followed by the raw counts
+        =======================================================================
+        """
+        mode = 0 if self.is_color() else 1
+        return (self._HEADER.pack(self._MAGIC, self._VERSION, mode,
+                                  self.counts.dtype.str.encode("ascii"),
+                                  *self.counts.shape) +
+                self.counts.tobytes())
+
+    def from_bytes(data):
+        """
+        =======================================================================
+        Deserialize a histogram written by to_bytes. The counts are read in
+        place from data, without copy.
+        =======================================================================
+        Raises :
+            ValueError if data was not written by to_bytes
+        """
+        header = CompactHistogram._HEADER
+        magic, version, mode, dtype, channels, bins = header.unpack_from(data)
+        if (magic != CompactHistogram._MAGIC or
+            version != CompactHistogram._VERSION):
+            raise ValueError("The data given is not a serialized "+
+                             "CompactHistogram.")
+        counts = np.frombuffer(data, dtype = np.dtype(dtype.decode("ascii")),
+                               count = channels * bins,
+                               offset = header.size).reshape(channels, bins)
+        return CompactHistogram(counts, (CompactHistogram.COLOR if mode == 0
+                                         else CompactHistogram.GREY))
+
+    def __reduce__(self):
+        return (CompactHistogram.from_bytes, (self.to_bytes(),))
+
+    def __eq__(self, o) -> bool:
+        if not isinstance(o, CompactHistogram):
+            return False
+        return (self.mode == o.mode and
+                np.array_equal(self.counts, o.counts))
+
+    def __hash__(self) -> int:
+        """
+        =======================================================================
+        Return the same hash value as the ColorHistogram or GreyHistogram
+        with these counts
+        =======================================================================
+        """
+        return int((np.arange(self.bins) * self.counts.astype(int)).sum())
+
+
+class HistogramPyramid:
+    """
+    ===========================================================================
+    Class representing the same histogram at several numbers of bins : 256
+    (one bin per value), 128, 64, ... 8. Each level is obtained by summing the
+    bins of the previous one two by two, which gives exactly the histogram
+    computed with that number of bins. Any other number of bins is derived
+    from the 256 bins level.
+    It is what the Database stores, so that a query can be compared with the
+    same number of bins whatever the --bins option.
+    ===========================================================================
+    """
+    __slots__ = ("levels",)
+
+    LEVELS = (256, 128, 64, 32, 16, 8)
+
+    #number of levels, then the size of each serialized level
+    _HEADER = struct.Struct("<I")
+
+    def __init__(self, base, levels = None):
+        """
+        base is the CompactHistogram at 256 bins. The other levels are
+        computed from it, unless they are given.
+        """
+        assert isinstance(base, CompactHistogram) and base.bins == 256, {
+            "HistogramPyramid : the base of the pyramid must be a "+
+            "CompactHistogram of 256 bins"}.pop()
+        if levels is None:
+            levels = [base]
+            counts = base.counts
+            while len(levels) < len(self.LEVELS):
+                counts = counts.reshape(len(counts), -1, 2).sum(axis = 2,
+                                                    dtype = counts.dtype)
+                levels.append(CompactHistogram(counts, base.mode))
+        self.levels = tuple(levels)
+
+    @property
+    def mode(self) -> str:
+        return self.levels[0].mode
+
+    def is_color(self) -> bool:
+        return self.levels[0].is_color()
+
+    def level(self, bins):
+        """
+        =======================================================================
+        Return the histogram with the given number of bins : a stored level
+        for a power of two, else a rebinning of the 256 bins level.
+        =======================================================================
+        Argument :
+            bins : The number of bins wanted
+        Return :
+            The CompactHistogram with bins bins
+        """
+        for level in self.levels:
+            if level.bins == bins:
+                return level
+        return self.levels[0].rebin(bins)
+
+    def to_bytes(self) -> bytes:
+        """
+        =======================================================================
+        Serialize all the levels of the pyramid
+        =======================================================================
+        """
+        levels = [level.to_bytes() for level in self.levels]
+        return b"".join([self._HEADER.pack(len(levels))] +
+                        [self._HEADER.pack(len(level)) + level
+                         for level in levels])
+
+    def from_bytes(data):
+        """
+        =======================================================================
+        Deserialize a pyramid written by to_bytes, without recomputing nor
+        copying its levels
+        =======================================================================
+        """
+        data = memoryview(data)
+        header = HistogramPyramid._HEADER
+        number, = header.unpack_from(data)
+        offset = header.size
+        levels = []
+        for _ in range(number):
+            size, = header.unpack_from(data, offset)
+            offset += header.size
+            levels.append(CompactHistogram.from_bytes(
+                data[offset:offset + size]))
+            offset += size
+        return HistogramPyramid(levels[0], levels)
+
+    def __reduce__(self):
+        return (HistogramPyramid.from_bytes, (self.to_bytes(),))
+
+    def __eq__(self, o) -> bool:
+        if not isinstance(o, HistogramPyramid):
+            return False
+        return self.levels == o.levels
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import PIL
+import PIL.Image
+import numpy as np
 import os
 from Histogram import Histogram
 import cv2
@@ -23,6 +24,7 @@ class Image:
         else:
             self._img = img
             self._path = file
+        self._array = None
 
     def to_grey(img, tmpdir): 
         assert type(img) is Image
@@ -52,6 +54,20 @@ class Image:
     
     def getimg(self):
         return self._img
+
+    def getarray(self):
+        """
+        =======================================================================
+        Return the pixels of the image. The file is only decoded the first
+        time, every later call returns the same buffer.
+        =======================================================================
+        Returns :
+            A np.uint8 array, of shape (height, width) for greyscale images
+            and (height, width, 3) for RGB ones.
+        """
+        if getattr(self, "_array", None) is None:
+            self._array = Parser._pixels(self._img)
+        return self._array
     
 class Parser:
     def _parse(file):
@@ -63,6 +79,18 @@ class Parser:
         assert os.path.exists(file)
         return(PIL.Image.open(file))
 
+    def _pixels(img):
+        """
+        Decode a PIL image into a np.uint8 array with one (L) or three (RGB)
+        channels. Palettes, alpha channels and other modes are converted.
+        """
+        if img.mode not in ("L", "RGB"):
+            if set(img.getbands()) <= {"L", "A", "1", "I", "F"}:
+                img = img.convert("L")
+            else:
+                img = img.convert("RGB")
+        return np.asarray(img)
+
     def scale_image(img):
         assert type(img) is Image, {"Parser : the scaling function takes an"+
                                     " image as argument and not"+
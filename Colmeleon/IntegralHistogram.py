@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Integral histogram of an image (Porikli), to find the region of an image
+whose histogram best matches a model, such as a chameleon in a scene.
+The image is cut in square cells of a few pixels, and the integral histogram
+holds, for each corner of the cells, the histogram of every pixel above and
+left of it : the histogram of any rectangle of cells is then the sum and
+difference of the ones of its four corners, in O(bins) whatever its size.
+The score of a window is the intersection of its normalized histogram with
+the one of the model, in percent : for each channel the sum of the minimums
+of the two distributions, the smallest value among the channels being kept,
+so that windows of any size are compared with the same model.
+===============================================================================
+"""
+import numpy as np
+from Histogram import CompactHistogram, bin_lut
+import Segmentation
+
+#Number of windows scored at once
+_CHUNK = 4096
+
+#Number of best windows of a step of a search refined by the next one
+CANDIDATES = 8
+
+class IntegralHistogram:
+    """
+    ===========================================================================
+    Class holding the integral histogram of an image, its rows and columns
+    being the corners of its cells (see the module).
+    ===========================================================================
+    Attributes :
+        bins : the number of bins of the histograms
+        cell : the side, in pixels, of a cell, the cells of the last row and
+               column being cut by the edges of the image
+        shape : the (height, width) of the image, in pixels
+        mode : CompactHistogram.COLOR or CompactHistogram.GREY
+        counts : the (rows + 1, columns + 1, channels, bins) np.uint32
+                 histograms of the pixels above and left of each corner
+    """
+    def __init__(self, image, bins = 16, cell = 8):
+        """
+        =======================================================================
+        Count the histogram of each cell of an image, then sum them along
+        the rows and the columns.
+        =======================================================================
+        Arguments :
+            image : The Image, or its pixels (see Segmentation.backproject)
+            bins : The number of bins of the histograms
+            cell : The side, in pixels, of a cell
+        """
+        assert cell >= 1, {"IntegralHistogram : the cells must be at least"+
+                           " 1 pixel wide"}.pop()
+        pixels = Segmentation._pixels(image)
+        self.bins = bins
+        self.cell = cell
+        self.shape = pixels.shape[:2]
+        self.mode = (CompactHistogram.COLOR if pixels.ndim == 3
+                     else CompactHistogram.GREY)
+        channels = 3 if pixels.ndim == 3 else 1
+        rows = -(-self.shape[0] // cell)
+        columns = -(-self.shape[1] // cell)
+        self.counts = np.zeros((rows + 1, columns + 1, channels, bins),
+                               dtype = np.uint32)
+        lut = bin_lut(bins).astype(np.intp)
+        #the cell of each pixel of a row of cells, times the bins
+        keys = np.arange(self.shape[1]) // cell * bins
+        for band, (_, values) in enumerate(Segmentation.tiles(
+                pixels, cell * self.shape[1])):
+            values = values.reshape(len(values), self.shape[1], channels)
+            for channel in range(channels):
+                found = (keys + lut[values[:, :, channel]]).ravel()
+                self.counts[band + 1, 1:, channel] = np.bincount(
+                    found, minlength = columns * bins).reshape(columns, bins)
+        np.cumsum(self.counts, axis = 0, out = self.counts)
+        np.cumsum(self.counts, axis = 1, out = self.counts)
+
+    def grid(self) -> tuple:
+        """
+        =======================================================================
+        Return the (rows, columns) of cells of the image.
+        =======================================================================
+        """
+        return len(self.counts) - 1, self.counts.shape[1] - 1
+
+    def rectangles(self, top, left, bottom, right) -> np.ndarray:
+        """
+        =======================================================================
+        Return the histograms of rectangles of cells, from their four corners.
+        =======================================================================
+        Arguments :
+            top, left, bottom, right : The (K,) first rows and columns of
+                                       cells of the rectangles, and the ones
+                                       after their last, or single integers
+        Returns :
+            The (K, channels, bins) counts of the rectangles, or the
+            (channels, bins) counts of a single one
+        """
+        counts = self.counts
+        return (counts[bottom, right].astype(np.int64) -
+                counts[top, right] - counts[bottom, left] +
+                counts[top, left])
+
+    def histogram(self, top, left, bottom, right):
+        """
+        =======================================================================
+        Return the histogram of a rectangle of pixels, its edges being
+        rounded to the closest cells.
+        =======================================================================
+        Arguments :
+            top, left, bottom, right : The first row and column of pixels of
+                                       the rectangle, and the ones after its
+                                       last
+        Returns :
+            The CompactHistogram of the rectangle
+        """
+        edges = [int(round(edge / self.cell)) for edge in
+                 (top, left, bottom, right)]
+        return CompactHistogram(self.rectangles(*edges), self.mode)
+
+    def scores(self, model, top, left, height, width) -> np.ndarray:
+        """
+        =======================================================================
+        Score windows of cells against a model (see the module), by chunks.
+        =======================================================================
+        Arguments :
+            model : The (channels, bins) distributions of the model, see
+                    _distributions
+            top, left : The (K,) first rows and columns of cells of the
+                        windows
+            height, width : The number of rows and columns of cells of the
+                            windows
+        Returns :
+            The (K,) scores, between 0 and 100
+        """
+        res = np.empty(len(top))
+        for start in range(0, len(top), _CHUNK):
+            end = start + _CHUNK
+            y, x = top[start:end], left[start:end]
+            counts = self.rectangles(y, x, y + height, x + width)
+            if len(model) == 1 and counts.shape[1] > 1:
+                counts = counts.sum(axis = 1, keepdims = True)
+            totals = np.maximum(counts.sum(axis = -1, keepdims = True), 1)
+            res[start:end] = np.minimum(counts / totals, model).sum(
+                axis = -1).min(axis = -1) * 100
+        return res
+
+    def _distributions(self, model) -> np.ndarray:
+        """
+        Return the (channels, bins) distributions of a model, the grey ones
+        if it or the image is grey
+        """
+        model = Segmentation.model_histogram(model, self.bins)
+        if not (model.is_color() and self.mode == CompactHistogram.COLOR):
+            model = model.grey()
+        counts = model.counts.astype(np.float64)
+        return counts / np.maximum(counts.sum(axis = -1, keepdims = True), 1)
+
+    def search(self, model, windows = None, stride = None,
+               candidates = CANDIDATES, stats = None) -> list:
+        """
+        =======================================================================
+        Find the windows of the image whose histograms best match a model,
+        coarse to fine : every window at a stride of about a quarter of its
+        size is scored, then the candidates best ones are scored again at
+        every position around them at half the stride, down to a single
+        cell.
+        =======================================================================
+        Arguments :
+            model : The model, see Segmentation.model_histogram
+            windows : The (height, width) in pixels of the windows searched,
+                      by default squares of a half, a quarter and an eighth
+                      of the smallest side of the image
+            stride : The first stride, in cells, by default a quarter of the
+                     size of each window
+            candidates : The number of windows refined at each step
+            stats : A dictionary in which "windows" (windows scored) and
+                    "positions" (windows of a single cell stride) are added,
+                    if given
+        Returns :
+            The list of the tuples (score, (top, left, bottom, right)) of the
+            best window of each size, the rectangles being in pixels cut by
+            the edges of the image, the best first
+        """
+        distributions = self._distributions(model)
+        if windows is None:
+            side = min(self.shape)
+            windows = [(side // n, side // n) for n in (2, 4, 8)]
+        rows, columns = self.grid()
+        res = []
+        for height, width in windows:
+            #the window in cells, within the image
+            height = min(rows, max(1, int(round(height / self.cell))))
+            width = min(columns, max(1, int(round(width / self.cell))))
+            last = (rows - height, columns - width)
+            step = (stride if stride is not None
+                    else max(1, min(height, width) // 4))
+            top, left = [np.ravel(axis) for axis in np.meshgrid(
+                np.arange(0, last[0] + 1, step),
+                np.arange(0, last[1] + 1, step), indexing = "ij")]
+            #the last positions are always scored
+            top = np.concatenate([top, np.full(1, last[0])])
+            left = np.concatenate([left, np.full(1, last[1])])
+            scored = 0
+            while True:
+                scores = self.scores(distributions, top, left, height, width)
+                scored += len(scores)
+                best = np.argsort(-scores, kind = "stable")[:candidates]
+                if step == 1:
+                    break
+                step = max(1, step // 2)
+                offsets = np.arange(-step, step + 1, step)
+                top = np.clip(top[best][:, np.newaxis, np.newaxis] +
+                              offsets[:, np.newaxis], 0, last[0])
+                left = np.clip(left[best][:, np.newaxis, np.newaxis] +
+                               offsets, 0, last[1])
+                top, left = np.broadcast_arrays(top, left)
+                top, left = np.unique(np.stack([top.ravel(), left.ravel()]),
+                                      axis = 1)
+            y, x = int(top[best[0]]), int(left[best[0]])
+            res.append((float(scores[best[0]]),
+                        (y * self.cell, x * self.cell,
+                         min(self.shape[0], (y + height) * self.cell),
+                         min(self.shape[1], (x + width) * self.cell))))
+            if stats is not None:
+                for name, value in [("windows", scored),
+                                    ("positions", (last[0] + 1) *
+                                     (last[1] + 1))]:
+                    stats[name] = stats.get(name, 0) + value
+        res.sort(key = lambda found : -found[0])
+        return res
+
+def locate(image, model, windows = None, bins = 16, cell = 8,
+           stats = None) -> list:
+    """
+    ===========================================================================
+    Find the region of an image whose histogram best matches a model (see
+    IntegralHistogram.search).
+    ===========================================================================
+    Arguments :
+        image : The Image, or its pixels (see Segmentation.backproject)
+        model : The model, see Segmentation.model_histogram
+        windows : The (height, width) in pixels of the windows searched
+        bins : The number of bins of the histograms compared
+        cell : The side, in pixels, of a cell of the integral histogram
+        stats : A dictionary for the counters, see IntegralHistogram.search
+    Returns :
+        The list of the tuples (score, (top, left, bottom, right)) of the
+        best window of each size, the best first
+    """
+    return IntegralHistogram(image, bins, cell).search(model, windows,
+                                                       stats = stats)
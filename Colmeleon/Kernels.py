@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Registry of the distances between histograms or vectors. Each kernel is
+written once for stacks of samples, so that comparing a query with every
+image of a database, or a batch of queries with every image, is a few
+vectorized expressions instead of one call per image.
+A sample is a (bins,) vector or the (channels, bins) counts of a histogram.
+The kernels made for distributions expect each channel to sum to 1, see
+normalize.
+===============================================================================
+"""
+import numpy as np
+
+#Number of values compared at once, to keep the kernels in the cache
+_CHUNK = 1 << 18
+
+def normalize(counts) -> np.ndarray:
+    """
+    ===========================================================================
+    Divide each channel of counts by its sum, an empty channel staying at 0.
+    ===========================================================================
+    Argument :
+        counts : (..., bins) counts
+    Returns :
+        The float64 array of the distributions, with the shape of counts
+    """
+    counts = np.asarray(counts, dtype = np.float64)
+    totals = counts.sum(axis = -1, keepdims = True)
+    return np.divide(counts, totals, out = np.zeros_like(counts),
+                     where = totals > 0)
+
+def _stacked(samples) -> np.ndarray:
+    """
+    Return a stack of (bins,) or (channels, bins) samples as a float64
+    (number of samples, channels, bins) array
+    """
+    samples = np.asarray(samples, dtype = np.float64)
+    if samples.ndim == 2:
+        samples = samples[:, np.newaxis]
+    assert samples.ndim == 3, {"Kernels : the samples must be stacked "+
+                               "(bins,) or (channels, bins) arrays"}.pop()
+    return samples
+
+def _reduce(term, images, models) -> np.ndarray:
+    """
+    Sum term(image, models) over the channels and the bins for every image
+    against stacked models, about _CHUNK values of the models at a time
+    """
+    res = np.empty((len(images), len(models)))
+    step = max(1, _CHUNK // max(1, images[0].size if len(images) else 1))
+    for start in range(0, len(models), step):
+        chunk = models[start:start+step]
+        for q, image in enumerate(images):
+            res[q, start:start+step] = term(image, chunk).sum(axis = (1, 2))
+    return res
+
+def _flat(samples) -> np.ndarray:
+    """
+    Return stacked samples as (number of samples, channels * bins)
+    """
+    return samples.reshape(len(samples), -1)
+
+def _intersection(images, models) -> np.ndarray:
+    return 1 - _reduce(np.minimum, images, models) / images.shape[1]
+
+def _euclidean(images, models) -> np.ndarray:
+    return np.sqrt(_reduce(lambda image, chunk : (chunk - image) ** 2,
+                           images, models))
+
+def _chi_square_term(image, models) -> np.ndarray:
+    total = image + models
+    return np.divide((image - models) ** 2, total,
+                     out = np.zeros_like(total), where = total > 0)
+
+def _chi_square(images, models) -> np.ndarray:
+    return _reduce(_chi_square_term, images, models) / 2
+
+def _coefficients(images, models) -> np.ndarray:
+    """
+    The Bhattacharyya coefficients of every image with every model, averaged
+    over the channels
+    """
+    return (_flat(np.sqrt(images)) @ _flat(np.sqrt(models)).T /
+            images.shape[1])
+
+def _hellinger(images, models) -> np.ndarray:
+    return np.sqrt(np.maximum(1 - _coefficients(images, models), 0))
+
+def _bhattacharyya(images, models) -> np.ndarray:
+    with np.errstate(divide = "ignore"):
+        return np.maximum(-np.log(_coefficients(images, models)), 0)
+
+def _cosine(images, models) -> np.ndarray:
+    images, models = _flat(images), _flat(models)
+    norms = (np.linalg.norm(images, axis = 1)[:, np.newaxis] *
+             np.linalg.norm(models, axis = 1))
+    products = np.divide(images @ models.T, norms,
+                         out = np.zeros_like(norms), where = norms > 0)
+    return np.maximum(1 - products, 0)
+
+def _emd(images, models) -> np.ndarray:
+    return _reduce(lambda image, chunk : np.abs(chunk - image),
+                   np.cumsum(images, axis = -1),
+                   np.cumsum(models, axis = -1)) / images.shape[1]
+
+class Kernel:
+    """
+    ===========================================================================
+    Class representing a distance between samples, given by its matrix form :
+    a function of the (Q, channels, bins) and (N, channels, bins) stacks of
+    two sets of samples returning their (Q, N) distances. The pairwise and
+    the one against many forms come from it.
+    ===========================================================================
+    Attributes :
+        name : the name under which the kernel is registered
+        function : the matrix form
+    """
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+    def matrix(self, images, models) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the distances of a batch of samples with stacked models.
+        =======================================================================
+        Arguments :
+            images : The Q stacked samples
+            models : The N stacked samples, with the shape of the images
+        Returns :
+            The (Q, N) array of the distances
+        """
+        images, models = _stacked(images), _stacked(models)
+        assert images.shape[1:] == models.shape[1:], {f"Kernel {self.name} "+
+                   f": samples of shape {images.shape[1:]} can not be "+
+                   f"compared with samples of shape {models.shape[1:]}"}.pop()
+        if len(images) == 0 or len(models) == 0:
+            return np.zeros((len(images), len(models)))
+        return self.function(images, models)
+
+    def distances(self, image, models) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the (N,) distances of a sample with N stacked models.
+        =======================================================================
+        """
+        return self.matrix(np.asarray(image)[np.newaxis], models)[0]
+
+    def pair(self, image, model) -> float:
+        """
+        =======================================================================
+        Compute the distance of two samples.
+        =======================================================================
+        """
+        return float(self.matrix(np.asarray(image)[np.newaxis],
+                                 np.asarray(model)[np.newaxis])[0, 0])
+
+#The kernels, by name
+KERNELS = {}
+
+def register(kernel) -> Kernel:
+    """
+    ===========================================================================
+    Add a kernel to KERNELS, replacing the one of the same name if any.
+    ===========================================================================
+    """
+    KERNELS[kernel.name] = kernel
+    return kernel
+
+def get(kernel) -> Kernel:
+    """
+    ===========================================================================
+    Return the kernel registered under a name, or the kernel itself.
+    ===========================================================================
+    Raises :
+        AssertionError if no kernel has this name
+    """
+    if isinstance(kernel, Kernel):
+        return kernel
+    assert kernel in KERNELS, {f"Kernels : the kernel {kernel} does not "+
+                               f"exist, it must be one of "+
+                               f"{sorted(KERNELS)}"}.pop()
+    return KERNELS[kernel]
+
+#1 - the sum of the minimums of the distributions, averaged over the channels
+register(Kernel("intersection", _intersection))
+#the euclidean distance of the whole samples
+register(Kernel("euclidean", _euclidean))
+#half the sum of (p - q)^2 / (p + q)
+register(Kernel("chi-square", _chi_square))
+#from the Bhattacharyya coefficient BC of the distributions, averaged over
+#the channels : sqrt(1 - BC) and -ln(BC)
+register(Kernel("hellinger", _hellinger))
+register(Kernel("bhattacharyya", _bhattacharyya))
+#1 - the cosine of the angle of the whole samples
+register(Kernel("cosine", _cosine))
+#the earth mover's distance of the distributions along the bins, as the sum
+#of the differences of their cumulative sums, averaged over the channels
+register(Kernel("emd", _emd))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import heapq
+import pickle
+import numpy as np
+from FeatureStore import dump
+
+#Number of rows under which a part of the tree is not split anymore
+LEAF_SIZE = 32
+
+#Margin added to the search radius so that every row whose distance rounded
+#to four decimals (see Algorithm.euclidean_dist) ties with the last one kept
+#is found, float errors included
+SLACK = 2e-4
+
+class _Leaf:
+    """
+    Rows of the tree scanned together
+    """
+    __slots__ = ("rows",)
+
+    def __init__(self, rows):
+        self.rows = np.asarray(rows, dtype = np.intp)
+
+class _Node:
+    """
+    Vantage point of the tree : the rows closer to it than mu are inside,
+    the others outside, and each side keeps the range of their distances to
+    the vantage point
+    """
+    __slots__ = ("vantage", "mu", "inside", "outside", "ranges")
+
+    def __init__(self, vantage, mu, inside, outside, ranges):
+        self.vantage = vantage
+        self.mu = mu
+        self.inside = inside
+        self.outside = outside
+        self.ranges = ranges
+
+class MetricTree:
+    """
+    ===========================================================================
+    Class representing a vantage point tree over the color axes vectors (see
+    Histogram.color_axes) of the images of a database. It answers exact
+    nearest neighbours and radius queries for the euclidean distance while
+    skipping, thanks to the triangle inequality, the parts of the database
+    that can not hold an answer.
+    The tree is stored next to the histograms of the database, and the
+    images added since are inserted when it is loaded (see
+    Database.metric_tree).
+    ===========================================================================
+    Attributes :
+        paths : the paths to the images, in the order of the rows
+        vectors : the (N, dimensions) color axes vectors
+        version : the version of the database the tree was built for (see
+                  Database.version)
+    """
+    def __init__(self, paths, vectors, version = None):
+        self.paths = list(paths)
+        self.vectors = np.ascontiguousarray(vectors, dtype = np.float64)
+        self.version = version
+        self._root = self._build(np.arange(len(self.paths)))
+
+    def from_vectors(entries, version = None):
+        """
+        =======================================================================
+        Build the tree of couples (path to image, color axes vector), such as
+        the ones Database.bin_histograms yields.
+        =======================================================================
+        """
+        paths, vectors = [], []
+        for path, vector in entries:
+            paths.append(path)
+            vectors.append(np.asarray(vector, dtype = np.float64))
+        return MetricTree(paths, np.stack(vectors) if vectors
+                          else np.zeros((0, 40)), version)
+
+    def load(path):
+        """
+        =======================================================================
+        Load a tree saved by MetricTree.save
+        =======================================================================
+        """
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def save(self, path) -> None:
+        dump(self, path)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _distances(self, rows, vector) -> np.ndarray:
+        """
+        The exact euclidean distances of the vector to some rows
+        """
+        return np.sqrt(np.sum((self.vectors[rows] - vector) ** 2, axis = 1))
+
+    def _build(self, rows):
+        """
+        Build the part of the tree holding rows, the first row being the
+        vantage point and the median distance to it the split
+        """
+        if len(rows) <= LEAF_SIZE:
+            return _Leaf(rows)
+        vantage, rows = rows[0], rows[1:]
+        dist = self._distances(rows, self.vectors[vantage])
+        mu = float(np.median(dist))
+        inside = dist <= mu
+        if inside.all():
+            #every row is at the same distance, it can not be split
+            return _Leaf(np.concatenate([[vantage], rows]))
+        return _Node(vantage, mu, self._build(rows[inside]),
+                     self._build(rows[~inside]),
+                     [float(dist[inside].min()), float(dist[inside].max()),
+                      float(dist[~inside].min()), float(dist[~inside].max())])
+
+    def insert(self, path, vector) -> None:
+        """
+        =======================================================================
+        Add a row to the tree : it goes down to the leaf on its side of each
+        vantage point, and the leaf is split once it grows too big.
+        =======================================================================
+        Arguments :
+            path : the path to the image
+            vector : its color axes vector
+        """
+        vector = np.asarray(vector, dtype = np.float64)
+        row = len(self.paths)
+        self.paths.append(path)
+        self.vectors = np.concatenate([self.vectors,
+                                       vector.reshape(1, -1)])
+        parent, side, node = None, None, self._root
+        while isinstance(node, _Node):
+            dist = float(self._distances([node.vantage], vector)[0])
+            parent = node
+            if dist <= node.mu:
+                side, low, high = "inside", 0, 1
+            else:
+                side, low, high = "outside", 2, 3
+            node.ranges[low] = min(node.ranges[low], dist)
+            node.ranges[high] = max(node.ranges[high], dist)
+            node = getattr(node, side)
+        rows = np.append(node.rows, row)
+        leaf = (self._build(rows) if len(rows) > 2 * LEAF_SIZE
+                else _Leaf(rows))
+        if parent is None:
+            self._root = leaf
+        else:
+            setattr(parent, side, leaf)
+
+    def _search(self, vector, radius, depth, stats):
+        """
+        Return the rows whose distance to the vector may be at most the
+        radius, or the depth-th smallest distance plus SLACK when depth is
+        given, with their exact distances
+        """
+        vector = np.asarray(vector, dtype = np.float64)
+        found_rows, found_dist = [], []
+        #the depth smallest distances met so far, as a max heap
+        best = []
+        limit = [radius]
+        evaluations = [0]
+
+        def consider(rows, dist):
+            keep = dist <= limit[0]
+            found_rows.append(rows[keep])
+            found_dist.append(dist[keep])
+            if depth is not None:
+                for value in dist[keep]:
+                    if len(best) < depth:
+                        heapq.heappush(best, -value)
+                    elif value < -best[0]:
+                        heapq.heapreplace(best, -value)
+                if len(best) == depth:
+                    limit[0] = min(limit[0], -best[0] + SLACK)
+
+        def visit(node):
+            if isinstance(node, _Leaf):
+                evaluations[0] += len(node.rows)
+                consider(node.rows, self._distances(node.rows, vector))
+                return
+            dist = self._distances([node.vantage], vector)
+            evaluations[0] += 1
+            consider(np.array([node.vantage]), dist)
+            dist = float(dist[0])
+            #the closest any row of a side can be to the vector
+            sides = [(max(node.ranges[0] - dist, dist - node.ranges[1], 0),
+                      node.inside),
+                     (max(node.ranges[2] - dist, dist - node.ranges[3], 0),
+                      node.outside)]
+            sides.sort(key = lambda side : side[0])
+            for bound, child in sides:
+                if bound <= limit[0]:
+                    visit(child)
+
+        if len(self):
+            visit(self._root)
+        rows = (np.concatenate(found_rows) if found_rows
+                else np.zeros(0, dtype = np.intp))
+        dist = np.concatenate(found_dist) if found_dist else np.zeros(0)
+        keep = dist <= limit[0]
+        if stats is not None:
+            for name, value in [("distances", evaluations[0]),
+                                ("saved", len(self) - evaluations[0]),
+                                ("rows", len(self))]:
+                stats[name] = stats.get(name, 0) + value
+        return rows[keep], dist[keep]
+
+    def candidates(self, vector, depth, stats = None) -> np.ndarray:
+        """
+        =======================================================================
+        Find the rows that may be among the depth nearest neighbours of a
+        vector.
+        =======================================================================
+        Arguments :
+            vector : the color axes vector of the query
+            depth : the number of neighbours looked for
+            stats : A dictionary in which "distances" (distances computed),
+                    "saved" (distances an exhaustive search would have
+                    computed in addition) and "rows" (rows of the tree) are
+                    added, if given
+        Returns :
+            The increasing indexes of the rows kept. They hold every row
+            whose distance, rounded to four decimals, is at most the one of
+            the depth-th nearest neighbour.
+        """
+        if depth <= 0:
+            return np.zeros(0, dtype = np.intp)
+        rows, _ = self._search(vector, np.inf, depth, stats)
+        return np.sort(rows)
+
+    def nearest(self, vector, depth, stats = None) -> list:
+        """
+        =======================================================================
+        Find the depth nearest neighbours of a vector.
+        =======================================================================
+        Arguments :
+            vector : the color axes vector of the query
+            depth : the number of neighbours returned
+            stats : A dictionary for the counters, see candidates
+        Returns :
+            The list of the depth nearest (distance, path), sorted, with the
+            distances of Algorithm.euclidean_dist
+        """
+        rows, dist = self._search(vector, np.inf, depth, stats)
+        dist = np.around(dist, decimals = 4)
+        return sorted((float(d), self.paths[row])
+                      for row, d in zip(rows, dist))[:max(depth, 0)]
+
+    def within(self, vector, radius, stats = None) -> list:
+        """
+        =======================================================================
+        Find every row whose distance to a vector, rounded to four decimals,
+        is at most radius.
+        =======================================================================
+        Arguments :
+            vector : the color axes vector of the query
+            radius : the largest distance returned
+            stats : A dictionary for the counters, see candidates
+        Returns :
+            The list of the (distance, path) found, sorted
+        """
+        rows, dist = self._search(vector, radius + SLACK, None, stats)
+        dist = np.around(dist, decimals = 4)
+        return sorted((float(d), self.paths[row])
+                      for row, d in zip(rows, dist) if d <= radius)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Compact storage of the feature matrix of a database. Instead of the counts,
+each channel of a row stores its distribution, quantized to a fixed total :
+    "float32" : the distribution itself, in 4 bytes per bin
+    "uint16" : the distribution times 65535, in 2 bytes per bin
+    "uint8" : the distribution times 255, in 1 byte per bin
+the rounding keeping the exact total (largest remainders). The uint32 counts
+of a FeatureMatrix take 4 bytes per bin. Retrieval.QuantizedMatrix holds
+the rows of a database in this form.
+The match values stay the ones of Algorithm.match_value : the query is
+scaled to the total of each row instead of the rows being expanded back to
+counts, so the quantized rows are read as they are stored. The rounding of
+the rows is the only difference, see Retrieval.quantization_error.
+===============================================================================
+"""
+import numpy as np
+
+#The storage types, by name, with the total of a channel of a row
+DTYPES = {"float32": (np.float32, 1), "uint16": (np.uint16, 65535),
+          "uint8": (np.uint8, 255)}
+
+#Number of counts quantized or scored at once
+_CHUNK = 1 << 18
+
+def quantize(counts, dtype) -> tuple:
+    """
+    ===========================================================================
+    Quantize the distributions of each channel of counts to the total of a
+    storage type.
+    ===========================================================================
+    Arguments :
+        counts : The (N, channels, bins) counts
+        dtype : The name of the storage type, one of DTYPES
+    Returns :
+        A tuple (codes, sums) : the (N, channels, bins) quantized
+        distributions in the storage type, an empty channel staying at 0,
+        and the (N, channels) sums of the channels of each row
+    Raises :
+        AssertionError if the storage type does not exist
+    """
+    assert dtype in DTYPES, {f"quantize : the type {dtype} does not exist, "+
+                             f"it must be one of {sorted(DTYPES)}"}.pop()
+    kind, total = DTYPES[dtype]
+    counts = np.asarray(counts)
+    codes = np.empty(counts.shape, dtype = kind)
+    sums = counts.sum(axis = -1, dtype = np.int64)
+    step = max(1, _CHUNK // max(1, counts[0].size if len(counts) else 1))
+    for start in range(0, len(counts), step):
+        chunk = counts[start:start+step].astype(np.float64)
+        totals = chunk.sum(axis = -1, keepdims = True)
+        exact = np.divide(chunk * total, totals, out = np.zeros_like(chunk),
+                          where = totals > 0)
+        if kind == np.float32:
+            codes[start:start+step] = exact
+            continue
+        rounded = np.floor(exact)
+        #the missing units go to the largest remainders
+        missing = np.rint(exact.sum(axis = -1, keepdims = True) -
+                          rounded.sum(axis = -1, keepdims = True))
+        order = np.argsort(rounded - exact, axis = -1, kind = "stable")
+        ranks = np.empty_like(order)
+        np.put_along_axis(ranks, order, np.arange(counts.shape[-1]),
+                          axis = -1)
+        codes[start:start+step] = rounded + (ranks < missing)
+    return codes, sums
+
+def score_matrix(images, codes, sums, pixels, total) -> np.ndarray:
+    """
+    ===========================================================================
+    Compute the match values (see Algorithm.intersection_scores) of the
+    counts of images with quantized rows. For a channel of a row which
+    counted sums values, the minimum of a count of the image and of the row
+    is the minimum of the count scaled by total / sums and of the code,
+    scaled back.
+    ===========================================================================
+    Arguments :
+        images : The (channels, bins) counts of the Q images
+        codes : The (N, channels, bins) rows quantized by quantize
+        sums : The (N, channels) sums quantize returned
+        pixels : The (N,) number of pixels of the images of the rows
+        total : The total of the storage type of the rows
+    Returns :
+        The (Q, N) array of the match values
+    """
+    res = np.empty((len(images), len(codes)))
+    scales = (total / np.maximum(sums, 1)).astype(np.float32)
+    pixels = np.asarray(pixels).reshape(-1, 1)
+    ratios = np.divide(sums, pixels * float(total),
+                       out = np.full(sums.shape, np.nan), where = pixels > 0)
+    step = max(1, _CHUNK // max(1, codes[0].size if len(codes) else 1))
+    images = [np.asarray(image, dtype = np.float32) for image in images]
+    for start in range(0, len(codes), step):
+        end = start + step
+        chunk = codes[start:end]
+        scale = scales[start:end, :, np.newaxis]
+        scaled = np.empty(chunk.shape, dtype = np.float32)
+        for q, image in enumerate(images):
+            np.multiply(image, scale, out = scaled)
+            np.minimum(scaled, chunk, out = scaled)
+            inter = np.einsum("ncb->nc", scaled)
+            res[q, start:end] = (inter * ratios[start:end]).min(axis = 1) * 100
+    return res
@@ -0,0 +1,1235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import atexit
+import bisect
+import numpy as np
+import Algorithm
+import ApproximateIndex
+import Kernels
+import ShardPool
+import Quantization
+from Histogram import Histogram, CompactHistogram
+
+#The modes of retrieval, as Algorithm.retrieval exposes them
+INTERSECTION = "intersection"
+GREY = "grey"
+INCREMENTAL = "incremental"
+INCREMENTAL_INTERSECTION = "incremental intersection"
+APPROXIMATE = "approximate"
+CASCADE = "cascade"
+CLUSTERED = "clustered"
+MODES = (INTERSECTION, GREY, INCREMENTAL, INCREMENTAL_INTERSECTION,
+         APPROXIMATE, CASCADE, CLUSTERED)
+
+#Number of candidates of the ApproximateIndex scored exactly per image
+#returned
+RERANK = 16
+
+#Number of bins per channel of the summaries of the CASCADE mode, and
+#number of rows it scores at full resolution at once
+SUMMARY_BINS = 8
+_CASCADE_STEP = 256
+
+#Number of counts scored at once, to keep the kernels in the cache
+_CHUNK = 1 << 18
+
+#Feature matrices already loaded by this process
+_loaded = {}
+
+#ShardPools started by this process
+_pools = {}
+
+def _compact(histo, bins) -> CompactHistogram:
+    """
+    Return the CompactHistogram with bins bins of a stored histogram
+    """
+    if isinstance(histo, CompactHistogram):
+        return histo.rebin(bins)
+    if histo.bins != bins:
+        return histo.pyramid().level(bins)
+    return histo.compact()
+
+class FeatureMatrix:
+    """
+    ===========================================================================
+    Class holding the histograms of all the images of a database, with the
+    same number of bins, as matrices. A query is scored against all of them
+    with a few vectorized expressions instead of one call per image.
+    ===========================================================================
+    Attributes :
+        paths : the paths to the images, in the order of the rows
+        bins : the number of bins of the histograms
+        is_color : (N,) booleans, True for the rows holding a color histogram
+        colors : (number of color rows, 3 * bins) counts of the color rows
+        greys : (N, bins) grey counts of every row, derived from the
+                channels for the color ones
+        pixels : (N,) number of pixels of each image
+    """
+    def __init__(self, paths, bins, is_color, colors, greys, pixels):
+        self.paths = list(paths)
+        self.bins = bins
+        self.is_color = np.asarray(is_color, dtype = bool)
+        self.colors = np.ascontiguousarray(colors)
+        self.greys = np.ascontiguousarray(greys)
+        self.pixels = np.asarray(pixels, dtype = np.int64)
+        #the PostingIndex and the summaries of the rows, built on the first
+        #query that needs them
+        self._postings = {}
+        self._summaries = {}
+        self._normalized = {}
+
+    def from_histograms(entries, bins):
+        """
+        =======================================================================
+        Build the matrices from couples (path to image, histogram), such as
+        the ones the Database generators yield.
+        =======================================================================
+        Arguments :
+            entries : iterable of (path, Histogram or CompactHistogram)
+            bins : the number of bins of the matrices
+        Returns :
+            The FeatureMatrix of the entries
+        """
+        paths, is_color, colors, greys, pixels = [], [], [], [], []
+        for path, histo in entries:
+            compact = _compact(histo, bins)
+            paths.append(path)
+            is_color.append(compact.is_color())
+            if compact.is_color():
+                colors.append(compact.counts.reshape(-1))
+            greys.append(compact.grey().counts[0])
+            pixels.append(compact.counts[0].sum(dtype = np.int64))
+        colors = (np.stack(colors) if colors
+                  else np.zeros((0, 3 * bins), dtype = np.uint32))
+        greys = (np.stack(greys) if greys
+                 else np.zeros((0, bins), dtype = np.uint32))
+        return FeatureMatrix(paths, bins, is_color, colors, greys, pixels)
+
+    def from_store(store, bins, grey = False):
+        """
+        =======================================================================
+        Build the matrices from the arrays of a FeatureStore, a chunk of
+        rows at a time, without a histogram per image.
+        =======================================================================
+        Arguments :
+            store : the FeatureStore of a database
+            bins : the number of bins of the matrices
+            grey : if True, the matrices of the grey histograms (see
+                   Database.grey_histograms)
+        Returns :
+            The FeatureMatrix of the store, with the rows of
+            FeatureMatrix.from_histograms, the tombstones left out
+        """
+        live = store.live_mask()
+        size = int(live.sum())
+        is_color = (np.zeros(size, dtype = bool) if grey
+                    else np.array(store.is_color)[live])
+        colors = np.empty((int(is_color.sum()), 3 * bins), dtype = np.uint32)
+        greys = np.empty((size, bins), dtype = np.uint32)
+        pixels = np.empty(size, dtype = np.int64)
+        step = max(1, _CHUNK // (3 * bins))
+        #the first row and the first color row of the chunk in the matrices
+        row = 0
+        first = 0
+        for start in range(0, len(store), step):
+            end = min(len(store), start + step)
+            #the tombstones are left out
+            kept = live[start:end]
+            last = row + int(kept.sum())
+            if grey:
+                counts = store.levels("greys", bins, start, end)[kept]
+                greys[row:last] = counts
+            else:
+                counts = store.levels("colors", bins, start, end)[kept]
+                color = is_color[row:last]
+                colors[first:first+int(color.sum())] = counts[color].reshape(
+                    -1, 3 * bins)
+                first += int(color.sum())
+                #the other channels of the grey rows are empty
+                greys[row:last] = counts.sum(axis = 1, dtype = np.uint32)
+                counts = counts[:, 0]
+            pixels[row:last] = counts.sum(axis = -1, dtype = np.int64)
+            row = last
+        return FeatureMatrix([store.paths[i] for i in np.flatnonzero(live)],
+                             bins, is_color, colors, greys, pixels)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def scores(self, histo) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the match value (see Algorithm.match_value) of a query with
+        every row of the matrix.
+        =======================================================================
+        Argument :
+            histo : The Histogram or CompactHistogram of the query, with the
+                    bins of the matrix
+        Returns :
+            The (N,) array of the match values, in the order of paths
+        """
+        return self.score_matrix([histo])[0]
+
+    def score_matrix(self, histos) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the match values of a batch of queries with every row of the
+        matrix. Each chunk of the matrix is read once for the whole batch.
+        =======================================================================
+        Argument :
+            histos : The Histograms or CompactHistograms of the Q queries,
+                     with the bins of the matrix
+        Returns :
+            The (Q, N) array of the match values, row q holding the ones of
+            the query q in the order of paths
+        """
+        queries = [_compact(histo, self.bins) for histo in histos]
+        res = np.empty((len(queries), len(self)))
+        color = [q for q in range(len(queries)) if queries[q].is_color()]
+        grey = [q for q in range(len(queries)) if not queries[q].is_color()]
+        if color:
+            rows = ~self.is_color
+            res[np.ix_(color, self.is_color)] = self._score_kind(
+                "color", [queries[q].counts for q in color])
+            res[np.ix_(color, rows)] = self._score_kind(
+                "grey rows", [queries[q].grey().counts for q in color])
+        if grey:
+            res[grey] = self._score_kind("grey", [queries[q].grey().counts
+                                                  for q in grey])
+        return res
+
+    def _score_kind(self, kind, images) -> np.ndarray:
+        """
+        Compute the match values of the counts of queries with the rows of a
+        kind (see _kind)
+        """
+        rows, models = self._kind(kind)
+        return _score_matrix(images, models, self.pixels[rows])
+
+    def normalized(self, kind) -> np.ndarray:
+        """
+        =======================================================================
+        Return the counts of the rows scored by a kind of query (see _kind),
+        each channel divided by its sum (see Kernels.normalize), built once
+        per matrix.
+        =======================================================================
+        """
+        if kind not in self._normalized:
+            self._normalized[kind] = Kernels.normalize(self._kind(kind)[1])
+        return self._normalized[kind]
+
+    def distance_matrix(self, histos, kernel) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the distances of a batch of queries with every row of the
+        matrix for a kernel of Kernels, the counts of the queries and of the
+        rows being normalized. As for the match values, a color query is
+        compared with the grey rows through its grey counts.
+        =======================================================================
+        Arguments :
+            histos : The Histograms or CompactHistograms of the Q queries,
+                     with the bins of the matrix
+            kernel : The Kernel, or its name in Kernels.KERNELS
+        Returns :
+            The (Q, N) array of the distances, row q holding the ones of the
+            query q in the order of paths
+        """
+        kernel = Kernels.get(kernel)
+        queries = [_compact(histo, self.bins) for histo in histos]
+        res = np.empty((len(queries), len(self)))
+        color = [q for q in range(len(queries)) if queries[q].is_color()]
+        grey = [q for q in range(len(queries)) if not queries[q].is_color()]
+        for kind, members, counts in [
+                ("color", color, [queries[q].counts for q in color]),
+                ("grey rows", color, [queries[q].grey().counts
+                                      for q in color]),
+                ("grey", grey, [queries[q].grey().counts for q in grey])]:
+            rows = self._kind(kind)[0]
+            if members and len(rows):
+                res[np.ix_(members, rows)] = kernel.matrix(
+                    Kernels.normalize(np.stack(counts)),
+                    self.normalized(kind))
+        return res
+
+    def subset(self, rows) -> "FeatureMatrix":
+        """
+        =======================================================================
+        Return the FeatureMatrix of some rows of the matrix, in the order
+        given.
+        =======================================================================
+        """
+        rows = np.asarray(rows, dtype = np.intp)
+        #the index of each color row among the color rows
+        colors = np.cumsum(self.is_color) - 1
+        kept = rows[self.is_color[rows]]
+        return FeatureMatrix([self.paths[i] for i in rows], self.bins,
+                             self.is_color[rows], self.colors[colors[kept]],
+                             self.greys[rows], self.pixels[rows])
+
+    def rows(self, start, end) -> "FeatureMatrix":
+        """
+        =======================================================================
+        Return the FeatureMatrix of the rows start to end, as views on the
+        arrays of this one.
+        =======================================================================
+        """
+        first = int(np.count_nonzero(self.is_color[:start]))
+        last = first + int(np.count_nonzero(self.is_color[start:end]))
+        return FeatureMatrix(self.paths[start:end], self.bins,
+                             self.is_color[start:end], self.colors[first:last],
+                             self.greys[start:end], self.pixels[start:end])
+
+    def _kind(self, kind) -> tuple:
+        """
+        Return the indexes and the (rows, channels, bins) counts of the rows
+        scored by a kind of query :
+            "color" : the color rows, against a color query
+            "grey rows" : the grey rows, against the grey of a color query
+            "grey" : every row by its grey counts, against a grey query
+        """
+        if kind == "color":
+            return (np.flatnonzero(self.is_color),
+                    self.colors.reshape(-1, 3, self.bins))
+        if kind == "grey rows":
+            rows = np.flatnonzero(~self.is_color)
+            return rows, self.greys[rows, np.newaxis]
+        return np.arange(len(self)), self.greys[:, np.newaxis]
+
+    def _select(self, histo, depth, select, stats) -> tuple:
+        """
+        Run select(kind, indexes, counts, query, depth, stats) on each kind
+        of rows a query is scored against (see _kind), select returning the
+        indexes it keeps among them and their match values, and gather the
+        rows kept in increasing order
+        """
+        query = _compact(histo, self.bins)
+        if query.is_color():
+            parts = [("color", query.counts),
+                     ("grey rows", query.grey().counts)]
+        else:
+            parts = [("grey", query.grey().counts)]
+        rows, scores = [], []
+        for kind, counts in parts:
+            subset, models = self._kind(kind)
+            if len(subset) == 0:
+                continue
+            kept, values = select(kind, subset, models, counts, depth, stats)
+            rows.append(subset[kept])
+            scores.append(values)
+        if not rows:
+            return np.zeros(0, dtype = np.intp), np.zeros(0)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        order = np.argsort(rows, kind = "stable")
+        return rows[order], scores[order]
+
+    def postings(self, kind) -> "PostingIndex":
+        """
+        =======================================================================
+        Return the PostingIndex of the rows scored by a kind of query (see
+        _kind), built once per matrix.
+        =======================================================================
+        """
+        if kind not in self._postings:
+            rows, counts = self._kind(kind)
+            self._postings[kind] = PostingIndex(counts, self.pixels[rows])
+        return self._postings[kind]
+
+    def incremental(self, histo, depth, stats = None) -> tuple:
+        """
+        =======================================================================
+        Find the rows that may be among the depth best matches of a query by
+        incremental intersection (see PostingIndex.candidates), and score
+        them exactly.
+        =======================================================================
+        Arguments :
+            histo : The Histogram or CompactHistogram of the query, with the
+                    bins of the matrix
+            depth : The number of best matches looked for
+            stats : A dictionary in which the counters of the PostingIndex
+                    are added, if given
+        Returns :
+            A tuple (rows, scores) : the increasing indexes of the rows kept,
+            and their match values. They hold every row whose match value is
+            at least the one of the depth-th best match.
+        """
+        def select(kind, subset, models, query, depth, stats):
+            index = self.postings(kind)
+            kept = index.candidates(query, depth, stats)
+            return kept, _scores(query, models[kept], index.pixels[kept])
+        return self._select(histo, depth, select, stats)
+
+    def summary(self, kind) -> np.ndarray:
+        """
+        =======================================================================
+        Return the (rows, channels, SUMMARY_BINS) counts of the rows scored
+        by a kind of query (see _kind), each summing consecutive bins (see
+        _summary), built once per matrix.
+        =======================================================================
+        """
+        if kind not in self._summaries:
+            self._summaries[kind] = _summary(self._kind(kind)[1])
+        return self._summaries[kind]
+
+    def cascade(self, histo, depth, stats = None) -> tuple:
+        """
+        =======================================================================
+        Find the rows among the depth best matches of a query with a cascade
+        of two stages :
+            - every row is first scored on its summary (see summary) : the
+              sum of the minimums of groups of bins is at least the sum of
+              the minimums of their bins, so this coarse match value bounds
+              the full one from above;
+            - the rows are then scored at full resolution by increasing
+              distance bound, until the bound of the next ones is worse
+              than the depth-th best distance found.
+        =======================================================================
+        Arguments :
+            histo : The Histogram or CompactHistogram of the query, with the
+                    bins of the matrix
+            depth : The number of best matches looked for
+            stats : A dictionary in which "coarse" (rows scored on their
+                    summary), "full" (rows scored at full resolution) and
+                    "rows" (rows of the matrix) are added, if given
+        Returns :
+            A tuple (rows, scores) : the increasing indexes of the rows
+            scored at full resolution, and their match values. They hold
+            every row whose match value is at least the one of the depth-th
+            best match.
+        """
+        def select(kind, subset, models, query, depth, stats):
+            pixels = self.pixels[subset]
+            coarse = Algorithm.intersection_scores(_summary(query),
+                                                   self.summary(kind), pixels)
+            #computed as the distances of the full match values, the bounds
+            #are never above them
+            bounds = np.where(coarse < 100, 100 - coarse, 0)
+            order = np.argsort(bounds, kind = "stable")
+            step = max(depth, _CASCADE_STEP)
+            kept, values, kth = [], [], np.inf
+            for start in range(0, len(order), step):
+                rows = order[start:start+step]
+                rows = rows[bounds[rows] <= kth]
+                if len(rows) == 0:
+                    break
+                kept.append(rows)
+                values.append(_scores(query, models[rows], pixels[rows]))
+                distances = np.abs(100 - np.concatenate(values))
+                if depth > 0 and len(distances) >= depth:
+                    kth = np.partition(distances, depth - 1)[depth - 1]
+            kept = np.concatenate(kept) if kept else np.zeros(0, np.intp)
+            values = np.concatenate(values) if values else np.zeros(0)
+            if stats is not None:
+                for name, value in [("coarse", len(subset)),
+                                    ("full", len(kept)),
+                                    ("rows", len(subset))]:
+                    stats[name] = stats.get(name, 0) + value
+            return kept, values
+        return self._select(histo, depth, select, stats)
+
+class QuantizedMatrix(FeatureMatrix):
+    """
+    ===========================================================================
+    Class holding the histograms of a FeatureMatrix quantized to a storage
+    type of Quantization.DTYPES (see Quantization). It is scored like a
+    FeatureMatrix, with the match values, and compared with the kernels of
+    Kernels on the quantized distributions. The INCREMENTAL_INTERSECTION
+    and CASCADE modes need the counts, so they are not served by it.
+    ===========================================================================
+    Attributes :
+        The ones of FeatureMatrix, colors and greys holding the quantized
+        rows, and
+        dtype : the name of the storage type
+        total : the total of a channel of a row
+        color_sums : the (number of color rows, 3) numbers of values
+                     counted in the channels of the color rows
+        grey_sums : the (N, 1) numbers of values counted in the grey rows
+    """
+    def __init__(self, paths, bins, is_color, colors, greys, pixels, dtype,
+                 color_sums, grey_sums):
+        super().__init__(paths, bins, is_color, colors, greys, pixels)
+        self.dtype = dtype
+        self.total = Quantization.DTYPES[dtype][1]
+        self.color_sums = np.asarray(color_sums, dtype = np.int64)
+        self.grey_sums = np.asarray(grey_sums, dtype = np.int64)
+
+    def from_matrix(matrix, dtype):
+        """
+        =======================================================================
+        Quantize the rows of a FeatureMatrix.
+        =======================================================================
+        Arguments :
+            matrix : The FeatureMatrix
+            dtype : The name of the storage type, one of
+                    Quantization.DTYPES
+        Returns :
+            The QuantizedMatrix of the rows
+        """
+        colors, color_sums = Quantization.quantize(
+            matrix.colors.reshape(-1, 3, matrix.bins), dtype)
+        greys, grey_sums = Quantization.quantize(
+            matrix.greys[:, np.newaxis], dtype)
+        color_sums = color_sums.reshape(-1, 3)
+        return QuantizedMatrix(matrix.paths, matrix.bins, matrix.is_color,
+                               colors.reshape(len(colors), -1), greys[:, 0],
+                               matrix.pixels, dtype, color_sums, grey_sums)
+
+    def nbytes(self) -> int:
+        """
+        =======================================================================
+        Return the size in bytes of the rows.
+        =======================================================================
+        """
+        return self.colors.nbytes + self.greys.nbytes
+
+    def _score_kind(self, kind, images) -> np.ndarray:
+        rows, codes = self._kind(kind)
+        sums = (self.color_sums if kind == "color" else self.grey_sums[rows])
+        return Quantization.score_matrix(images, codes, sums,
+                                         self.pixels[rows], self.total)
+
+    def subset(self, rows) -> "QuantizedMatrix":
+        rows = np.asarray(rows, dtype = np.intp)
+        colors = np.cumsum(self.is_color) - 1
+        kept = colors[rows[self.is_color[rows]]]
+        return QuantizedMatrix([self.paths[i] for i in rows], self.bins,
+                               self.is_color[rows], self.colors[kept],
+                               self.greys[rows], self.pixels[rows],
+                               self.dtype, self.color_sums[kept],
+                               self.grey_sums[rows])
+
+    def rows(self, start, end) -> "QuantizedMatrix":
+        first = int(np.count_nonzero(self.is_color[:start]))
+        last = first + int(np.count_nonzero(self.is_color[start:end]))
+        return QuantizedMatrix(self.paths[start:end], self.bins,
+                               self.is_color[start:end],
+                               self.colors[first:last],
+                               self.greys[start:end], self.pixels[start:end],
+                               self.dtype, self.color_sums[first:last],
+                               self.grey_sums[start:end])
+
+    def incremental(self, histo, depth, stats = None):
+        raise ValueError("The incremental intersection needs the counts, "+
+                         "it can not use a QuantizedMatrix.")
+
+    def cascade(self, histo, depth, stats = None):
+        raise ValueError("The cascade needs the counts, it can not use a "+
+                         "QuantizedMatrix.")
+
+class PostingIndex:
+    """
+    ===========================================================================
+    Class holding the counts of N histograms as posting lists, for the
+    incremental intersection of Swain and Ballard : for each (channel, bin),
+    the histograms with a non zero count in that bin, by decreasing count.
+    A query visits its bins from the largest to the smallest and stops as
+    soon as the best matches are known, while the bins it did not visit can
+    not change them anymore.
+    ===========================================================================
+    Attributes :
+        counts : the (N, channels, bins) counts
+        pixels : (N,) number of pixels of each histogram
+        totals : the (channels, N) sums of the counts of each channel
+        indptr : the postings of the flat bin j are rows[indptr[j]:indptr[j+1]]
+        rows, values : the rows and counts of all the postings
+    """
+    #Part of the postings read after which the visit is given up, every row
+    #being scored by the exhaustive kernel instead
+    BUDGET = 0.25
+
+    def __init__(self, counts, pixels):
+        self.counts = counts
+        self.pixels = np.asarray(pixels, dtype = np.int64)
+        self.totals = counts.sum(axis = 2, dtype = np.int64).T
+        flat = counts.reshape(len(counts), counts[0].size if len(counts)
+                              else 0).T
+        keys, rows = np.nonzero(flat)
+        values = flat[keys, rows].astype(np.int64)
+        #np.nonzero sorts by bin then row, a stable sort of the bin and the
+        #decreasing count keeps the rows in order for equal counts
+        top = values.max() + 1 if len(values) else 1
+        order = np.argsort(keys * top + (top - 1 - values), kind = "stable")
+        self.rows = rows[order].astype(np.intp)
+        self.values = values[order]
+        self.indptr = np.searchsorted(keys[order], np.arange(len(flat) + 1))
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def _bounds(self, low, high) -> tuple:
+        """
+        The smallest and largest distances abs(100 - match value) of rows
+        whose (channels, N) sums of minimums lie between low and high,
+        computed with the operations of the exhaustive retrieval so that
+        they bound its results exactly
+        """
+        low = (low / self.pixels).min(axis = 0) * 100
+        high = (high / self.pixels).min(axis = 0) * 100
+        #a match value above 100 is possible against a derived grey
+        best = np.where(high < 100, 100 - high,
+                        np.where(low > 100, low - 100, 0))
+        worst = np.maximum(np.abs(100 - low), np.abs(100 - high))
+        return best, worst
+
+    def candidates(self, query, depth, stats = None) -> np.ndarray:
+        """
+        =======================================================================
+        Find the rows that may be among the depth best matches of a query.
+        The bins of the query are visited by decreasing count, adding the
+        minimum of the query and of each posting to the partial sums of its
+        row. At any time the remaining bins of a channel add at most the
+        smallest of what is left of the query and of the row in it, which
+        bounds the distance of every row from both sides. The visit stops
+        once the depth rows with the best bounds are strictly better than
+        all the other rows can still be.
+        =======================================================================
+        Arguments :
+            query : The (channels, bins) counts of the query
+            depth : The number of best matches looked for
+            stats : A dictionary in which "bins" (query bins visited),
+                    "postings" (postings read), "candidates" (rows met in
+                    the postings), "rows" (rows of the index) and "scored"
+                    (rows kept) are added, if given
+        Returns :
+            The increasing indexes of the rows kept : exactly the depth best
+            ones when the visit stopped early, else all the rows (when the
+            visit reads more than BUDGET of the postings, it is given up).
+        """
+        query = np.asarray(query, dtype = np.int64)
+        channels, bins = query.shape
+        partial = np.zeros((channels, len(self)), dtype = np.int64)
+        seen = np.zeros((channels, len(self)), dtype = np.int64)
+        left = query.sum(axis = 1)
+        flat = query.reshape(-1)
+        order = np.argsort(-flat, kind = "stable")
+        order = order[flat[order] > 0]
+        kept = np.arange(len(self))
+        visited, postings, check = 0, 0, 1
+        if depth <= 0 or depth >= len(self):
+            #every row is kept anyway
+            order = order[:0]
+        for key in order:
+            channel = key // bins
+            start, end = self.indptr[key], self.indptr[key+1]
+            rows = self.rows[start:end]
+            values = self.values[start:end]
+            partial[channel, rows] += np.minimum(flat[key], values)
+            seen[channel, rows] += values
+            left[channel] -= flat[key]
+            visited += 1
+            postings += int(end - start)
+            over = postings > self.BUDGET * len(self.rows)
+            if visited < check and not over:
+                continue
+            check *= 2
+            best, worst = self._bounds(partial, partial + np.minimum(
+                left[:, np.newaxis], self.totals - seen))
+            top = np.argpartition(worst, depth - 1)[:depth]
+            others = np.ones(len(self), dtype = bool)
+            others[top] = False
+            if worst[top].max() < best[others].min():
+                kept = np.sort(top)
+                break
+            if over:
+                break
+        if stats is not None:
+            for name, value in [("bins", visited), ("postings", postings),
+                                ("candidates",
+                                 int(np.count_nonzero(seen.any(axis = 0)))),
+                                ("rows", len(self)),
+                                ("scored", len(kept))]:
+                stats[name] = stats.get(name, 0) + value
+        return kept
+
+class AxesMatrix:
+    """
+    ===========================================================================
+    Class holding the color axes vectors (see Histogram.color_axes) of all
+    the images of a database as a single (N, dimensions) matrix, and the
+    MetricTree indexing them if there is one.
+    ===========================================================================
+    """
+    def __init__(self, paths, vectors, tree = None):
+        self.paths = list(paths)
+        self.vectors = np.ascontiguousarray(vectors, dtype = np.float64)
+        self.tree = tree
+
+    def from_tree(tree):
+        """
+        =======================================================================
+        Build the matrix of the rows of a MetricTree
+        =======================================================================
+        """
+        return AxesMatrix(tree.paths, tree.vectors, tree)
+
+    def from_vectors(entries):
+        """
+        =======================================================================
+        Build the matrix from couples (path to image, color axes vector),
+        such as the ones Database.bin_histograms yields.
+        =======================================================================
+        """
+        paths, vectors = [], []
+        for path, vector in entries:
+            paths.append(path)
+            vectors.append(np.asarray(vector, dtype = np.float64))
+        return AxesMatrix(paths, np.stack(vectors) if vectors
+                          else np.zeros((0, 40)))
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def distances(self, vector) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the euclidean distance (see Algorithm.euclidean_dist) between
+        a color axes vector and every row of the matrix.
+        =======================================================================
+        """
+        return self.distance_matrix([vector])[0]
+
+    def distance_matrix(self, vectors, kernel = None) -> np.ndarray:
+        """
+        =======================================================================
+        Compute the euclidean distances between a batch of Q color axes
+        vectors and every row of the matrix, as a (Q, N) array, or their
+        distances for a kernel of Kernels if one is given.
+        =======================================================================
+        """
+        vectors = [np.asarray(vector, dtype = np.float64)
+                   for vector in vectors]
+        if kernel is not None:
+            return Kernels.get(kernel).matrix(
+                np.stack(vectors) if vectors else
+                np.zeros((0, self.vectors.shape[1])), self.vectors)
+        res = np.empty((len(vectors), len(self)))
+        step = max(1, _CHUNK // max(1, self.vectors.shape[1]))
+        for start in range(0, len(self), step):
+            chunk = self.vectors[start:start+step]
+            for q, vector in enumerate(vectors):
+                res[q, start:start+step] = np.sqrt(np.sum(
+                    (chunk - vector) ** 2, axis = 1))
+        return np.around(res, decimals = 4)
+
+    def nearest(self, vector, depth, stats = None) -> tuple:
+        """
+        =======================================================================
+        Find the rows that may be among the depth nearest to a color axes
+        vector with the MetricTree (see MetricTree.candidates), or all the
+        rows without one, and their distances.
+        =======================================================================
+        Returns :
+            A tuple (rows, distances) : the increasing indexes of the rows
+            kept and their distances (see distances)
+        """
+        if self.tree is None:
+            return np.arange(len(self)), self.distances(vector)
+        rows = self.tree.candidates(vector, depth, stats)
+        return rows, AxesMatrix([self.paths[i] for i in rows],
+                                self.vectors[rows]).distances(vector)
+
+def _summary(counts) -> np.ndarray:
+    """
+    Sum the counts (..., bins) over SUMMARY_BINS groups of consecutive bins
+    """
+    counts = np.asarray(counts)
+    edges = np.linspace(0, counts.shape[-1], SUMMARY_BINS + 1).astype(int)
+    edges = np.unique(edges[:-1])
+    return np.add.reduceat(counts, edges, axis = -1, dtype = np.int64)
+
+def _scores(image, models, pixels) -> np.ndarray:
+    """
+    Score an image against stacked models, about _CHUNK counts at a time
+    """
+    return _score_matrix([image], models, pixels)[0]
+
+def _score_matrix(images, models, pixels) -> np.ndarray:
+    """
+    Score every image against stacked models, about _CHUNK counts of the
+    models at a time, each chunk being scored against all the images while
+    it is in the cache
+    """
+    res = np.empty((len(images), len(models)))
+    step = max(1, _CHUNK // max(1, models[0].size if len(models) else 1))
+    for start in range(0, len(models), step):
+        end = start + step
+        for q, image in enumerate(images):
+            res[q, start:end] = Algorithm.intersection_scores(
+                image, models[start:end], pixels[start:end])
+    return res
+
+def _version(database):
+    """
+    Return what changes when the histograms of the database change
+    """
+    return database.version()
+
+def features(database, mode = INTERSECTION, bins = 255, dtype = None):
+    """
+    ===========================================================================
+    Return the matrix of the features of a database for a mode of retrieval.
+    It is loaded once per process, and again only if the database changed.
+    ===========================================================================
+    Arguments :
+        database : The Database
+        mode : INTERSECTION (color histograms), GREY (grey histograms),
+               INCREMENTAL (color axes vectors, with the MetricTree of the
+               database), INCREMENTAL_INTERSECTION, APPROXIMATE, CASCADE or
+               CLUSTERED (the matrix of INTERSECTION, see
+               FeatureMatrix.incremental, approximate_index,
+               FeatureMatrix.cascade and cluster_index)
+        bins : The number of bins of the histograms
+        dtype : The name of a storage type of Quantization.DTYPES, the
+                histograms being quantized to it, if given
+    Returns :
+        A FeatureMatrix, a QuantizedMatrix if dtype is given, or an
+        AxesMatrix for the INCREMENTAL mode
+    """
+    assert mode in MODES, {f"features : the mode {mode} does not exist, it "+
+                           f"must be one of {MODES}"}.pop()
+    if mode in (INCREMENTAL_INTERSECTION, APPROXIMATE, CASCADE, CLUSTERED):
+        #the postings, the candidates, the summaries and the clusters come
+        #from the intersection matrix
+        mode = INTERSECTION
+    assert dtype is None or mode != INCREMENTAL, {"features : the color axes "+
+                                                  "vectors are not "+
+                                                  "quantized"}.pop()
+    key = (database.get_dir(), mode, None if mode == INCREMENTAL else bins)
+    if dtype is not None:
+        key += (dtype,)
+    version = _version(database)
+    if key in _loaded and _loaded[key][0] == version:
+        return _loaded[key][1]
+    if dtype is not None:
+        matrix = QuantizedMatrix.from_matrix(
+            features(database, mode, bins), dtype)
+    elif mode == INCREMENTAL:
+        matrix = AxesMatrix.from_tree(database.metric_tree())
+    elif database.store() is None:
+        matrix = FeatureMatrix.from_histograms([], bins)
+    else:
+        matrix = FeatureMatrix.from_store(database.store(), bins,
+                                          mode == GREY)
+    _loaded[key] = (version, matrix)
+    return matrix
+
+def approximate_index(database, subquantizers = 16):
+    """
+    ===========================================================================
+    Return the ApproximateIndex of a database (see Database.ann_index),
+    loaded once per process, and again only if the database changed.
+    ===========================================================================
+    """
+    key = (database.get_dir(), APPROXIMATE, subquantizers)
+    version = _version(database)
+    if key not in _loaded or _loaded[key][0] != version:
+        _loaded[key] = (version, database.ann_index(
+            subquantizers = subquantizers))
+    return _loaded[key][1]
+
+def shard_pool(database, mode = INTERSECTION, bins = 255, workers = None,
+               shard_size = None, dtype = None):
+    """
+    ===========================================================================
+    Return the ShardPool scoring the matrix of a database for a mode (see
+    features). It is started once per process and kept for the next
+    queries, and started again only if the database or its parameters
+    changed.
+    ===========================================================================
+    Arguments :
+        database : The Database
+        mode : INTERSECTION or GREY
+        bins : The number of bins of the histograms
+        workers, shard_size : see ShardPool.ShardPool
+        dtype : The storage type of the matrix, see features
+    """
+    assert mode in (INTERSECTION, GREY), {f"shard_pool : the mode {mode} "+
+                                          "can not be sharded"}.pop()
+    key = (database.get_dir(), mode, bins, dtype)
+    version = _version(database)
+    if key in _pools:
+        old, pool = _pools[key]
+        if (old == version and (workers is None or pool.workers == workers)
+            and (shard_size is None or pool.shard_size == shard_size)):
+            return pool
+        pool.close()
+        del _pools[key]
+    pool = ShardPool.ShardPool(features(database, mode, bins, dtype),
+                               workers, shard_size)
+    _pools[key] = (version, pool)
+    return pool
+
+def close_pools() -> None:
+    """
+    ===========================================================================
+    Stop every ShardPool started by shard_pool. It is done when the process
+    exits.
+    ===========================================================================
+    """
+    for _, pool in _pools.values():
+        pool.close()
+    _pools.clear()
+
+atexit.register(close_pools)
+
+def cluster_index(database, clusters = None):
+    """
+    ===========================================================================
+    Return the ClusterIndex of a database (see Database.cluster_index),
+    loaded once per process, and again only if the database changed.
+    ===========================================================================
+    """
+    key = (database.get_dir(), CLUSTERED)
+    version = _version(database)
+    if (key not in _loaded or _loaded[key][0] != version or
+        (clusters is not None and
+         len(_loaded[key][1].centroids) != clusters)):
+        _loaded[key] = (version, database.cluster_index(clusters))
+    return _loaded[key][1]
+
+def _clustered(matrix, index, histo, depth, nclusters, stats) -> list:
+    """
+    Score exactly the images of the nclusters clusters closest to a query
+    """
+    assert len(index) == len(matrix), {"The ClusterIndex and the "+
+                                       "histograms do not match"}.pop()
+    rows = index.rows(index.nearest(ApproximateIndex.vector(histo),
+                                    nclusters), stats)
+    candidates = matrix.subset(rows)
+    return top_k(np.abs(100 - candidates.scores(histo)), candidates.paths,
+                 depth)
+
+def _approximate(matrix, index, histo, depth, nprobe, stats) -> list:
+    """
+    Score exactly the best candidates of the ApproximateIndex for a query
+    """
+    assert len(index) == len(matrix), {"The ApproximateIndex and the "+
+                                       "histograms do not match"}.pop()
+    rows = index.candidates(ApproximateIndex.vector(histo),
+                            max(1, depth * RERANK), nprobe, stats)
+    candidates = matrix.subset(rows)
+    return top_k(np.abs(100 - candidates.scores(histo)), candidates.paths,
+                 depth)
+
+def recall(database, depth = 15, nprobe = 8, subquantizers = 16,
+           queries = None, samples = 100, bins = 255) -> float:
+    """
+    ===========================================================================
+    Measure the recall at depth of the APPROXIMATE mode : the part of the
+    depth images the exhaustive INTERSECTION returns that it returns too.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        depth : The number of images returned per query
+        nprobe, subquantizers : The parameters of the APPROXIMATE mode
+        queries : The Histograms of the queries. By default, samples images
+                  of the database chosen at random are the queries.
+        samples : The number of images of the database used as queries
+        bins : The number of bins of the default queries
+    Returns :
+        The mean recall of the queries, between 0 and 1
+    """
+    if queries is None:
+        matrix = features(database, INTERSECTION, bins)
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(matrix), min(samples, len(matrix)),
+                          replace = False)
+        histograms = [level for path, level in database.histograms(bins)]
+        queries = [histograms[i] for i in rows]
+    res = []
+    for histo in queries:
+        matrix = features(database, INTERSECTION, histo.bins)
+        exact = top_k(np.abs(100 - matrix.scores(histo)), matrix.paths, depth)
+        if not exact:
+            continue
+        found = _approximate(matrix, approximate_index(database,
+                                                       subquantizers),
+                             histo, depth, nprobe, None)
+        res.append(len({p for _, p in exact} & {p for _, p in found}) /
+                   len(exact))
+    return float(np.mean(res)) if res else 1.0
+
+def quantization_error(database, dtype, depth = 15, queries = None,
+                       samples = 100, bins = 255, mode = INTERSECTION) -> dict:
+    """
+    ===========================================================================
+    Measure what the quantization of the histograms to a storage type costs
+    in accuracy and saves in memory, against the exact counts.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        dtype : The name of a storage type of Quantization.DTYPES
+        depth : The number of images returned per query
+        queries : The Histograms of the queries. By default, samples images
+                  of the database chosen at random are the queries.
+        samples : The number of images of the database used as queries
+        bins : The number of bins of the default queries
+        mode : INTERSECTION or GREY
+    Returns :
+        A dictionary of "max" and "mean" (the largest and the mean absolute
+        difference of the match values), "recall" (the mean part of the
+        depth images of the exact search that the quantized one returns
+        too), "bytes" and "exact bytes" (the sizes of the rows of the
+        matrices of the last queries)
+    """
+    if queries is None:
+        matrix = features(database, mode, bins)
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(matrix), min(samples, len(matrix)),
+                          replace = False)
+        histograms = [level for path, level in database.histograms(bins)]
+        queries = [histograms[i] for i in rows]
+    res = {"max": 0.0, "mean": 0.0, "recall": 1.0, "bytes": 0,
+           "exact bytes": 0}
+    deltas, recalls = [], []
+    for histo in queries:
+        exact = features(database, mode, histo.bins)
+        quantized = features(database, mode, histo.bins, dtype)
+        scores, approximate = exact.scores(histo), quantized.scores(histo)
+        delta = np.abs(approximate - scores)
+        deltas.append(delta[np.isfinite(delta)])
+        found = top_k(np.abs(100 - scores), exact.paths, depth)
+        if found:
+            kept = top_k(np.abs(100 - approximate), quantized.paths, depth)
+            recalls.append(len({p for _, p in found} & {p for _, p in kept})
+                           / len(found))
+        res["bytes"] = quantized.nbytes()
+        res["exact bytes"] = exact.colors.nbytes + exact.greys.nbytes
+    deltas = np.concatenate([np.zeros(0)] + deltas)
+    if len(deltas):
+        res["max"], res["mean"] = float(deltas.max()), float(deltas.mean())
+    if recalls:
+        res["recall"] = float(np.mean(recalls))
+    return res
+
+def best_rows(values, depth) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the increasing indexes of the values up to the depth-th smallest
+    one, ties included : the only ones top_k can keep. The top_k of the
+    best_rows of parts of some values, put together in order, is the top_k
+    of the values.
+    ===========================================================================
+    """
+    if depth <= 0:
+        return np.zeros(0, dtype = np.intp)
+    if depth >= len(values):
+        return np.arange(len(values))
+    kth = values[np.argpartition(values, depth - 1)[:depth]].max()
+    return np.flatnonzero(values <= kth)
+
+def top_k(values, paths, depth) -> list:
+    """
+    ===========================================================================
+    Select the depth smallest values with np.argpartition.
+    ===========================================================================
+    Arguments :
+        values : (N,) array of values
+        paths : the N paths associated to the values
+        depth : the number of values kept
+    Returns :
+        The list of the depth smallest (value, path), sorted. Equal values
+        are kept the way the former sequential retrieval did.
+    """
+    if depth <= 0 or len(values) == 0:
+        return []
+    result = []
+    rows = best_rows(values, depth)
+    for i in rows:
+        item = (float(values[i]), paths[i])
+        if len(result) < depth:
+            bisect.insort(result, item)
+        elif item[0] < result[-1][0]:
+            del(result[-1])
+            bisect.insort(result, item)
+    return result
+
+def search(database, histoImage, depth = 15, mode = INTERSECTION,
+           stats = None, nprobe = 8, subquantizers = 16,
+           kernel = None, workers = None, shard_size = None,
+           nclusters = 4, dtype = None) -> list:
+    """
+    ===========================================================================
+    Find the images of the database closest to the query, by scoring it
+    against the whole feature matrix at once, or only against the candidates
+    of the incremental intersection for INCREMENTAL_INTERSECTION and of the
+    coarse summaries for CASCADE.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        histoImage : The Histogram object of the image
+        depth : The number of images returned
+        mode : INTERSECTION, GREY, INCREMENTAL, INCREMENTAL_INTERSECTION,
+               APPROXIMATE, CASCADE or CLUSTERED, see features
+        stats : A dictionary in which the counters of the retrieval are
+                added, if given (see PostingIndex.candidates,
+                MetricTree.candidates, ApproximateIndex.candidates,
+                FeatureMatrix.cascade and ClusterIndex.rows)
+        nprobe : The number of lists of the ApproximateIndex visited by
+                 APPROXIMATE
+        subquantizers : The size in bytes of the codes of the
+                        ApproximateIndex used by APPROXIMATE
+        kernel : A Kernel or the name of one in Kernels.KERNELS, comparing
+                 the normalized histograms of INTERSECTION and GREY or the
+                 color axes vectors of INCREMENTAL against the whole
+                 database instead of the default distance, if given
+        workers, shard_size : If workers is given, INTERSECTION and GREY
+                              split the matrix into shards of shard_size
+                              rows scored by workers processes (see
+                              shard_pool), for the same results
+        nclusters : The number of clusters of the ClusterIndex whose images
+                    are scored by CLUSTERED
+        dtype : The name of a storage type of Quantization.DTYPES the
+                histograms are scored in, if given, for every mode but
+                INCREMENTAL, INCREMENTAL_INTERSECTION and CASCADE (see
+                quantization_error)
+    Returns :
+        The depth best matched images as a list of tuples (distance, path) :
+        the distance of the kernel if one is given, else the euclidean
+        distance for INCREMENTAL and abs(100 - match value) otherwise.
+        INCREMENTAL_INTERSECTION and CASCADE return the same list as
+        INTERSECTION, APPROXIMATE the best of the depth * RERANK candidates
+        of the ApproximateIndex (see recall) and CLUSTERED the best images
+        of the nclusters clusters closest to the query.
+    """
+    assert type(histoImage) is Histogram
+    assert dtype is None or mode in (INTERSECTION, GREY, APPROXIMATE,
+                                     CLUSTERED), {f"search : the mode {mode}"+
+                                                  " needs the counts"}.pop()
+    if workers is not None and mode in (INTERSECTION, GREY):
+        return shard_pool(database, mode, histoImage.bins, workers,
+                          shard_size, dtype).search([histoImage], depth,
+                                                    kernel)[0]
+    if kernel is not None:
+        values, paths = score_batch(database, [histoImage], mode, kernel,
+                                    dtype)
+        return top_k(values[0], paths, depth)
+    matrix = features(database, mode, histoImage.bins, dtype)
+    if mode == INCREMENTAL:
+        rows, values = matrix.nearest(Histogram.color_axes(histoImage), depth,
+                                      stats)
+        return top_k(values, [matrix.paths[i] for i in rows], depth)
+    elif mode == APPROXIMATE:
+        return _approximate(matrix, approximate_index(database,
+                                                      subquantizers),
+                            histoImage, depth, nprobe, stats)
+    elif mode == CLUSTERED:
+        return _clustered(matrix, cluster_index(database), histoImage, depth,
+                          nclusters, stats)
+    elif mode in (INCREMENTAL_INTERSECTION, CASCADE):
+        if mode == CASCADE:
+            rows, scores = matrix.cascade(histoImage, depth, stats)
+        else:
+            rows, scores = matrix.incremental(histoImage, depth, stats)
+        return top_k(np.abs(100 - scores), [matrix.paths[i] for i in rows],
+                     depth)
+    else:
+        values = np.abs(100 - matrix.scores(histoImage))
+    return top_k(values, matrix.paths, depth)
+
+def within(database, histoImage, radius, stats = None) -> list:
+    """
+    ===========================================================================
+    Find every image of the database whose color axes vector is at most at
+    radius of the one of the query, with the MetricTree of the database.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        histoImage : The Histogram object of the image
+        radius : The largest euclidean distance returned
+        stats : A dictionary in which the counters of MetricTree.candidates
+                are added, if given
+    Returns :
+        The list of the tuples (distance, path) found, sorted
+    """
+    assert type(histoImage) is Histogram
+    tree = features(database, INCREMENTAL).tree
+    return tree.within(Histogram.color_axes(histoImage), radius, stats)
+
+def score_batch(database, histograms, mode = INTERSECTION,
+                kernel = None, dtype = None) -> tuple:
+    """
+    ===========================================================================
+    Score a batch of queries against the whole database in one pass.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        histograms : The Histogram objects of the Q queries, all with the
+                     same number of bins
+        mode : INTERSECTION, GREY or INCREMENTAL, see features
+        kernel : A Kernel or the name of one in Kernels.KERNELS, see search
+        dtype : The storage type of INTERSECTION and GREY, see search
+    Returns :
+        A tuple (values, paths) : the (Q, N) array of the distances (see
+        search) of every query to the N images, and the paths of the images
+        in the order of the columns
+    """
+    histograms = list(histograms)
+    if not histograms:
+        return np.zeros((0, 0)), []
+    for histo in histograms:
+        assert type(histo) is Histogram
+    bins = histograms[0].bins
+    assert all(histo.bins == bins for histo in histograms), {
+        "score_batch : the queries of a batch must have the same bins"}.pop()
+    assert kernel is None or mode in (INTERSECTION, GREY, INCREMENTAL), {
+        f"score_batch : the mode {mode} can not use a kernel"}.pop()
+    matrix = features(database, mode, bins, dtype)
+    if mode == INCREMENTAL:
+        values = matrix.distance_matrix([Histogram.color_axes(histo)
+                                         for histo in histograms], kernel)
+    elif kernel is not None:
+        values = matrix.distance_matrix(histograms, kernel)
+    else:
+        values = np.abs(100 - matrix.score_matrix(histograms))
+    return values, matrix.paths
+
+def search_batch(database, histograms, depth = 15, mode = INTERSECTION,
+                 batch = 64, kernel = None, workers = None,
+                 shard_size = None, dtype = None):
+    """
+    ===========================================================================
+    Generator finding the images of the database closest to each query of a
+    stream. The queries are scored batch queries at a time (see score_batch),
+    and the results of a query are yielded as soon as its batch is scored.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        histograms : Iterable of the Histogram objects of the queries
+        depth : The number of images returned for each query
+        mode : INTERSECTION, GREY or INCREMENTAL, see features
+        batch : The maximum number of queries scored together
+        kernel : A Kernel or the name of one in Kernels.KERNELS, see search
+        workers, shard_size : The parameters of the ShardPool scoring the
+                              batches of INTERSECTION and GREY, see search
+        dtype : The storage type of INTERSECTION and GREY, see search
+    Yields :
+        For each query, in order, the same list as search would return
+    """
+    assert batch > 0, {"search_batch : batch must be positive"}.pop()
+    pending = []
+    for histo in histograms:
+        if pending and (len(pending) == batch or
+                        pending[0].bins != histo.bins):
+            yield from _top_rows(database, pending, depth, mode, kernel,
+                                 workers, shard_size, dtype)
+            pending = []
+        pending.append(histo)
+    if pending:
+        yield from _top_rows(database, pending, depth, mode, kernel, workers,
+                             shard_size, dtype)
+
+def _top_rows(database, histograms, depth, mode, kernel = None,
+              workers = None, shard_size = None, dtype = None):
+    """
+    Yield the top_k of every row of the score_batch of the histograms, or
+    the results of the ShardPool if workers is given
+    """
+    if workers is not None and mode in (INTERSECTION, GREY):
+        yield from shard_pool(database, mode, histograms[0].bins, workers,
+                              shard_size, dtype).search(histograms, depth,
+                                                        kernel)
+        return
+    values, paths = score_batch(database, histograms, mode, kernel, dtype)
+    for row in values:
+        yield top_k(row, paths, depth)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Segmentation of an image by histogram back-projection (Swain and Ballard) :
+each pixel gets the likelihood that it belongs to the object of a model
+histogram, from the bins its values fall in.
+The likelihood of a bin of a channel is the ratio histogram
+min(model / image, 1), the model and the image being the distributions of
+the model and of the whole image to segment : the colors of the model which
+are rare in the image get 1, the ones the image is full of get little. The
+likelihood of a pixel is the smallest one among its channels, as the match
+value (see Algorithm.match_value) keeps the smallest intersection among the
+channels. When the model or the image is grey, their grey histograms (see
+CompactHistogram.grey) are used, each value of a pixel being looked up in
+the same table.
+The image is read by tiles of rows, twice : once to count its histogram and
+once to look its pixels up, so that an image of any size, such as a
+np.memmap, is segmented in bounded memory when the mask is written to a
+np.memmap too.
+===============================================================================
+"""
+import os
+import numpy as np
+import cv2
+from Histogram import Histogram, CompactHistogram, HistogramPyramid
+from Histogram import bin_lut, value_counts, _bin_matrix
+from Image import Image
+
+#Number of pixels of a tile
+TILE = 1 << 18
+
+#The types of the masks, with the value of a likelihood of 1
+DTYPES = {np.dtype(np.float32): 1.0, np.dtype(np.uint8): 255}
+
+def model_histogram(model, bins, database = None) -> CompactHistogram:
+    """
+    ===========================================================================
+    Return the histogram of a model with bins bins.
+    ===========================================================================
+    Arguments :
+        model : A Histogram, CompactHistogram or HistogramPyramid, an
+                Image, or the path to an image : the histogram stored for
+                it in the database if it is one of its images, else the
+                histogram of the image
+        bins : The number of bins of the histogram
+        database : The Database the stored histograms are looked up in
+    Returns :
+        The CompactHistogram of the model
+    Raises :
+        ValueError if a CompactHistogram can not be rebinned to bins bins
+    """
+    if isinstance(model, str):
+        if database is not None and database.is_computed():
+            path = os.path.abspath(model)
+            for image, histo in database.histograms(bins):
+                if os.path.abspath(image) == path:
+                    return CompactHistogram.from_histogram(histo)
+        model = Image(model)
+    if isinstance(model, Image):
+        model = Histogram(model, bins = bins)
+    if isinstance(model, HistogramPyramid):
+        return model.level(bins)
+    if isinstance(model, Histogram):
+        return (model.compact() if model.bins == bins
+                else model.pyramid().level(bins))
+    return model.rebin(bins)
+
+def _pixels(image) -> np.ndarray:
+    """
+    The (height, width) or (height, width, 3) pixels of an Image or an
+    array, without reading them
+    """
+    pixels = image.getarray() if isinstance(image, Image) else image
+    assert pixels.dtype == np.uint8 and pixels.ndim in (2, 3), {
+        "Segmentation : the pixels must be a (height, width) or (height, "+
+        "width, channels) array of np.uint8"}.pop()
+    if pixels.ndim == 3:
+        #the alpha channel is left out, as in Histogram
+        pixels = pixels[:, :, :3] if pixels.shape[2] > 1 else pixels[:, :, 0]
+    return pixels
+
+def tiles(pixels, tile = TILE):
+    """
+    ===========================================================================
+    Generator of the tiles of an image : its bands of whole rows of about
+    tile pixels, as contiguous arrays.
+    ===========================================================================
+    Arguments :
+        pixels : The (height, width) or (height, width, channels) pixels
+        tile : The number of pixels of a tile
+    Yields :
+        The tuples (first row, pixels of the rows)
+    """
+    rows = max(1, tile // max(1, pixels.shape[1]))
+    for start in range(0, len(pixels), rows):
+        yield start, np.ascontiguousarray(pixels[start:start+rows])
+
+def image_histogram(image, bins, tile = TILE) -> CompactHistogram:
+    """
+    ===========================================================================
+    Count the histogram of an image, tile by tile. It has the counts of the
+    Histogram of the image.
+    ===========================================================================
+    Arguments :
+        image : The Image or its pixels (see backproject)
+        bins : The number of bins of the histogram
+        tile : The number of pixels of a tile
+    Returns :
+        The CompactHistogram of the image
+    """
+    pixels = _pixels(image)
+    channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+    counts = np.zeros((channels, 256), dtype = np.int64)
+    for _, band in tiles(pixels, tile):
+        counts += value_counts(band.reshape(-1, channels))
+    return CompactHistogram(counts @ _bin_matrix(bins),
+                            CompactHistogram.COLOR if channels == 3
+                            else CompactHistogram.GREY)
+
+def likelihoods(model, image, ratio = True) -> np.ndarray:
+    """
+    ===========================================================================
+    Return the likelihood of each bin of each channel (see the module).
+    ===========================================================================
+    Arguments :
+        model : The CompactHistogram of the model
+        image : The CompactHistogram of the image, with the bins of the model
+        ratio : If False, the likelihood of a bin is the one of the model
+                distribution alone, the largest bin of each channel getting 1
+    Returns :
+        The (channels, bins) likelihoods, between 0 and 1, of the channels
+        of the image, or of its grey histogram
+    """
+    assert model.bins == image.bins, {"likelihoods : the model and the "+
+                                      "image must have the same number of "+
+                                      "bins"}.pop()
+    if not (model.is_color() and image.is_color()):
+        model, image = model.grey(), image.grey()
+    model = model.counts.astype(np.float64)
+    totals = model.sum(axis = 1, keepdims = True)
+    if not ratio:
+        return np.divide(model, model.max(axis = 1, keepdims = True),
+                         out = np.zeros_like(model), where = totals > 0)
+    model = np.divide(model, totals, out = np.zeros_like(model),
+                      where = totals > 0)
+    image = image.counts.astype(np.float64)
+    image = image / np.maximum(image.sum(axis = 1, keepdims = True), 1)
+    return np.minimum(np.divide(model, image, out = np.zeros_like(model),
+                                where = image > 0), 1)
+
+def backproject(image, model, bins = 32, ratio = True, tile = TILE,
+                out = None, dtype = np.float32, stats = None) -> np.ndarray:
+    """
+    ===========================================================================
+    Compute the likelihood mask of an image for a model (see the module),
+    tile by tile : each tile is looked up in the table of its 256 values by
+    cv2.LUT.
+    ===========================================================================
+    Arguments :
+        image : The Image, or its (height, width) or (height, width,
+                channels) np.uint8 pixels, which may be a np.memmap
+        model : The model, see model_histogram
+        bins : The number of bins of the histograms
+        ratio : See likelihoods
+        tile : The number of pixels of a tile
+        out : The (height, width) array the mask is written in, such as a
+              np.memmap, by default a new one
+        dtype : The type of the mask when out is not given, np.float32 for
+                likelihoods between 0 and 1, np.uint8 for likelihoods
+                rounded between 0 and 255
+        stats : A dictionary in which "tiles" (tiles looked up) and
+                "pixels" (pixels of the image) are added, if given
+    Returns :
+        The mask, out if it was given
+    Raises :
+        AssertionError if the type of the mask is neither of DTYPES
+    """
+    pixels = _pixels(image)
+    model = model_histogram(model, bins)
+    if out is None:
+        out = np.empty(pixels.shape[:2], dtype = dtype)
+    assert out.dtype in DTYPES, {"backproject : the mask can not be of "+
+                                 f"type {out.dtype}"}.pop()
+    assert out.shape == pixels.shape[:2]
+    table = (likelihoods(model, image_histogram(pixels, bins, tile), ratio)
+             [:, bin_lut(bins)] * DTYPES[out.dtype])
+    if out.dtype == np.uint8:
+        table = np.rint(table)
+    table = table.astype(out.dtype)
+    channels = 1 if pixels.ndim == 2 else 3
+    #cv2 looks every channel up in its own table, or all in a single one
+    table = table.T.reshape(1, 256, len(table))
+    count = 0
+    for start, band in tiles(pixels, tile):
+        values = cv2.LUT(band, table)
+        rows = out[start:start+len(band)]
+        if channels == 1:
+            rows[...] = values
+        else:
+            np.minimum(values[:, :, 0], values[:, :, 1], out = rows)
+            np.minimum(rows, values[:, :, 2], out = rows)
+        count += 1
+    if stats is not None:
+        for name, value in [("tiles", count), ("pixels", out.size)]:
+            stats[name] = stats.get(name, 0) + value
+    return out
+
+def write_mask(mask, path, tile = TILE) -> None:
+    """
+    ===========================================================================
+    Write a mask to a file : a .npy file keeps it as it is, written tile by
+    tile, any other extension is an 8 bits image written by cv2, the
+    likelihoods being scaled between 0 and 255.
+    ===========================================================================
+    Arguments :
+        mask : The mask backproject returned
+        path : The path to the file
+        tile : The number of pixels of a tile
+    Raises :
+        OSError if the image could not be written
+    """
+    if path.endswith(".npy"):
+        out = np.lib.format.open_memmap(path, mode = "w+", dtype = mask.dtype,
+                                        shape = mask.shape)
+        for start, band in tiles(mask, tile):
+            out[start:start+len(band)] = band
+        out.flush()
+        del out
+        return
+    if mask.dtype != np.uint8:
+        mask = np.rint(mask * 255).astype(np.uint8)
+    if not cv2.imwrite(path, mask):
+        raise OSError(f"The mask could not be written to {path}.")
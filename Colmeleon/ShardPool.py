@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import math
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import Retrieval
+
+#The arrays of a FeatureMatrix written for the workers
+_ARRAYS = ("is_color", "colors", "greys", "pixels")
+
+#The arrays a QuantizedMatrix adds
+_QUANTIZED = ("dtype", "color_sums", "grey_sums")
+
+#FeatureMatrix attached by this worker process, by directory
+_attached = {}
+
+def attach(directory, bins):
+    """
+    Return the FeatureMatrix written in directory, memory-mapped : every
+    worker reads the same pages, without copying nor unpickling them
+    """
+    if directory not in _attached:
+        arrays = [np.load(os.path.join(directory, name + ".npy"),
+                          mmap_mode = "r") for name in _ARRAYS]
+        if os.path.exists(os.path.join(directory, "dtype.npy")):
+            dtype, *sums = [np.load(os.path.join(directory, name + ".npy"))
+                            for name in _QUANTIZED]
+            _attached[directory] = Retrieval.QuantizedMatrix(
+                range(len(arrays[3])), bins, *arrays, str(dtype), *sums)
+        else:
+            _attached[directory] = Retrieval.FeatureMatrix(
+                range(len(arrays[3])), bins, *arrays)
+    return _attached[directory]
+
+def _score_shard(directory, bins, start, end, queries, depth, kernel):
+    """
+    Score the queries against the rows start to end of the matrix written
+    in directory, and return for each query the global indexes of the rows
+    that may be among its depth best matches (see Retrieval.best_rows) with
+    their distances
+    """
+    shard = attach(directory, bins).rows(start, end)
+    if kernel is None:
+        values = np.abs(100 - shard.score_matrix(queries))
+    else:
+        values = shard.distance_matrix(queries, kernel)
+    res = []
+    for row in values:
+        kept = Retrieval.best_rows(row, depth)
+        res.append((kept + start, row[kept]))
+    return res
+
+class ShardPool:
+    """
+    ===========================================================================
+    Class scoring queries against a FeatureMatrix split into shards of
+    consecutive rows, each shard being scored by a process of a pool. The
+    matrix is written once to memory-mapped files which the workers attach
+    to, and each worker only sends back the few best rows of its shard,
+    which are merged into the same results as an exhaustive search.
+    The pool and its workers are kept until close is called, so that a long
+    running process pays for them once (see Retrieval.shard_pool).
+    ===========================================================================
+    Attributes :
+        paths : the paths to the images, in the order of the rows
+        bins : the number of bins of the histograms
+        workers : the number of processes of the pool
+        shard_size : the number of rows of a shard
+    """
+    def __init__(self, matrix, workers = None, shard_size = None):
+        """
+        =======================================================================
+        Write the matrix for the workers and start the pool.
+        =======================================================================
+        Arguments :
+            matrix : the FeatureMatrix
+            workers : the number of processes, by default the number of
+                      processors
+            shard_size : the number of rows scored by a task, by default
+                         one shard per worker
+        """
+        self.workers = workers or os.cpu_count() or 1
+        assert self.workers > 0, {"ShardPool : the number of workers must "+
+                                  "be positive"}.pop()
+        self.paths = matrix.paths
+        self.bins = matrix.bins
+        if shard_size is None:
+            shard_size = math.ceil(len(matrix) / self.workers)
+        self.shard_size = max(1, shard_size)
+        self.directory = tempfile.mkdtemp(prefix = "colmeleon_shards_")
+        names = _ARRAYS
+        if isinstance(matrix, Retrieval.QuantizedMatrix):
+            names += _QUANTIZED
+        for name in names:
+            np.save(os.path.join(self.directory, name + ".npy"),
+                    np.asarray(getattr(matrix, name)))
+        self._executor = ProcessPoolExecutor(self.workers)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def shards(self) -> list:
+        """
+        =======================================================================
+        Return the (start, end) rows of each shard, in order.
+        =======================================================================
+        """
+        return [(start, min(start + self.shard_size, len(self)))
+                for start in range(0, len(self), self.shard_size)]
+
+    def search(self, histos, depth, kernel = None) -> list:
+        """
+        =======================================================================
+        Find the depth best matches of a batch of queries, every shard being
+        scored against the whole batch by a worker.
+        =======================================================================
+        Arguments :
+            histos : The Histograms or CompactHistograms of the queries,
+                     with the bins of the matrix
+            depth : The number of images returned for each query
+            kernel : The name of a kernel of Kernels.KERNELS, see
+                     Retrieval.search
+        Returns :
+            For each query, the list Retrieval.search returns for the matrix
+        """
+        queries = [Retrieval._compact(histo, self.bins) for histo in histos]
+        if kernel is not None:
+            #the kernels are found by name in the workers
+            kernel = Retrieval.Kernels.get(kernel).name
+        futures = [self._executor.submit(_score_shard, self.directory,
+                                         self.bins, start, end, queries,
+                                         depth, kernel)
+                   for start, end in self.shards()]
+        parts = [future.result() for future in futures]
+        res = []
+        for q in range(len(queries)):
+            rows = np.concatenate([np.zeros(0, dtype = np.intp)] +
+                                  [part[q][0] for part in parts])
+            values = np.concatenate([np.zeros(0)] +
+                                    [part[q][1] for part in parts])
+            res.append(Retrieval.top_k(values, [self.paths[i] for i in rows],
+                                       depth))
+        return res
+
+    def submit(self, function, *arguments):
+        """
+        =======================================================================
+        Run function(directory, bins, *arguments) in a worker, where
+        attach(directory, bins) returns the matrix of the pool.
+        =======================================================================
+        Returns :
+            The Future of the result, function having to be picklable
+        """
+        return self._executor.submit(function, self.directory, self.bins,
+                                     *arguments)
+
+    def close(self) -> None:
+        """
+        =======================================================================
+        Stop the workers and remove the files of the matrix.
+        =======================================================================
+        """
+        self._executor.shutdown()
+        shutil.rmtree(self.directory, ignore_errors = True)
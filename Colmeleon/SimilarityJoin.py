@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+===============================================================================
+Similarity self-join of the histograms of a database : every pair of images
+whose intersection is at least a threshold, without comparing every image
+with every other one.
+The score of a pair is the intersection of their normalized histograms, in
+percent : for each channel the sum of the minimums of the two distributions,
+the smallest value among the channels being kept. It is symmetric, and it is
+the match value (see Algorithm.match_value) of two images of the same size.
+A color image is compared with a grey one through its grey histogram.
+
+For two distributions p and q, the sum of the minimums is 1 - |p - q| / 2,
+|p - q| being the sum of the absolute differences. Two rows reaching a
+threshold t thus differ by at most 2 (1 - t) in each bin, and so does any
+weighted sum of the bins of a channel whose weights are between -1 and 1.
+The rows are put in the cells of a grid of that width over DIMENSIONS such
+sums, the principal directions of the distributions, and each cell is only
+compared with itself and its neighbouring cells, the pairs whose sums differ
+by more than the width along any of _FILTERS directions being left out
+before the scoring. The result is exact.
+===============================================================================
+"""
+import csv
+import json
+import itertools
+import numpy as np
+import Retrieval
+import ShardPool
+
+#Number of directions the rows are put in a grid along
+DIMENSIONS = 4
+
+#Number of directions the pairs of neighbouring cells are filtered along
+#before being scored
+_FILTERS = 16
+
+#Number of rows the directions of the grid are found on
+_SAMPLE = 4096
+
+#Number of rows of a block compared with the rows of another at once
+_TILE = 1024
+
+#Number of values of the pairs scored at once
+_CHUNK = 1 << 20
+
+#What the blocks need (see _plan) in this worker process, by matrix, kind
+#and threshold
+_plans = {}
+
+def _scores(dists, left, right) -> np.ndarray:
+    """
+    The scores of the pairs of rows (left[i], right[i]), between 0 and 1
+    """
+    res = np.empty(len(left))
+    step = max(1, _CHUNK // max(1, dists[0].size if len(dists) else 1))
+    for start in range(0, len(left), step):
+        end = start + step
+        res[start:end] = np.minimum(dists[left[start:end]],
+                                    dists[right[start:end]]).sum(
+                                        axis = -1).min(axis = -1)
+    return res
+
+def _block(dists, projected, width, rows, others, threshold,
+           keep = None) -> tuple:
+    """
+    Compare the rows of a cell with others, its rows followed by the rows
+    of its neighbouring cells, tile by tile. The pairs keep(left, right)
+    rejects and the pairs whose projections differ by more than width are
+    left out.
+    Returns the (left, right, scores) of the pairs reaching the threshold,
+    and the number of pairs scored.
+    """
+    found, scored = [], 0
+    for a in range(0, len(rows), _TILE):
+        left = rows[a:a+_TILE]
+        for b in range(a, len(others), _TILE):
+            right = others[b:b+_TILE]
+            #each pair of rows of the cell once
+            i, j = np.nonzero((left[:, np.newaxis] < right) |
+                              (np.arange(b, b + len(right)) >= len(rows)))
+            i, j = left[i], right[j]
+            #one direction at a time, on the pairs still near
+            for values in projected:
+                near = np.abs(values[i] - values[j]) <= width
+                i, j = i[near], j[near]
+            if keep is not None:
+                kept = keep(i, j)
+                i, j = i[kept], j[kept]
+            scores = _scores(dists, i, j)
+            scored += len(i)
+            hit = scores >= threshold
+            found.append((i[hit], j[hit], scores[hit]))
+    if not found:
+        return (np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.intp),
+                np.zeros(0), 0)
+    return tuple(np.concatenate(part) for part in zip(*found)) + (scored,)
+
+def _projections(dists, count) -> np.ndarray:
+    """
+    Project the (N, channels, bins) distributions on the count directions
+    along which they vary the most, found among the principal
+    directions of each channel. Each direction is scaled so that its largest
+    weight is 1 : the projections of two distributions then differ by at
+    most the sum of the absolute differences of their channel.
+    """
+    rng = np.random.default_rng(0)
+    sample = dists[rng.choice(len(dists), min(len(dists), _SAMPLE),
+                              replace = False)]
+    candidates = []
+    for channel in range(dists.shape[1]):
+        values = sample[:, channel] - sample[:, channel].mean(axis = 0)
+        directions = np.linalg.svd(values, full_matrices = False)[2]
+        for direction in directions[:count]:
+            direction = direction / max(np.abs(direction).max(), 1e-12)
+            candidates.append(((values @ direction).std(), channel,
+                               direction))
+    candidates.sort(key = lambda candidate : -candidate[0])
+    return np.stack([dists[:, channel] @ direction for _, channel, direction
+                     in candidates[:count]], axis = 1)
+
+def _grid(dists, threshold) -> tuple:
+    """
+    Put the rows in the cells of the grid (see the module), the rows with an
+    empty channel, which reach no threshold, being left out.
+    Returns the width of the cells, the (_FILTERS, N) projections of the
+    rows, the rows sorted by cell, the start of each cell among them and the
+    neighbouring cells each cell is compared with, the ones after it
+    """
+    #the rounding errors of the sums are kept out of the width
+    width = 2 * (1 - threshold) + 1e-9
+    rows = np.flatnonzero((dists.sum(axis = -1) > 0.5).all(axis = -1))
+    projected = np.zeros((_FILTERS, len(dists)))
+    if len(rows) < 2:
+        return width, projected, rows, np.zeros(1, dtype = np.intp), []
+    values = _projections(dists[rows], _FILTERS)
+    projected[:values.shape[1], rows] = values.T
+    coordinates = np.floor(projected[:DIMENSIONS, rows].T /
+                           width).astype(np.int64)
+    coordinates -= coordinates.min(axis = 0) - 1
+    #each cell is one integer, its neighbours being at offsets of strides,
+    #the dimensions which would not fit in 63 bits being dropped
+    sizes = coordinates.max(axis = 0) + 2
+    kept = max(1, int(np.sum(np.cumsum(np.log2(sizes)) < 62)))
+    coordinates = coordinates[:, :kept]
+    strides = np.cumprod(np.concatenate([[1], sizes[:kept-1]]))
+    keys = coordinates @ strides
+    order = np.argsort(keys, kind = "stable")
+    keys, rows = keys[order], rows[order]
+    cells, starts = np.unique(keys, return_index = True)
+    starts = np.append(starts, len(rows))
+    neighbours = [[] for _ in cells]
+    for offset in itertools.product((-1, 0, 1), repeat = kept):
+        shift = int(np.dot(offset, strides))
+        if shift <= 0:
+            continue
+        found = np.minimum(np.searchsorted(cells, cells + shift),
+                           len(cells) - 1)
+        for cell in np.flatnonzero(cells[found] == cells + shift):
+            neighbours[cell].append(found[cell])
+    return width, projected, rows, starts, neighbours
+
+def _plan(matrix, kind, threshold) -> tuple:
+    """
+    Return what the blocks of a kind of rows (see _kind) need : their
+    distributions, the grid (see _grid), and the keep filter of the pairs
+    """
+    dists = matrix.normalized(kind)
+    keep = None
+    if kind == "grey":
+        #the pairs of color rows are compared in color
+        is_color = matrix.is_color
+        keep = lambda i, j : ~(is_color[i] & is_color[j])
+    return dists, _grid(dists, threshold), keep
+
+def _join(matrix, kind, start, end, threshold, plan = None) -> list:
+    """
+    Return, for the cells start to end (see _grid), the (left, right,
+    scores, scored) of their pairs, the rows being indexes among the rows of
+    the kind
+    """
+    dists, grid, keep = plan or _plan(matrix, kind, threshold)
+    width, projected, rows, starts, neighbours = grid
+    res = []
+    for cell in range(len(neighbours))[start:end]:
+        others = np.concatenate([rows[starts[c]:starts[c+1]] for c
+                                 in [cell] + sorted(neighbours[cell])])
+        res.append(_block(dists, projected, width,
+                          rows[starts[cell]:starts[cell+1]], others,
+                          threshold, keep))
+    return res
+
+def _join_task(directory, bins, kind, start, end, threshold) -> list:
+    """
+    _join of a matrix attached by a worker of a ShardPool, the grid being
+    built once per worker
+    """
+    matrix = ShardPool.attach(directory, bins)
+    key = (directory, kind, threshold)
+    if key not in _plans:
+        _plans[key] = _plan(matrix, kind, threshold)
+    return _join(matrix, kind, start, end, threshold, _plans[key])
+
+def join(matrix, threshold = 90, stats = None, pool = None):
+    """
+    ===========================================================================
+    Generator of the pairs of rows of a FeatureMatrix whose score (see the
+    module) is at least threshold. Each cell of the grid is compared with
+    its neighbours at once, by the workers of pool if one is given.
+    ===========================================================================
+    Arguments :
+        matrix : The FeatureMatrix
+        threshold : The smallest score kept, in percent
+        stats : A dictionary in which "blocks" (cells compared),
+                "scored" (pairs scored), "pairs" (pairs found) and "rows"
+                (rows of the matrix) are added, if given
+        pool : A ShardPool of the matrix (see Retrieval.shard_pool)
+    Yields :
+        The tuples (row, other row, score) found, row < other row, block by
+        block
+    """
+    assert 0 < threshold <= 100, {"join : the threshold must be in "+
+                                  "]0, 100]"}.pop()
+    threshold = threshold / 100
+    if stats is not None:
+        stats["rows"] = stats.get("rows", 0) + len(matrix)
+    for kind in ["color", "grey"]:
+        rows = matrix._kind(kind)[0]
+        if len(rows) < 2 or (kind == "grey" and matrix.is_color.all()):
+            continue
+        plan = _plan(matrix, kind, threshold)
+        if pool is None:
+            results = iter(_join(matrix, kind, 0, None, threshold, plan))
+        else:
+            #about four tasks per worker, gathered in order
+            total = len(plan[1][4])
+            step = max(1, -(-total // (4 * pool.workers)))
+            futures = [pool.submit(_join_task, kind, start, start + step,
+                                   threshold)
+                       for start in range(0, total, step)]
+            results = (part for future in futures
+                       for part in future.result())
+        for left, right, scores, scored in results:
+            if stats is not None:
+                for name, value in [("blocks", 1), ("scored", scored),
+                                    ("pairs", len(left))]:
+                    stats[name] = stats.get(name, 0) + value
+            for i, j, score in zip(rows[left], rows[right], scores):
+                yield int(min(i, j)), int(max(i, j)), float(score) * 100
+
+def duplicates(database, threshold = 90, bins = 32, workers = None,
+               stats = None):
+    """
+    ===========================================================================
+    Generator of the pairs of images of a database whose score (see the
+    module) is at least threshold.
+    ===========================================================================
+    Arguments :
+        database : The Database with all the calculated histograms inside
+        threshold : The smallest score kept, in percent
+        bins : The number of bins of the histograms compared
+        workers : The number of processes comparing the blocks, if given
+                  (see Retrieval.shard_pool)
+        stats : A dictionary for the counters, see join
+    Yields :
+        The tuples (path, other path, score) found
+    """
+    matrix = Retrieval.features(database, Retrieval.INTERSECTION, bins)
+    pool = (None if workers is None else
+            Retrieval.shard_pool(database, Retrieval.INTERSECTION, bins,
+                                 workers))
+    for i, j, score in join(matrix, threshold, stats, pool):
+        yield matrix.paths[i], matrix.paths[j], score
+
+def write_pairs(pairs, out, format = "jsonl") -> int:
+    """
+    ===========================================================================
+    Write pairs to out as soon as they are found, one per line : a CSV line
+    path,other,score or a JSON line {"path": ..., "other": ..., "score": ...}
+    ===========================================================================
+    Arguments :
+        pairs : Iterable of the tuples (path, other path, score)
+        out : The text file written
+        format : "csv" or "jsonl"
+    Returns :
+        The number of pairs written
+    """
+    assert format in ("csv", "jsonl"), {f"write_pairs : the format {format}"+
+                                        " does not exist"}.pop()
+    writer = csv.writer(out) if format == "csv" else None
+    count = 0
+    for path, other, score in pairs:
+        if writer is not None:
+            writer.writerow([path, other, score])
+        else:
+            out.write(json.dumps({"path": path, "other": other,
+                                  "score": score})+"\n")
+        out.flush()
+        count += 1
+    return count
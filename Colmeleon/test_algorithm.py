@@ -1,6 +1,8 @@
 import unittest as ut
 from Algorithm import *
 from Histogram import *
+from Image import Image
+import os
 
 
 expectations = ()
@@ -13,6 +15,12 @@ data3 = [10,20,30,40,50,60]
 baddata1 = "Lorem ipsum"
 baddata2 = "HistogramsAndColor"
 
+maindir = os.path.dirname(__file__)
+images = [os.path.join(maindir, 'chameleon_smallDB', name) for name in
+          ['mascot.jpg', 'chameleon-on-leaf.jpg']]
+grey_image = os.path.join(maindir, 'UnitTesting', 'Histogram',
+                          'grey_square.png')
+
 class TestAlgorithm(ut.TestCase):
     """
     Unit testing class for the module Image.
@@ -42,6 +50,52 @@ class TestAlgorithm(ut.TestCase):
         self.assertEqual(euclidean_dist(data1,data3), 88.0625 )
         with self.assertRaises(TypeError):
             jaccard_dist(baddata1,baddata1)
+    def test_intersection(self):
+        """
+        Test the intersection of two histograms, with the same number of bins
+        or not
+        """
+        histo1 = Histogram(Image(images[0]), bins = 64)
+        histo2 = Histogram(Image(images[1]), bins = 64)
+        self.assertEqual(match_value(histo1, histo1), 100)
+        red = np.minimum(histo1.histograms.get_red(),
+                         histo2.histograms.get_red())
+        self.assertListEqual(list(intersection(histo1, histo2)[0]), list(red))
+        #the model is brought down to the bins of the image
+        histo3 = Histogram(Image(images[1]), bins = 255)
+        self.assertEqual(intersection(histo1, histo3),
+                         intersection(histo1, histo2))
+        self.assertEqual(intersection(histo1, histo3.pyramid().level(64)),
+                         intersection(histo1, histo2))
+        self.assertEqual(intersection(histo1, histo3.compact()),
+                         intersection(histo1, histo2))
+
+    def test_intersection_grey(self):
+        histo1 = Histogram(Image(images[0]), bins = 32)
+        histo2 = Histogram(Image(grey_image), bins = 32)
+        grey = Histogram(Image(images[0]), bins = 32, grey = True)
+        self.assertEqual(intersection(histo1, histo2),
+                         intersection(grey, histo2))
+        self.assertEqual(intersection(histo2, histo1.compact()),
+                         intersection(histo2, grey))
+        #the derived grey is kept, the pixels are not read anymore
+        histo1.imageArray = None
+        self.assertEqual(intersection(histo1, histo2),
+                         intersection(grey, histo2))
+    def test_intersection_scores(self):
+        """
+        Test that scoring many models at once gives the values of match_value
+        """
+        histo = Histogram(Image(images[0]), bins = 32)
+        models = [Histogram(Image(path), bins = 32).compact()
+                  for path in images]
+        scores = intersection_scores(histo.compact().counts,
+                                     np.stack([m.counts for m in models]))
+        self.assertEqual(scores.shape, (len(models),))
+        for score, model in zip(scores, models):
+            self.assertEqual(score, match_value(histo, model))
+        self.assertEqual(intersection_scores(models[1].counts,
+                                             models[1].counts), 100)
 
 if __name__ == '__main__':
     ut.main()
@@ -0,0 +1,106 @@
+import unittest as ut
+import ApproximateIndex
+from ApproximateIndex import ApproximateIndex as Index, vector
+from Database import Database
+from Histogram import Histogram, CompactHistogram
+from Image import Image
+import Retrieval
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestApproximateIndex(ut.TestCase):
+    """
+    Unit testing class for the module ApproximateIndex.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.dirichlet(np.full(3 * ApproximateIndex.BINS, 0.3),
+                                size = 10)
+        self.vectors = np.concatenate([center + rng.normal(0, 0.001, (40, 96))
+                                       for center in centers])
+        self.paths = [f"image{i}" for i in range(len(self.vectors))]
+
+    def test_vector(self):
+        histo = Histogram(Image(query))
+        res = vector(histo)
+        self.assertEqual(res.shape, (3 * ApproximateIndex.BINS,))
+        for channel in res.reshape(3, -1):
+            self.assertAlmostEqual(channel.sum(), 1)
+        np.testing.assert_array_equal(vector(histo.pyramid()), res)
+        grey = CompactHistogram([[1, 0, 3] + [0] * 29], CompactHistogram.GREY)
+        np.testing.assert_array_equal(vector(grey).reshape(3, -1),
+                                      np.repeat(grey.counts / 4, 3, axis = 0))
+
+    def test_candidates(self):
+        index = Index(self.paths, self.vectors, lists = 10,
+                      subquantizers = 8)
+        self.assertEqual(len(index), 400)
+        stats = {}
+        rows = index.candidates(self.vectors[5], 400, 10, stats)
+        self.assertEqual(list(rows), list(range(400)))
+        self.assertEqual(stats, {"lists": 10, "codes": 400, "rows": 400})
+        #the neighbours of a vector share its list
+        rows = index.candidates(self.vectors[5], 10, 1)
+        self.assertEqual(len(rows), 10)
+        self.assertTrue(all(row < 40 for row in rows))
+
+    def test_add(self):
+        index = Index(self.paths[:200], self.vectors[:200], lists = 5,
+                      subquantizers = 8)
+        index.add(self.paths[200:], self.vectors[200:])
+        index.add([], [])
+        self.assertEqual(index.paths, self.paths)
+        self.assertEqual(sorted(np.concatenate(index.rows)),
+                         list(range(400)))
+
+    def test_save(self):
+        index = Index(self.paths, self.vectors, subquantizers = 8,
+                      version = (1, 2))
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(os.path.join(directory, 'index'))
+            loaded = Index.load(os.path.join(directory, 'index'))
+        self.assertEqual(loaded.version, (1, 2))
+        np.testing.assert_array_equal(loaded.candidates(self.vectors[0], 5),
+                                      index.candidates(self.vectors[0], 5))
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            histo = Histogram(Image(query))
+            #every list visited and every candidate scored : exact results
+            self.assertEqual(
+                Retrieval.search(database, histo, 3, Retrieval.APPROXIMATE,
+                                 nprobe = 10),
+                Retrieval.search(database, histo, 3, Retrieval.INTERSECTION))
+            self.assertEqual(Retrieval.recall(database, depth = 3,
+                                              nprobe = 10), 1.0)
+            index = database.ann_index()
+            self.assertEqual(index.version, database.version())
+            database.add(query, histo)
+            index = database.ann_index()
+            self.assertEqual(index.version, database.version())
+            self.assertEqual(len(index), len(list(database.histograms())))
+            self.assertEqual(Retrieval.search(database, histo, 1,
+                                              Retrieval.APPROXIMATE)[0][0], 0)
+            #a reindex which finds nothing new leaves the index as it is
+            self.assertEqual(database._calculate_histograms(), [])
+            self.assertEqual(database.ann_index().version, database.version())
+            self.assertEqual(len(database.ann_index()), len(index))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
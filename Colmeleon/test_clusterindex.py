@@ -0,0 +1,114 @@
+import unittest as ut
+import ApproximateIndex
+from ClusterIndex import ClusterIndex, minibatch_kmeans
+from Database import Database
+from Histogram import Histogram
+from Image import Image
+import Algorithm
+import Retrieval
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestClusterIndex(ut.TestCase):
+    """
+    Unit testing class for the module ClusterIndex, on vectors drawn around
+    well separated centers.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.centers = rng.dirichlet(np.full(3 * ApproximateIndex.BINS, 0.3),
+                                     size = 8)
+        self.truth = np.arange(800) % 8
+        self.vectors = (self.centers[self.truth] +
+                        rng.normal(0, 0.001, (800, 96)))
+        self.paths = [f"image{i}" for i in range(800)]
+
+    def test_minibatch_kmeans(self):
+        centroids = minibatch_kmeans(self.vectors, 8,
+                                     np.random.default_rng(0), batch = 64)
+        self.assertEqual(centroids.shape, (8, 96))
+        #every center is found
+        dist = np.linalg.norm(self.centers[:, np.newaxis] - centroids,
+                              axis = 2)
+        self.assertLess(dist.min(axis = 1).max(), 0.01)
+
+    def test_labels(self):
+        index = ClusterIndex(self.paths, self.vectors, 8)
+        self.assertEqual(len(index), 800)
+        #the images of a center share a label, and only them
+        for center in range(8):
+            labels = set(index.labels[self.truth == center])
+            self.assertEqual(len(labels), 1)
+            self.assertEqual(index.label(self.centers[center]),
+                             labels.pop())
+        groups = index.clusters()
+        self.assertEqual(sorted(len(g) for g in groups.values()), [100] * 8)
+
+    def test_rows(self):
+        index = ClusterIndex(self.paths, self.vectors, 8)
+        stats = {}
+        nearest = index.nearest(self.vectors[3], 2)
+        rows = index.rows(nearest, stats)
+        self.assertEqual(list(rows), sorted(rows))
+        self.assertIn(3, rows)
+        self.assertEqual(stats, {"clusters": 2, "scored": 200,
+                                 "saved": 600, "rows": 800})
+
+    def test_add_save(self):
+        index = ClusterIndex(self.paths[:400], self.vectors[:400], 8,
+                             version = (1, 2))
+        index.add(self.paths[400:], self.vectors[400:])
+        np.testing.assert_array_equal(index.labels[400:], index.labels[:400])
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(os.path.join(directory, 'index'))
+            loaded = ClusterIndex.load(os.path.join(directory, 'index'))
+        self.assertEqual(loaded.version, (1, 2))
+        np.testing.assert_array_equal(loaded.labels, index.labels)
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            groups = Algorithm.cluster(database, 3)
+            self.assertEqual(len(groups), 3)
+            paths = [p for p, _ in database.histograms()]
+            self.assertEqual(sorted(sum(groups.values(), [])), sorted(paths))
+            self.assertEqual(database.cluster_index().version,
+                             database.version())
+            label = Algorithm.label_images(Image(paths[0]), database)
+            self.assertIn(paths[0], groups[label])
+            histo = Histogram(Image(query))
+            #every cluster scored : exact results
+            stats = {}
+            self.assertEqual(
+                Retrieval.search(database, histo, 3, Retrieval.CLUSTERED,
+                                 stats, nclusters = 3),
+                Retrieval.search(database, histo, 3, Retrieval.INTERSECTION))
+            self.assertEqual(stats["saved"], 0)
+            stats = {}
+            Retrieval.search(database, histo, 3, Retrieval.CLUSTERED, stats,
+                             nclusters = 1)
+            self.assertEqual(stats["scored"] + stats["saved"], len(paths))
+            database.add(query, histo)
+            index = database.cluster_index()
+            self.assertEqual(index.version, database.version())
+            self.assertEqual(len(index), len(paths) + 1)
+            self.assertEqual(Retrieval.search(database, histo, 1,
+                                              Retrieval.CLUSTERED)[0][0], 0)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
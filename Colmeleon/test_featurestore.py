@@ -0,0 +1,420 @@
+import unittest as ut
+import FeatureStore
+from FeatureStore import FeatureStore as Store
+import Retrieval
+from Database import Database
+from Histogram import Histogram, CompactHistogram, HistogramPyramid
+from Image import Image
+import numpy as np
+import pickle
+import json
+import csv
+import tempfile
+import shutil
+import multiprocessing
+import os
+
+
+def _append_many(directory, entries):
+    """
+    Append entries one at a time, as an ingest process would
+    """
+    store = Store.open(directory)
+    for entry in entries:
+        store.append([entry], replace = True)
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestFeatureStore(ut.TestCase):
+    """
+    Unit testing class for the module FeatureStore, and the Database on top
+    of it.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.entries = []
+        for i in range(40):
+            channels = 3 if i % 5 else 1
+            histo = CompactHistogram(rng.integers(0, 100, (channels, 256)),
+                                     CompactHistogram.COLOR if channels == 3
+                                     else CompactHistogram.GREY)
+            grey = CompactHistogram(rng.integers(0, 100, (1, 256)),
+                                    CompactHistogram.GREY)
+            self.entries.append((f"image{i}.jpg", histo, grey,
+                                 rng.random(FeatureStore.AXES)))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def database(self, name = 'db'):
+        directory = os.path.join(self.workdir, name)
+        shutil.copytree(smalldb, directory)
+        os.makedirs(os.path.join(self.workdir, 'tmp'), exist_ok = True)
+        return Database(directory, os.path.join(self.workdir, 'tmp'))
+
+    def test_rebin(self):
+        counts = CompactHistogram(np.arange(3 * 256).reshape(3, 256),
+                                  CompactHistogram.COLOR)
+        pyramid = HistogramPyramid(counts)
+        for bins in [255, 128, 32, 7, 256]:
+            rebinned = FeatureStore.rebin(counts.counts, bins)
+            self.assertEqual(rebinned.dtype, counts.counts.dtype)
+            np.testing.assert_array_equal(rebinned,
+                                          pyramid.level(bins).counts)
+        #the histograms of an image with any number of bins, finer ones too
+        image = Image(query)
+        counts = Histogram(image, bins = FeatureStore.BINS).compact().counts
+        for bins in [8, 32, 256, 300]:
+            np.testing.assert_array_equal(
+                FeatureStore.rebin(counts, bins),
+                Histogram(image, bins = bins).compact().counts)
+
+    def test_append(self):
+        self.assertFalse(Store.exists(self.workdir))
+        store = Store.create(self.workdir)
+        self.assertTrue(Store.exists(self.workdir))
+        self.assertEqual(len(store), 0)
+        #past the first capacity of the arrays
+        store.append(self.entries[:10])
+        store.append(self.entries[10:])
+        for opened in [store, Store(self.workdir)]:
+            self.assertEqual(opened.paths, [e[0] for e in self.entries])
+            self.assertIsInstance(opened.colors, np.memmap)
+            for row, (_, histo, grey, axes) in enumerate(self.entries):
+                self.assertEqual(opened.histogram(row), histo)
+                self.assertEqual(opened.histogram(row, 32), histo.rebin(32))
+                self.assertEqual(opened.grey(row, 32), grey.rebin(32))
+                np.testing.assert_array_equal(opened.axes[row], axes)
+            np.testing.assert_array_equal(opened.levels("greys", 8, 3, 9),
+                                          [g.rebin(8).counts[0] for _, _, g,
+                                           _ in self.entries[3:9]])
+
+    def test_header(self):
+        self.assertIsNone(Store.header(self.workdir))
+        store = Store.create(self.workdir)
+        header = Store.header(self.workdir)
+        self.assertEqual((header["count"], header["generation"]), (0, 0))
+        self.assertEqual(header["bins"], FeatureStore.BINS)
+        self.assertEqual(header["axes"], FeatureStore.AXES)
+        #every write of rows is a new generation, not the one of the
+        #manifest alone
+        store.append(self.entries[:3])
+        store.delete([1])
+        store.record([0], [(1, 2, 3)])
+        self.assertIsNone(store.delete([1]))
+        header = Store.header(self.workdir)
+        self.assertEqual((header["count"], header["generation"]), (3, 2))
+        self.assertEqual(store.generation, 2)
+        self.assertEqual(store.mtimes[0], 2)
+        self.assertEqual(header["id"], store.identifier)
+        self.assertNotEqual(Store.create(self.workdir).identifier,
+                            store.identifier)
+        #a header of another format is not read
+        path = os.path.join(Store.path(self.workdir), 'header.json')
+        with open(path, 'w') as file:
+            json.dump(dict(header, format = 0), file)
+        self.assertIsNone(Store.header(self.workdir))
+        self.assertRaises(ValueError, Store, self.workdir)
+        with open(path, 'w') as file:
+            file.write("{")
+        self.assertIsNone(Store.header(self.workdir))
+
+    def test_interrupted_append(self):
+        store = Store.create(self.workdir)
+        store.append(self.entries[:3])
+        old = Store(self.workdir)
+        #the paths of an append stopped before its header
+        with open(os.path.join(store.directory, 'paths.jsonl'), 'a') as file:
+            file.write(json.dumps("lost.jpg") + "\n")
+        self.assertEqual(len(Store(self.workdir)), 3)
+        store.append(self.entries[3:5])
+        self.assertEqual(Store(self.workdir).paths,
+                         [e[0] for e in self.entries[:5]])
+        #a store opened before an append keeps its rows
+        self.assertEqual(len(old), 3)
+        self.assertEqual(old.histogram(2), self.entries[2][1])
+
+    def test_snapshots(self):
+        store = Store.create(self.workdir)
+        store.append(self.entries[:5])
+        old = Store(self.workdir)
+        replaced, version = store.append([self.entries[1],
+                                          self.entries[7]], replace = True)
+        np.testing.assert_array_equal(replaced, [1])
+        self.assertEqual(version, (store.identifier, 2))
+        self.assertEqual(store.delete([3]), (store.identifier, 3))
+        #the store opened before keeps its rows and tombstones
+        self.assertEqual(len(old), 5)
+        np.testing.assert_array_equal(old.live(), range(5))
+        np.testing.assert_array_equal(Store(self.workdir).live(),
+                                      [0, 2, 4, 5, 6])
+        self.assertEqual(store.generation, 3)
+        #a write stopped before its header is left out, then cleared
+        with FeatureStore._locked(store.directory):
+            store._tombstone([0, 2], store.generation + 1)
+        np.testing.assert_array_equal(Store(self.workdir).live(),
+                                      [0, 2, 4, 5, 6])
+        old.append(self.entries[8:9])
+        store = Store(self.workdir)
+        np.testing.assert_array_equal(store.live(), [0, 2, 4, 5, 6, 7])
+        self.assertEqual(store.generation, 4)
+
+    def test_concurrent_writers(self):
+        store = Store.create(self.workdir)
+        processes = [multiprocessing.Process(target = _append_many,
+                                             args = (self.workdir,
+                                                     self.entries[i::4]))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        store = Store(self.workdir)
+        self.assertEqual(store.generation, len(self.entries))
+        self.assertEqual(sorted(store.paths),
+                         sorted(e[0] for e in self.entries))
+        for row, path in enumerate(store.paths):
+            entry = self.entries[int(path[5:-4])]
+            self.assertEqual(store.histogram(row), entry[1])
+            np.testing.assert_array_equal(store.axes[row], entry[3])
+        #an image written again by several processes has a single row left
+        processes = [multiprocessing.Process(target = _append_many,
+                                             args = (self.workdir,
+                                                     self.entries[:10]))
+                     for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        store = Store(self.workdir)
+        self.assertEqual(sorted(store.paths[row] for row in store.live()),
+                         sorted(e[0] for e in self.entries))
+
+    def test_database(self):
+        database = self.database()
+        self.assertIsNone(database.store())
+        self.assertFalse(database.is_computed())
+        database._calculate_histograms()
+        #only the header is read, the images are not listed
+        database.explore = None
+        self.assertTrue(database.is_computed())
+        del database.explore
+        self.assertFalse(os.path.exists(os.path.join(database.get_dir(),
+                                                     'histograms.csv')))
+        self.assertTrue(database.is_computed())
+        for path, histo in database.histograms(32):
+            expected = Histogram(Image(path), bins = 32)
+            self.assertEqual(histo, expected.compact())
+        for bins in [255, 32]:
+            for grey in [False, True]:
+                entries = (database.grey_histograms(bins) if grey
+                           else database.histograms(bins))
+                matrix = Retrieval.FeatureMatrix.from_histograms(entries,
+                                                                 bins)
+                stored = Retrieval.FeatureMatrix.from_store(
+                    database.store(), bins, grey)
+                self.assertEqual(stored.paths, matrix.paths)
+                for name in ["is_color", "colors", "greys", "pixels"]:
+                    np.testing.assert_array_equal(getattr(stored, name),
+                                                  getattr(matrix, name))
+                    self.assertEqual(getattr(stored, name).dtype,
+                                     getattr(matrix, name).dtype)
+        images = len(database.store())
+        version = database.version()
+        database.add(query, Histogram(Image(query)))
+        self.assertNotEqual(database.version(), version)
+        self.assertFalse([file for file in os.listdir(database.get_dir())
+                          if file.endswith('.tmp')])
+        self.assertEqual(len(database.store()), images + 1)
+        path, histo = list(database.histograms(16))[-1]
+        self.assertEqual(path, os.path.join(database.get_dir(),
+                                            'image5.jpg'))
+        self.assertEqual(histo, Histogram(Image(query), bins = 16).compact())
+        self.assertEqual(len(list(database.bin_histograms())), images + 1)
+
+    def test_interleaved_writes(self):
+        database = self.database()
+        directory = database.get_dir()
+        database._calculate_histograms(workers = 1)
+        names = ['color_axes_tree', 'ann_index', 'clusters_index']
+
+        def indexes(reader):
+            return [reader.metric_tree(), reader.ann_index(),
+                    reader.cluster_index()]
+
+        def saved():
+            res = []
+            for name in names:
+                with open(os.path.join(directory, name), 'rb') as file:
+                    res.append(file.read())
+            return res
+
+        def check(reader):
+            store = reader.store()
+            live = [store.paths[row] for row in store.live()]
+            for index in indexes(reader):
+                self.assertEqual(index.version, reader.version())
+                self.assertEqual(index.paths, live)
+
+        centroids = [index.centroids for index in indexes(database)[1:]]
+        sources = []
+        for name in ['a.jpg', 'b.jpg']:
+            sources.append(os.path.join(self.workdir, name))
+            shutil.copy(query, sources[-1])
+        #the writers do not touch the indexes
+        before = saved()
+        writers = [Database(directory, database.tmpdir) for _ in sources]
+        writers[0].add(sources[0], Histogram(Image(sources[0])))
+        self.assertEqual(saved(), before)
+        #the indexes read between two writes catch up with each of them,
+        #the new rows being added to the trained ones
+        check(writers[1])
+        writers[1].add(sources[1], Histogram(Image(sources[1])))
+        check(writers[0])
+        check(database)
+        for index, trained in zip(indexes(database)[1:], centroids):
+            np.testing.assert_array_equal(index.centroids, trained)
+        #a catch up which finds nothing new saves nothing
+        before = saved()
+        check(writers[1])
+        self.assertEqual(saved(), before)
+        #an image added again makes a tombstone, the indexes are built again
+        writers[0].add(sources[0], Histogram(Image(sources[0])))
+        check(writers[1])
+
+    def test_parallel(self):
+        database = self.database()
+        directory = database.get_dir()
+        #a file which is not an image, left out
+        with open(os.path.join(directory, 'corrupted.jpg'), 'wb') as file:
+            file.write(b"not an image")
+        calls = []
+        stats = {}
+        failed = database._calculate_histograms(
+            workers = 2, chunk_size = 2, stats = stats,
+            progress = lambda *args : calls.append(args))
+        self.assertEqual([error.path for error in failed],
+                         [os.path.join(directory, 'corrupted.jpg')])
+        images = len(database.store())
+        self.assertEqual(stats["images"], images)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual([done for done, _, _ in calls],
+                         list(range(2, images + 1, 2)) + [images + 1])
+        self.assertTrue(all(total == images + 1 for _, total, _ in calls))
+        #the same store as computed in this process
+        os.remove(os.path.join(directory, 'corrupted.jpg'))
+        other = self.database('other')
+        self.assertEqual(other._calculate_histograms(workers = 1), [])
+        expected = other.store()
+        self.assertEqual([os.path.basename(p) for p in database.store().paths],
+                         [os.path.basename(p) for p in expected.paths])
+        for name in ["is_color", "colors", "greys", "axes"]:
+            np.testing.assert_array_equal(getattr(database.store(), name),
+                                          getattr(expected, name))
+
+    def test_reindex(self):
+        database = self.database()
+        directory = database.get_dir()
+        database._calculate_histograms(workers = 1)
+        names = sorted(database.images())
+        paths = [os.path.join(directory, name) for name in names]
+        version = database.version()
+        indexes = [os.path.join(directory, name) for name in
+                   ['color_axes_tree', 'ann_index', 'clusters_index']]
+        loads = [database.metric_tree, database.ann_index,
+                 database.cluster_index]
+        for load in loads:
+            load()
+        saved = [os.stat(index).st_mtime_ns for index in indexes]
+        stats = {}
+        database._calculate_histograms(workers = 1, stats = stats)
+        self.assertEqual(stats, {"images": 0, "failed": 0, "deleted": 0,
+                                 "hashed": 0, "seconds": stats["seconds"]})
+        #a file touched is hashed, not computed
+        os.utime(paths[0], ns = (0, 0))
+        stats = {}
+        database._calculate_histograms(workers = 1, stats = stats)
+        self.assertEqual((stats["hashed"], stats["images"]), (1, 0))
+        self.assertEqual(database.store().mtimes[database.store().paths.index(
+            paths[0])], 0)
+        #neither changed the database : the indexes are not saved again
+        self.assertEqual(database.version(), version)
+        for load in loads:
+            load()
+        self.assertEqual([os.stat(index).st_mtime_ns for index in indexes],
+                         saved)
+        #a file changed and a file deleted become tombstones
+        shutil.copy(paths[2], paths[1])
+        os.remove(paths[3])
+        stats = {}
+        database._calculate_histograms(workers = 1, stats = stats)
+        self.assertEqual((stats["images"], stats["deleted"]), (1, 2))
+        store = database.store()
+        self.assertEqual(len(store), len(names) + 1)
+        histograms = dict(database.histograms(32))
+        self.assertEqual(sorted(histograms), sorted(paths[:3] + paths[4:]))
+        self.assertEqual(histograms[paths[1]], histograms[paths[2]])
+        self.assertEqual(len(list(database.grey_histograms())), len(names) - 1)
+        self.assertNotIn(paths[3], dict(database.bin_histograms()))
+        self.assertEqual(sorted(database.metric_tree().paths),
+                         sorted(histograms))
+        matrix = Retrieval.FeatureMatrix.from_store(store, 32)
+        expected = Retrieval.FeatureMatrix.from_histograms(
+            database.histograms(32), 32)
+        self.assertEqual(matrix.paths, expected.paths)
+        for name in ["is_color", "colors", "greys", "pixels"]:
+            np.testing.assert_array_equal(getattr(matrix, name),
+                                          getattr(expected, name))
+        #an image added again replaces the one of the same name
+        database.add(paths[0], Histogram(Image(paths[0])))
+        self.assertEqual([path for path, _ in database.histograms()].count(
+            paths[0]), 1)
+        self.assertEqual(sorted(dict(database.histograms())),
+                         sorted(histograms))
+
+    def test_migration(self):
+        database = self.database()
+        directory = database.get_dir()
+        #a database computed by an older version
+        rows = []
+        for name in ["histograms", "bins_histograms", "grey_histograms"]:
+            os.mkdir(os.path.join(directory, name))
+        for i, file in enumerate(sorted(database.images())):
+            path = os.path.join(directory, file)
+            histo, grey, axes = database._calculate_histogram(path)
+            row = [path]
+            for name, value in [("histograms", HistogramPyramid(histo)),
+                                ("bins_histograms", axes),
+                                ("grey_histograms", HistogramPyramid(grey))]:
+                row.append(os.path.join(directory, name, f"{i}"))
+                with open(row[-1], 'wb') as file:
+                    pickle.dump(value, file)
+            rows.append(row)
+        #a grey histogram which can not be read is computed again
+        os.remove(rows[1][3])
+        with open(os.path.join(directory, 'histograms.csv'), 'w') as file:
+            csv.writer(file).writerows(rows)
+        self.assertTrue(database.is_computed())
+        store = database.store()
+        self.assertTrue(Store.exists(directory))
+        self.assertEqual(store.paths, [row[0] for row in rows])
+        for row, path in enumerate(store.paths):
+            histo, grey, axes = database._calculate_histogram(path)
+            self.assertEqual(store.histogram(row), histo)
+            self.assertEqual(store.grey(row), grey)
+            np.testing.assert_array_equal(store.axes[row], axes)
+        #the files are fingerprinted by the next reindex, not computed
+        self.assertTrue((store.mtimes == FeatureStore.UNKNOWN).all())
+        stats = {}
+        database._calculate_histograms(workers = 1, stats = stats)
+        self.assertEqual((stats["images"], stats["hashed"]), (0, len(rows)))
+        self.assertEqual(database.store().hashes[0],
+                         FeatureStore.fingerprint(rows[0][0])[2])
+
+if __name__ == '__main__':
+    ut.main()
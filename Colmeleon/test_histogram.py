@@ -1,6 +1,11 @@
 import unittest as ut
-from Histogram import ColorHistogram, GreyHistogram, Histogram
+from Histogram import ColorHistogram, GreyHistogram, Histogram, channel_counts
+from Histogram import is_grey, CompactHistogram, HistogramPyramid
+from Histogram import image_features
+import pickle
+import cv2
 from Image import Image
+import numpy as np
 import os
 
 
@@ -42,6 +47,38 @@ class TestHistogram(ut.TestCase):
             histo_grey = Histogram(Image(path),bins=255, grey = True)
             self.assertIsInstance(histo_grey.histograms,GreyHistogram)
 
+    def test_is_grey(self):
+        for path, a,b in expectation :
+            self.assertEqual(is_grey(Image(path).getarray()), a)
+        self.assertTrue(is_grey(np.zeros((4,4), dtype = np.uint8)))
+
+    def test_single_decode(self):
+        """
+        The histogram must read the buffer the image already decoded
+        """
+        image = Image(expectation[0][0])
+        histo = Histogram(image, bins=255)
+        self.assertIs(histo.imageArray, image.getarray())
+
+    def test_image_features(self):
+        """
+        Every feature of the database must come from the decoded buffer
+        alone, the same as the ones of the Histogram of the image
+        """
+        query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+        for path in [query] + [e[0] for e in expectation]:
+            image = Image(path)
+            histo = Histogram(image)
+            features, grey, axes = image_features(image.getarray())
+            self.assertEqual(features, histo.pyramid().level(256))
+            np.testing.assert_array_equal(axes, Histogram.color_axes(histo))
+            pixels = image.getarray()
+            expected = (pixels if pixels.ndim == 2 else
+                        cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY))
+            self.assertEqual(grey, CompactHistogram(
+                channel_counts(expected.reshape(-1, 1), 256),
+                CompactHistogram.GREY))
+
 class TestColorHistogram(ut.TestCase):
     def test_init(self):
         pass
@@ -89,6 +126,108 @@ class TestGreyHistogram(ut.TestCase):
                 self.assertListEqual(list(histo.histograms.get_grey()),expected_list)
 
 
+class TestHistogramEngine(ut.TestCase):
+
+    def test_channel_counts(self):
+        """
+        The counts must be the ones numpy (and so matplotlib) gives
+        """
+        pixels = np.random.default_rng(0).integers(0, 256, (5000, 3),
+                                                   dtype = np.uint8)
+        for testbins in [1, 8, 100, 255, 256, 300]:
+            expected = [np.histogram(pixels[:,i], bins = testbins,
+                                     range = [0,255])[0] for i in range(3)]
+            counts = channel_counts(pixels, testbins)
+            self.assertEqual(counts.shape, (3, testbins))
+            for i in range(3):
+                self.assertListEqual(list(counts[i]), list(expected[i]))
+
+    def test_channel_counts_other_types(self):
+        pixels = np.arange(-20, 300).reshape(-1, 1)
+        expected = np.histogram(pixels, bins = 255, range = [0,255])[0]
+        self.assertListEqual(list(channel_counts(pixels, 255)[0]),
+                             list(expected))
+
+class TestCompactHistogram(ut.TestCase):
+
+    def test_from_histogram(self):
+        for path, a,b in expectation :
+            histo = Histogram(Image(path),bins=255)
+            compact = histo.compact()
+            self.assertEqual(compact.bins, 255)
+            self.assertEqual(compact.is_color(), not a)
+            self.assertEqual(compact.counts.dtype.kind, "u")
+            self.assertTrue(compact.counts.flags["C_CONTIGUOUS"])
+            self.assertEqual(hash(compact), hash(histo.histograms))
+            if a :
+                self.assertListEqual(list(compact.get_grey()),
+                                     list(histo.histograms.get_grey()))
+            else :
+                self.assertListEqual(list(compact.get_red()),
+                                     list(histo.histograms.get_red()))
+                self.assertListEqual(list(compact.get_blue()),
+                                     list(histo.histograms.get_blue()))
+
+    def test_no_pixels(self):
+        compact = Histogram(Image(expectation[0][0]),bins=255).compact()
+        self.assertFalse(hasattr(compact, "__dict__"))
+        self.assertLess(len(pickle.dumps(compact)), 4 * 3 * 255 + 100)
+
+    def test_serialization(self):
+        compact = Histogram(Image(expectation[3][0]),bins=64).compact()
+        self.assertEqual(CompactHistogram.from_bytes(compact.to_bytes()),
+                         compact)
+        self.assertEqual(pickle.loads(pickle.dumps(compact)), compact)
+        with self.assertRaises(ValueError):
+            CompactHistogram.from_bytes(bytes(64))
+
+    def test_grey(self):
+        """
+        The derived grey counts must be the ones of a GreyHistogram
+        """
+        image = Image(expectation[4][0])
+        self.assertListEqual(
+            list(Histogram(image,bins=32).compact().grey().get_grey()),
+            list(Histogram(image,bins=32,grey=True).histograms.get_grey()))
+        histo = Histogram(image,bins=32)
+        for bins in [32, 8]:
+            self.assertListEqual(list(histo.grey(bins).get_grey()), list(
+                Histogram(image,bins=bins,grey=True).histograms.get_grey()))
+            #computed once, then shared
+            self.assertIs(histo.grey(bins), histo.grey(bins))
+        self.assertIs(histo.grey(), histo.grey(32))
+        compact = histo.compact()
+        self.assertIs(compact.grey(), compact.grey())
+
+class TestHistogramPyramid(ut.TestCase):
+
+    def test_levels(self):
+        """
+        Every level must be the histogram computed with that number of bins
+        """
+        for path, a,b in expectation[3:8] :
+            image = Image(path)
+            pyramid = Histogram(image).pyramid()
+            self.assertEqual([level.bins for level in pyramid.levels],
+                             list(HistogramPyramid.LEVELS))
+            for testbins in [256, 255, 128, 100, 32, 8, 5, 300]:
+                self.assertEqual(pyramid.level(testbins),
+                                 Histogram(image,bins=testbins).compact())
+
+    def test_rebin(self):
+        image = Image(expectation[5][0])
+        compact = Histogram(image,bins=255).compact()
+        self.assertEqual(compact.rebin(32),
+                         Histogram(image,bins=32).compact())
+        with self.assertRaises(ValueError):
+            Histogram(image,bins=100).compact().rebin(64)
+
+    def test_serialization(self):
+        pyramid = Histogram(Image(expectation[4][0])).pyramid()
+        self.assertEqual(pickle.loads(pickle.dumps(pyramid)), pyramid)
+        self.assertEqual(HistogramPyramid.from_bytes(pyramid.to_bytes()),
+                         pyramid)
+
 
 if __name__ == '__main__':
     ut.main()
\ No newline at end of file
@@ -0,0 +1,91 @@
+import unittest as ut
+import IntegralHistogram
+from IntegralHistogram import IntegralHistogram as Integral
+from Histogram import Histogram, CompactHistogram, channel_counts
+from Image import Image
+import numpy as np
+import os
+
+
+maindir = os.path.dirname(__file__)
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestIntegralHistogram(ut.TestCase):
+    """
+    Unit testing class for the module IntegralHistogram, against the
+    histograms of the windows counted again.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.pixels = rng.integers(0, 256, (150, 203, 3), dtype = np.uint8)
+        #a window of other colors, found by the searches
+        patch = rng.integers(0, 64, (40, 60, 3), dtype = np.uint8)
+        self.pixels[80:120, 100:160] = patch
+        self.model = CompactHistogram(channel_counts(patch.reshape(-1, 3),
+                                                     8),
+                                      CompactHistogram.COLOR)
+
+    def test_rectangles(self):
+        rng = np.random.default_rng(1)
+        for cell in [1, 4, 7]:
+            integral = Integral(self.pixels, 8, cell)
+            rows, columns = integral.grid()
+            self.assertEqual((rows, columns), (-(-150 // cell),
+                                               -(-203 // cell)))
+            for _ in range(20):
+                top, bottom = np.sort(rng.choice(rows + 1, 2,
+                                                 replace = False))
+                left, right = np.sort(rng.choice(columns + 1, 2,
+                                                 replace = False))
+                window = self.pixels[top*cell:bottom*cell,
+                                     left*cell:right*cell]
+                np.testing.assert_array_equal(
+                    integral.rectangles(top, left, bottom, right),
+                    channel_counts(window.reshape(-1, 3), 8))
+            #the cells of the edges are cut by the image
+            np.testing.assert_array_equal(
+                integral.rectangles(0, 0, rows, columns),
+                channel_counts(self.pixels.reshape(-1, 3), 8))
+
+    def test_histogram(self):
+        integral = Integral(self.pixels, 8, 4)
+        self.assertEqual(integral.histogram(80, 100, 120, 160), self.model)
+        grey = Integral(self.pixels[:, :, 1], 8, 4)
+        self.assertEqual(grey.histogram(0, 0, 150, 203),
+                         CompactHistogram(channel_counts(
+                             self.pixels[:, :, 1].reshape(-1, 1), 8),
+                                          CompactHistogram.GREY))
+
+    def test_search(self):
+        integral = Integral(self.pixels, 8, 4)
+        stats = {}
+        found = integral.search(self.model, [(40, 60)], stats = stats)
+        self.assertEqual(found, [(100.0, (80, 100, 120, 160))])
+        self.assertLess(stats["windows"], stats["positions"])
+        #the same window as every position scored
+        rows, columns = integral.grid()
+        top, left = [np.ravel(axis) for axis in np.meshgrid(
+            np.arange(rows - 10 + 1), np.arange(columns - 15 + 1),
+            indexing = "ij")]
+        scores = integral.scores(integral._distributions(self.model), top,
+                                 left, 10, 15)
+        self.assertEqual(scores.max(), found[0][0])
+        self.assertEqual(len(top), stats["positions"])
+        #a grey model is compared with the grey histograms
+        window = integral.search(self.model.grey(), [(40, 60)])[0][1]
+        self.assertEqual(window, (80, 100, 120, 160))
+        found = integral.search(self.model)
+        self.assertEqual(len(found), 3)
+        self.assertEqual(found, sorted(found, key = lambda f : -f[0]))
+
+    def test_locate(self):
+        image = Image(query)
+        found = IntegralHistogram.locate(image, Histogram(image, bins = 8),
+                                         [(1000, 1000)], bins = 8)
+        #a window larger than the image is the whole image
+        self.assertEqual(found[0][1], (0, 0, image.height(), image.width()))
+        self.assertAlmostEqual(found[0][0], 100)
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,90 @@
+import unittest as ut
+import Kernels
+from Kernels import Kernel, normalize
+from Algorithm import euclidean_dist
+import numpy as np
+
+
+class TestKernels(ut.TestCase):
+    """
+    Unit testing class for the module Kernels, against the formulas written
+    one pair of samples at a time.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        images = rng.integers(0, 20, (4, 3, 16))
+        models = rng.integers(0, 20, (7, 3, 16))
+        #an empty bin in both, and a model equal to an image
+        images[:, :, 0] = models[:, :, 0] = 0
+        models[2] = images[1]
+        self.images, self.models = normalize(images), normalize(models)
+
+    def reference(self, name, p, q):
+        if name == "intersection":
+            return 1 - np.minimum(p, q).sum() / 3
+        if name == "euclidean":
+            return np.sqrt(((p - q) ** 2).sum())
+        if name == "chi-square":
+            return sum((a - b) ** 2 / (a + b) for a, b in
+                       zip(p.ravel(), q.ravel()) if a + b > 0) / 2
+        coefficient = np.sqrt(p * q).sum() / 3
+        if name == "hellinger":
+            return np.sqrt(max(1 - coefficient, 0))
+        if name == "bhattacharyya":
+            return max(-np.log(coefficient), 0)
+        if name == "cosine":
+            return 1 - (p * q).sum() / (np.linalg.norm(p) * np.linalg.norm(q))
+        if name == "emd":
+            return np.abs(np.cumsum(p, axis = 1) -
+                          np.cumsum(q, axis = 1)).sum() / 3
+
+    def test_kernels(self):
+        self.assertEqual(sorted(Kernels.KERNELS),
+                         ["bhattacharyya", "chi-square", "cosine", "emd",
+                          "euclidean", "hellinger", "intersection"])
+        for name, kernel in Kernels.KERNELS.items():
+            matrix = kernel.matrix(self.images, self.models)
+            self.assertEqual(matrix.shape, (4, 7))
+            for q, p in enumerate(self.images):
+                np.testing.assert_allclose(kernel.distances(p, self.models),
+                                           matrix[q])
+                for n, model in enumerate(self.models):
+                    self.assertAlmostEqual(matrix[q, n],
+                                           self.reference(name, p, model),
+                                           msg = name)
+                    self.assertAlmostEqual(kernel.pair(p, model),
+                                           matrix[q, n])
+            self.assertAlmostEqual(matrix[1, 2], 0, msg = name)
+
+    def test_vectors(self):
+        rng = np.random.default_rng(1)
+        vectors = rng.random((5, 40))
+        kernel = Kernels.get("euclidean")
+        for vector in vectors:
+            np.testing.assert_allclose(
+                np.around(kernel.distances(vector, vectors), decimals = 4),
+                [euclidean_dist(vector, v) for v in vectors])
+        self.assertEqual(kernel.matrix(np.zeros((0, 40)), vectors).shape,
+                         (0, 5))
+
+    def test_normalize(self):
+        res = normalize([[1, 3], [0, 0]])
+        np.testing.assert_array_equal(res, [[0.25, 0.75], [0, 0]])
+
+    def test_register(self):
+        kernel = Kernel("manhattan", lambda images, models : np.abs(
+            images[:, np.newaxis] - models).sum(axis = (2, 3)))
+        try:
+            self.assertIs(Kernels.register(kernel), kernel)
+            self.assertIs(Kernels.get("manhattan"), kernel)
+            self.assertIs(Kernels.get(kernel), kernel)
+            self.assertAlmostEqual(kernel.pair([0, 1], [1, 1]), 1)
+        finally:
+            del Kernels.KERNELS["manhattan"]
+        self.assertRaises(AssertionError, Kernels.get, "manhattan")
+        self.assertRaises(AssertionError, Kernels.get("cosine").matrix,
+                          self.images, self.models[:, :2])
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,111 @@
+import unittest as ut
+from MetricTree import MetricTree
+from Algorithm import euclidean_dist
+from Database import Database
+from Histogram import Histogram
+from Image import Image
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestMetricTree(ut.TestCase):
+    """
+    Unit testing class for the module MetricTree, against an exhaustive
+    search on random vectors.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.dirichlet(np.full(40, 0.2), size = 20)
+        self.vectors = np.concatenate([center + rng.normal(0, 0.002,
+                                                            (50, 40))
+                                       for center in centers])
+        #exact ties
+        self.vectors[[3, 500, 999]] = self.vectors[100]
+        self.paths = [f"image{i}" for i in range(len(self.vectors))]
+        self.queries = [self.vectors[100], self.vectors[7] + 0.001,
+                        rng.dirichlet(np.full(40, 0.2))]
+
+    def exhaustive(self, vector):
+        return sorted((euclidean_dist(vector, v), path)
+                      for path, v in zip(self.paths, self.vectors))
+
+    def test_nearest(self):
+        tree = MetricTree(self.paths, self.vectors)
+        for vector in self.queries:
+            expected = self.exhaustive(vector)
+            for depth in [1, 4, 15]:
+                stats = {}
+                self.assertEqual(tree.nearest(vector, depth, stats),
+                                 expected[:depth])
+                self.assertEqual(stats["distances"] + stats["saved"], 1000)
+        stats = {}
+        tree.nearest(self.queries[1], 5, stats)
+        self.assertGreater(stats["saved"], 500)
+
+    def test_candidates(self):
+        tree = MetricTree(self.paths, self.vectors)
+        for vector in self.queries:
+            values = [euclidean_dist(vector, v) for v in self.vectors]
+            kth = sorted(values)[3]
+            rows = tree.candidates(vector, 4)
+            self.assertEqual(list(rows), sorted(rows))
+            self.assertTrue({i for i in range(len(values))
+                             if values[i] <= kth} <= set(rows))
+
+    def test_within(self):
+        tree = MetricTree(self.paths, self.vectors)
+        for vector in self.queries:
+            expected = self.exhaustive(vector)
+            for radius in [0, 0.01, expected[30][0]]:
+                self.assertEqual(tree.within(vector, radius),
+                                 [e for e in expected if e[0] <= radius])
+
+    def test_insert(self):
+        tree = MetricTree.from_vectors([])
+        for path, vector in zip(self.paths, self.vectors):
+            tree.insert(path, vector)
+        self.assertEqual(len(tree), 1000)
+        for vector in self.queries:
+            self.assertEqual(tree.nearest(vector, 10),
+                             self.exhaustive(vector)[:10])
+
+    def test_save(self):
+        tree = MetricTree(self.paths, self.vectors, (1, 2))
+        with tempfile.TemporaryDirectory() as directory:
+            tree.save(os.path.join(directory, 'tree'))
+            loaded = MetricTree.load(os.path.join(directory, 'tree'))
+        self.assertEqual(loaded.version, (1, 2))
+        self.assertEqual(loaded.nearest(self.queries[0], 5),
+                         tree.nearest(self.queries[0], 5))
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            tree = database.metric_tree()
+            self.assertEqual(tree.version, database.version())
+            self.assertEqual(tree.paths,
+                             [p for p, _ in database.bin_histograms()])
+            histo = Histogram(Image(query))
+            database.add(query, histo)
+            tree = database.metric_tree()
+            self.assertEqual(tree.version, database.version())
+            self.assertEqual(len(tree), len(list(database.bin_histograms())))
+            self.assertEqual(tree.nearest(Histogram.color_axes(histo), 1)[0][0],
+                             0)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
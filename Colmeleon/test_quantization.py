@@ -0,0 +1,134 @@
+import unittest as ut
+import Retrieval
+import Quantization
+from ShardPool import ShardPool
+from Database import Database
+from Histogram import Histogram, CompactHistogram
+from Image import Image
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestQuantization(ut.TestCase):
+    """
+    Unit testing class for the module Quantization and the QuantizedMatrix
+    of Retrieval, against the scores of the counts.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        #images of different sizes, grey rows and an empty one
+        counts = rng.integers(0, 40, (120, 3, 8)) * rng.integers(1, 9,
+                                                                 (120, 1, 1))
+        counts[:, 1:] = counts[:, :1]
+        counts[:, 1] = rng.permutation(counts[:, 1], axis = 1)
+        counts[5] = 0
+        is_color = np.arange(120) % 6 != 0
+        self.histos = [CompactHistogram(c, CompactHistogram.COLOR)
+                       if color else CompactHistogram(c[:1],
+                                                      CompactHistogram.GREY)
+                       for c, color in zip(counts, is_color)]
+        self.matrix = Retrieval.FeatureMatrix.from_histograms(
+            [(f"image{i}", h) for i, h in enumerate(self.histos)], 8)
+        self.queries = [self.histos[1], self.histos[6], self.histos[40]]
+
+    def test_quantize(self):
+        counts = np.array([[[3, 0, 1, 2], [0, 0, 0, 0]],
+                           [[1, 1, 1, 0], [7, 0, 0, 1]]])
+        for dtype, (kind, total) in Quantization.DTYPES.items():
+            codes, sums = Quantization.quantize(counts, dtype)
+            self.assertEqual(codes.dtype, kind)
+            np.testing.assert_array_equal(sums, [[6, 0], [3, 8]])
+            np.testing.assert_array_equal(codes[0, 1], 0)
+            np.testing.assert_allclose(codes.sum(axis = -1),
+                                       [[total, 0], [total, total]],
+                                       rtol = 1e-6)
+            #each code is a rounding of the exact value
+            self.assertTrue(np.all(np.abs(codes[1, 0, :3] - total / 3) < 1))
+        codes = Quantization.quantize(counts, "uint8")[0]
+        np.testing.assert_array_equal(codes[1, 0], [85, 85, 85, 0])
+        self.assertRaises(AssertionError, Quantization.quantize, counts,
+                          "int4")
+
+    def test_scores(self):
+        exact = self.matrix.score_matrix(self.queries)
+        for dtype, (kind, total) in Quantization.DTYPES.items():
+            matrix = Retrieval.QuantizedMatrix.from_matrix(self.matrix,
+                                                           dtype)
+            self.assertEqual(matrix.colors.dtype, kind)
+            scores = matrix.score_matrix(self.queries)
+            #a code is less than 1 from the exact value in each bin, and
+            #the grey rows of the color images count 3 values per pixel
+            bound = 100 * 8 * 3 / total + 1e-3
+            finite = np.isfinite(exact)
+            np.testing.assert_array_equal(np.isfinite(scores), finite)
+            self.assertLessEqual(np.abs(scores - exact)[finite].max(), bound)
+            self.assertLess(matrix.nbytes(), (self.matrix.colors.nbytes +
+                                              self.matrix.greys.nbytes) *
+                            np.dtype(kind).itemsize / 4 + 1)
+        matrix = Retrieval.QuantizedMatrix.from_matrix(self.matrix,
+                                                       "float32")
+        np.testing.assert_allclose(matrix.score_matrix(self.queries), exact,
+                                   atol = 1e-3)
+        self.assertRaises(ValueError, matrix.cascade, self.queries[0], 3)
+
+    def test_subset_rows(self):
+        matrix = Retrieval.QuantizedMatrix.from_matrix(self.matrix, "uint8")
+        scores = matrix.scores(self.queries[0])
+        rows = [50, 3, 6, 119]
+        subset = matrix.subset(rows)
+        self.assertIsInstance(subset, Retrieval.QuantizedMatrix)
+        np.testing.assert_array_equal(subset.scores(self.queries[0]),
+                                      scores[rows])
+        np.testing.assert_array_equal(matrix.rows(30, 90).scores(
+            self.queries[0]), scores[30:90])
+        pool = ShardPool(matrix, workers = 2, shard_size = 37)
+        try:
+            self.assertEqual(pool.search(self.queries, 5),
+                             [Retrieval.top_k(np.abs(100 - row),
+                                              matrix.paths, 5)
+                              for row in matrix.score_matrix(self.queries)])
+        finally:
+            pool.close()
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            histo = Histogram(Image(query), bins = 32)
+            matrix = Retrieval.features(database, Retrieval.INTERSECTION, 32,
+                                        "uint16")
+            self.assertIsInstance(matrix, Retrieval.QuantizedMatrix)
+            self.assertIs(Retrieval.features(database,
+                                             Retrieval.INTERSECTION, 32,
+                                             "uint16"), matrix)
+            exact = Retrieval.search(database, histo, 3)
+            found = Retrieval.search(database, histo, 3, dtype = "uint16")
+            self.assertEqual([p for _, p in found], [p for _, p in exact])
+            for (value, _), (other, _) in zip(found, exact):
+                self.assertAlmostEqual(value, other, delta = 0.1)
+            self.assertRaises(AssertionError, Retrieval.search, database,
+                              histo, 3, Retrieval.CASCADE, dtype = "uint8")
+            error = Retrieval.quantization_error(database, "uint8", 3,
+                                                 bins = 32)
+            self.assertEqual(set(error), {"max", "mean", "recall", "bytes",
+                                          "exact bytes"})
+            self.assertLessEqual(error["mean"], error["max"])
+            self.assertEqual(error["bytes"] * 4, error["exact bytes"])
+            self.assertEqual(Retrieval.quantization_error(
+                database, "float32", 3, bins = 32)["recall"], 1.0)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
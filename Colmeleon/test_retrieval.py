@@ -0,0 +1,215 @@
+import unittest as ut
+import Retrieval
+import Kernels
+from Algorithm import match_value, euclidean_dist
+from Database import Database
+from Histogram import Histogram, CompactHistogram
+from Image import Image
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+queries = [os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg'),
+           os.path.join(maindir, 'UnitTesting', 'Histogram',
+                        'grey_square.png')]
+
+class TestRetrieval(ut.TestCase):
+    """
+    Unit testing class for the module Retrieval, on a copy of the small
+    database with a grey image added.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        directory = os.path.join(cls.workdir, 'db')
+        shutil.copytree(smalldb, directory)
+        shutil.copy(queries[1], directory)
+        tmpdir = os.path.join(cls.workdir, 'tmp')
+        os.mkdir(tmpdir)
+        cls.database = Database(directory, tmpdir)
+        cls.database._calculate_histograms()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def sequential(self, histo, grey = False):
+        """
+        The distances computed one image at a time
+        """
+        entries = (self.database.grey_histograms(histo.bins) if grey
+                   else self.database.histograms(histo.bins))
+        return sorted((abs(100 - match_value(histo, model)), path)
+                      for path, model in entries)
+
+    def test_search(self):
+        for path in queries:
+            for bins in [255, 32]:
+                histo = Histogram(Image(path), bins = bins)
+                for grey, mode in [(False, Retrieval.INTERSECTION),
+                                   (True, Retrieval.GREY)]:
+                    expected = self.sequential(histo, grey)
+                    result = Retrieval.search(self.database, histo, 3, mode)
+                    self.assertEqual([p for _, p in result],
+                                     [p for _, p in expected[:3]])
+                    for (value, _), (exp, _) in zip(result, expected):
+                        self.assertAlmostEqual(value, exp)
+
+    def test_search_incremental(self):
+        histo = Histogram(Image(queries[0]))
+        vector = Histogram.color_axes(histo)
+        expected = sorted((euclidean_dist(vector, model), path) for path, model
+                          in self.database.bin_histograms())
+        stats = {}
+        result = Retrieval.search(self.database, histo, 4,
+                                  Retrieval.INCREMENTAL, stats)
+        self.assertEqual(result, expected[:4])
+        self.assertEqual(stats["rows"], len(expected))
+        self.assertEqual(Retrieval.within(self.database, histo,
+                                          expected[2][0]), expected[:3])
+
+    def test_features_loaded_once(self):
+        matrix = Retrieval.features(self.database, Retrieval.INTERSECTION, 64)
+        self.assertIs(Retrieval.features(self.database,
+                                         Retrieval.INTERSECTION, 64), matrix)
+        self.assertEqual(len(matrix), len(list(self.database.histograms())))
+
+    def test_score_batch(self):
+        histos = [Histogram(Image(path), bins = 32) for path in queries]
+        for mode in Retrieval.MODES:
+            values, paths = Retrieval.score_batch(self.database, histos, mode)
+            self.assertEqual(values.shape, (len(histos), len(paths)))
+            for row, histo in zip(values, histos):
+                self.assertEqual(Retrieval.top_k(row, paths, 5),
+                                 Retrieval.search(self.database, histo, 5,
+                                                  mode))
+
+    def test_search_batch(self):
+        histos = [Histogram(Image(path), bins = bins) for bins in [255, 32]
+                  for path in queries * 2]
+        for mode in Retrieval.MODES:
+            results = list(Retrieval.search_batch(self.database, iter(histos),
+                                                  3, mode, batch = 3))
+            self.assertEqual(results, [Retrieval.search(self.database, histo,
+                                                        3, mode)
+                                       for histo in histos])
+
+    def test_search_incremental_intersection(self):
+        for path in queries:
+            for bins in [255, 32]:
+                histo = Histogram(Image(path), bins = bins)
+                for depth in [1, 3, 20]:
+                    stats = {}
+                    self.assertEqual(Retrieval.search(
+                        self.database, histo, depth,
+                        Retrieval.INCREMENTAL_INTERSECTION, stats),
+                        Retrieval.search(self.database, histo, depth,
+                                         Retrieval.INTERSECTION))
+                    self.assertLessEqual(stats["scored"], stats["rows"])
+
+    def test_posting_index(self):
+        rng = np.random.default_rng(0)
+        counts = np.stack([rng.multinomial(1000, rng.dirichlet(
+            np.full(16, 0.1)), size = 3) for _ in range(300)])
+        #a few exact ties with the query
+        counts[[10, 20]] = counts[5]
+        pixels = np.full(300, 1000)
+        index = Retrieval.PostingIndex(counts, pixels)
+        expected = np.abs(100 - Retrieval._scores(counts[5], counts, pixels))
+        for depth in [1, 2, 3, 4, 10, 300]:
+            stats = {}
+            kept = index.candidates(counts[5], depth, stats)
+            self.assertEqual(list(kept), sorted(kept))
+            kth = np.sort(expected)[min(depth, 300) - 1]
+            self.assertTrue(set(np.flatnonzero(expected <= kth)) <=
+                            set(kept))
+            self.assertEqual(stats["rows"], 300)
+            self.assertEqual(stats["scored"], len(kept))
+        stats = {}
+        self.assertEqual(list(index.candidates(counts[0], 1, stats)), [0])
+        self.assertLess(stats["bins"], 48)
+
+    def test_search_cascade(self):
+        for path in queries:
+            for bins in [255, 32]:
+                histo = Histogram(Image(path), bins = bins)
+                for depth in [1, 3, 20]:
+                    stats = {}
+                    self.assertEqual(Retrieval.search(
+                        self.database, histo, depth, Retrieval.CASCADE,
+                        stats), Retrieval.search(self.database, histo, depth,
+                                                 Retrieval.INTERSECTION))
+                    self.assertEqual(stats["coarse"], stats["rows"])
+                    self.assertLessEqual(stats["full"], stats["rows"])
+
+    def test_cascade(self):
+        rng = np.random.default_rng(0)
+        centers = rng.dirichlet(np.full(32, 0.3), size = (20, 3))
+        counts = np.stack([[rng.multinomial(1000, center) for center in
+                            centers[i % 20]] for i in range(2000)])
+        #a few exact ties with the query
+        counts[[10, 20]] = counts[5]
+        counts = counts.astype(np.uint32)
+        matrix = Retrieval.FeatureMatrix(
+            [str(i) for i in range(2000)], 32, np.ones(2000, dtype = bool),
+            counts.reshape(2000, -1), counts.sum(axis = 1),
+            np.full(2000, 1000))
+        query = CompactHistogram(counts[5], CompactHistogram.COLOR)
+        expected = np.abs(100 - matrix.scores(query))
+        for depth in [1, 3, 15]:
+            stats = {}
+            rows, scores = matrix.cascade(query, depth, stats)
+            self.assertEqual(list(rows), sorted(rows))
+            np.testing.assert_array_equal(np.abs(100 - scores),
+                                          expected[rows])
+            kth = np.sort(expected)[depth - 1]
+            self.assertTrue(set(np.flatnonzero(expected <= kth)) <=
+                            set(rows))
+            self.assertEqual(stats["coarse"], 2000)
+            self.assertLess(stats["full"], 1000)
+
+    def test_search_kernel(self):
+        for path in queries:
+            histo = Histogram(Image(path), bins = 32)
+            query = histo.compact()
+            for name, kernel in Kernels.KERNELS.items():
+                expected = []
+                for model_path, model in self.database.histograms(32):
+                    image = query
+                    if not (query.is_color() and model.is_color()):
+                        image, model = query.grey(), model.grey()
+                    expected.append((kernel.pair(
+                        Kernels.normalize(image.counts),
+                        Kernels.normalize(model.counts)), model_path))
+                expected.sort()
+                result = Retrieval.search(self.database, histo, 3,
+                                          Retrieval.INTERSECTION,
+                                          kernel = name)
+                self.assertEqual([p for _, p in result],
+                                 [p for _, p in expected[:3]])
+                for (value, _), (exp, _) in zip(result, expected):
+                    self.assertAlmostEqual(value, exp)
+        histo = Histogram(Image(queries[0]))
+        result = Retrieval.search(self.database, histo, 3,
+                                  Retrieval.INCREMENTAL, kernel = "euclidean")
+        self.assertEqual([p for _, p in result],
+                         [p for _, p in Retrieval.search(
+                             self.database, histo, 3, Retrieval.INCREMENTAL)])
+        self.assertRaises(AssertionError, Retrieval.search, self.database,
+                          histo, 3, Retrieval.CASCADE, kernel = "cosine")
+
+    def test_top_k(self):
+        values = np.array([3., 1., 2., 1., 5.])
+        paths = ['e', 'd', 'c', 'b', 'a']
+        self.assertEqual(Retrieval.top_k(values, paths, 2),
+                         [(1., 'b'), (1., 'd')])
+        self.assertEqual(len(Retrieval.top_k(values, paths, 10)), 5)
+        self.assertEqual(Retrieval.top_k(values, paths, 0), [])
+
+if __name__ == '__main__':
+    ut.main()
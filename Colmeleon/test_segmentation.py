@@ -0,0 +1,144 @@
+import unittest as ut
+import Segmentation
+from Database import Database
+from Histogram import Histogram, CompactHistogram, bin_lut
+from Image import Image
+import numpy as np
+import cv2
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestSegmentation(ut.TestCase):
+    """
+    Unit testing class for the module Segmentation, against the likelihoods
+    of each pixel computed one by one.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.pixels = rng.integers(0, 256, (37, 23, 3), dtype = np.uint8)
+        self.model = CompactHistogram(rng.integers(0, 50, (3, 8)),
+                                      CompactHistogram.COLOR)
+
+    def reference(self, pixels, model, bins):
+        image = Segmentation.image_histogram(pixels, bins)
+        if pixels.ndim == 2 or not model.is_color():
+            model, image = model.grey(), image.grey()
+        m = model.counts / model.counts.sum(axis = 1, keepdims = True)
+        i = image.counts / image.counts.sum(axis = 1, keepdims = True)
+        lut = bin_lut(bins)
+        res = np.empty(pixels.shape[:2])
+        for y in range(pixels.shape[0]):
+            for x in range(pixels.shape[1]):
+                values = np.atleast_1d(pixels[y, x])
+                res[y, x] = min(min(m[c % len(m), lut[v]] /
+                                    i[c % len(i), lut[v]], 1)
+                                for c, v in enumerate(values))
+        return res
+
+    def test_likelihoods(self):
+        model = CompactHistogram([[2, 2, 0, 0]], CompactHistogram.GREY)
+        image = CompactHistogram([[1, 9, 0, 2]], CompactHistogram.GREY)
+        np.testing.assert_allclose(Segmentation.likelihoods(model, image),
+                                   [[1, 2 / 3, 0, 0]])
+        np.testing.assert_allclose(Segmentation.likelihoods(model, image,
+                                                            False),
+                                   [[1, 1, 0, 0]])
+        color = CompactHistogram([[1, 3, 0, 4]] * 3, CompactHistogram.COLOR)
+        self.assertEqual(Segmentation.likelihoods(model, color).shape, (1, 4))
+        self.assertEqual(Segmentation.likelihoods(color, color).shape, (3, 4))
+
+    def test_backproject(self):
+        expected = self.reference(self.pixels, self.model, 8)
+        stats = {}
+        #tiles of a few rows, the last one shorter
+        mask = Segmentation.backproject(self.pixels, self.model, 8,
+                                        tile = 100, stats = stats)
+        self.assertEqual(mask.dtype, np.float32)
+        np.testing.assert_allclose(mask, expected, rtol = 1e-6)
+        self.assertEqual(stats, {"tiles": 10, "pixels": 37 * 23})
+        mask = Segmentation.backproject(self.pixels, self.model, 8,
+                                        dtype = np.uint8)
+        np.testing.assert_array_equal(mask, np.rint(expected * 255))
+        out = np.zeros((37, 23), dtype = np.float32)
+        self.assertIs(Segmentation.backproject(self.pixels, self.model, 8,
+                                               out = out), out)
+        self.assertRaises(AssertionError, Segmentation.backproject,
+                          self.pixels, self.model, 8, dtype = np.int16)
+
+    def test_grey(self):
+        grey = self.pixels[:, :, 0]
+        np.testing.assert_allclose(Segmentation.backproject(grey, self.model,
+                                                            8),
+                                   self.reference(grey, self.model, 8),
+                                   rtol = 1e-6)
+        model = self.model.grey()
+        np.testing.assert_allclose(Segmentation.backproject(self.pixels,
+                                                            model, 8),
+                                   self.reference(self.pixels, model, 8),
+                                   rtol = 1e-6)
+
+    def test_image(self):
+        image = Image(query)
+        histo = Histogram(image, bins = 16)
+        self.assertEqual(Segmentation.image_histogram(image, 16, tile = 999),
+                         histo.compact())
+        #an image is entirely its own model
+        np.testing.assert_array_equal(Segmentation.backproject(image, histo,
+                                                               16), 1)
+        self.assertEqual(Segmentation.model_histogram(query, 16),
+                         histo.compact())
+        self.assertEqual(Segmentation.model_histogram(histo, 8),
+                         histo.pyramid().level(8))
+
+    def test_mask_files(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            mask = Segmentation.backproject(self.pixels, self.model, 8)
+            path = os.path.join(workdir, 'mask.npy')
+            Segmentation.write_mask(mask, path, tile = 50)
+            np.testing.assert_array_equal(np.load(path), mask)
+            path = os.path.join(workdir, 'mask.png')
+            Segmentation.write_mask(mask, path)
+            np.testing.assert_array_equal(cv2.imread(path,
+                                                     cv2.IMREAD_GRAYSCALE),
+                                          np.rint(mask * 255))
+            #a memory-mapped image into a memory-mapped mask
+            pixels = np.lib.format.open_memmap(
+                os.path.join(workdir, 'image.npy'), mode = "w+",
+                dtype = np.uint8, shape = self.pixels.shape)
+            pixels[:] = self.pixels
+            out = np.lib.format.open_memmap(
+                os.path.join(workdir, 'out.npy'), mode = "w+",
+                dtype = np.uint8, shape = (37, 23))
+            Segmentation.backproject(pixels, self.model, 8, tile = 64,
+                                     out = out)
+            np.testing.assert_array_equal(out, Segmentation.backproject(
+                self.pixels, self.model, 8, dtype = np.uint8))
+            del pixels, out
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            path, histo = next(database.histograms(32))
+            self.assertEqual(Segmentation.model_histogram(path, 32,
+                                                          database),
+                             CompactHistogram.from_histogram(histo))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,90 @@
+import unittest as ut
+import Retrieval
+from ShardPool import ShardPool
+from Database import Database
+from Histogram import Histogram, CompactHistogram
+from Image import Image
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+query = os.path.join(maindir, 'UnitTesting', 'Image', 'image5.jpg')
+
+class TestShardPool(ut.TestCase):
+    """
+    Unit testing class for the module ShardPool, against the exhaustive
+    search of the same FeatureMatrix.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 6, (200, 3, 8))
+        #grey rows, and exact ties across the shards
+        is_color = np.arange(200) % 7 != 0
+        counts[[50, 120, 199]] = counts[1]
+        self.histos = [CompactHistogram(c, CompactHistogram.COLOR)
+                       if color else CompactHistogram(c[:1],
+                                                      CompactHistogram.GREY)
+                       for c, color in zip(counts, is_color)]
+        self.matrix = Retrieval.FeatureMatrix.from_histograms(
+            [(f"image{i}", h) for i, h in enumerate(self.histos)], 8)
+        self.queries = [self.histos[1], self.histos[7], self.histos[3]]
+
+    def test_rows(self):
+        shard = self.matrix.rows(30, 90)
+        self.assertEqual(shard.paths, self.matrix.paths[30:90])
+        np.testing.assert_array_equal(
+            shard.scores(self.queries[0]),
+            self.matrix.scores(self.queries[0])[30:90])
+
+    def test_search(self):
+        pool = ShardPool(self.matrix, workers = 2, shard_size = 37)
+        try:
+            self.assertEqual(pool.shards()[-1], (185, 200))
+            for depth in [1, 4, 15, 300]:
+                expected = [Retrieval.top_k(np.abs(100 - row),
+                                            self.matrix.paths, depth)
+                            for row in self.matrix.score_matrix(self.queries)]
+                self.assertEqual(pool.search(self.queries, depth), expected)
+            expected = Retrieval.top_k(self.matrix.distance_matrix(
+                self.queries[:1], "emd")[0], self.matrix.paths, 5)
+            self.assertEqual(pool.search(self.queries[:1], 5, "emd")[0],
+                             expected)
+        finally:
+            pool.close()
+        self.assertFalse(os.path.exists(pool.directory))
+
+    def test_database(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            histo = Histogram(Image(query), bins = 32)
+            for mode in [Retrieval.INTERSECTION, Retrieval.GREY]:
+                self.assertEqual(Retrieval.search(database, histo, 3, mode,
+                                                  workers = 2,
+                                                  shard_size = 2),
+                                 Retrieval.search(database, histo, 3, mode))
+            #the pool is kept for the next queries, until the database changes
+            pool = Retrieval.shard_pool(database, Retrieval.INTERSECTION, 32)
+            self.assertEqual((pool.workers, pool.shard_size), (2, 2))
+            self.assertEqual(list(Retrieval.search_batch(
+                database, [histo, histo], 3, workers = 2, shard_size = 2)),
+                [Retrieval.search(database, histo, 3)] * 2)
+            self.assertIs(Retrieval.shard_pool(database, bins = 32), pool)
+            database.add(query, Histogram(Image(query)))
+            self.assertIsNot(Retrieval.shard_pool(database, bins = 32), pool)
+            self.assertFalse(os.path.exists(pool.directory))
+        finally:
+            Retrieval.close_pools()
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()
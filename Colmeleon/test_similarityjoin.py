@@ -0,0 +1,123 @@
+import unittest as ut
+import Retrieval
+import SimilarityJoin
+from ShardPool import ShardPool
+from Database import Database
+from Histogram import CompactHistogram
+import numpy as np
+import io
+import csv
+import json
+import tempfile
+import shutil
+import os
+
+
+maindir = os.path.dirname(__file__)
+smalldb = os.path.join(maindir, 'chameleon_smallDB')
+
+class TestSimilarityJoin(ut.TestCase):
+    """
+    Unit testing class for the module SimilarityJoin, against the scores of
+    every pair of rows.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 4, (150, 3, 8)) ** 3
+        #near duplicates, among color rows, grey rows, and across them
+        for i, j in [(3, 40), (5, 90), (14, 21), (28, 1), (70, 71)]:
+            counts[j] = counts[i] + rng.integers(0, 2, (3, 8))
+        self.is_color = np.arange(150) % 7 != 0
+        histos = [CompactHistogram(c, CompactHistogram.COLOR)
+                  if color else CompactHistogram(c[:1],
+                                                 CompactHistogram.GREY)
+                  for c, color in zip(counts, self.is_color)]
+        self.matrix = Retrieval.FeatureMatrix.from_histograms(
+            [(f"image{i}", h) for i, h in enumerate(histos)], 8)
+
+    def brute_force(self, threshold):
+        colors = self.matrix.normalized("color")
+        greys = self.matrix.normalized("grey")
+        color_rows = np.flatnonzero(self.is_color)
+        res = {}
+        for i in range(len(self.matrix)):
+            for j in range(i + 1, len(self.matrix)):
+                if self.is_color[i] and self.is_color[j]:
+                    a = colors[np.searchsorted(color_rows, i)]
+                    b = colors[np.searchsorted(color_rows, j)]
+                else:
+                    a, b = greys[i], greys[j]
+                score = np.minimum(a, b).sum(axis = -1).min() * 100
+                if score >= threshold:
+                    res[(i, j)] = score
+        return res
+
+    def test_join(self):
+        for threshold in [95, 80, 50, 10]:
+            stats = {}
+            found = {(i, j): score for i, j, score
+                     in SimilarityJoin.join(self.matrix, threshold, stats)}
+            expected = self.brute_force(threshold)
+            self.assertEqual(set(found), set(expected))
+            for pair, score in expected.items():
+                self.assertAlmostEqual(found[pair], score)
+            self.assertEqual(stats["pairs"], len(expected))
+            self.assertEqual(stats["rows"], 150)
+        #the blocks compare fewer pairs than every pair at a high threshold
+        stats = {}
+        list(SimilarityJoin.join(self.matrix, 95, stats))
+        self.assertLess(stats["scored"], 150 * 149 // 2)
+        self.assertRaises(AssertionError, list,
+                          SimilarityJoin.join(self.matrix, 0))
+
+    def test_join_pool(self):
+        pool = ShardPool(self.matrix, workers = 2)
+        try:
+            self.assertEqual(list(SimilarityJoin.join(self.matrix, 80,
+                                                      pool = pool)),
+                             list(SimilarityJoin.join(self.matrix, 80)))
+        finally:
+            pool.close()
+
+    def test_write_pairs(self):
+        pairs = [("a.jpg", "b.jpg", 97.5), ("a.jpg", "c,d.jpg", 91.0)]
+        out = io.StringIO()
+        self.assertEqual(SimilarityJoin.write_pairs(iter(pairs), out,
+                                                    "csv"), 2)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows, [[a, b, str(s)] for a, b, s in pairs])
+        out = io.StringIO()
+        SimilarityJoin.write_pairs(pairs, out)
+        lines = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual(lines[1], {"path": "a.jpg", "other": "c,d.jpg",
+                                    "score": 91.0})
+        self.assertRaises(AssertionError, SimilarityJoin.write_pairs,
+                          pairs, out, "xml")
+
+    def test_duplicates(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            directory = os.path.join(workdir, 'db')
+            shutil.copytree(smalldb, directory)
+            name = sorted(os.listdir(directory))[0]
+            original = os.path.join(directory, name)
+            copy = os.path.join(directory, 'copy_' + name)
+            shutil.copy(original, copy)
+            images = len(os.listdir(directory))
+            os.mkdir(os.path.join(workdir, 'tmp'))
+            database = Database(directory, os.path.join(workdir, 'tmp'))
+            database._calculate_histograms()
+            stats = {}
+            pairs = list(SimilarityJoin.duplicates(database, 99.9,
+                                                   stats = stats))
+            self.assertIn(sorted([original, copy]),
+                          [sorted(pair[:2]) for pair in pairs])
+            for path, other, score in pairs:
+                self.assertGreaterEqual(score, 99.9)
+            self.assertEqual(stats["rows"], images)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    ut.main()